@@ -0,0 +1,61 @@
+"""Micro-benchmark of moodle.convert_moodle_params for large payloads
+compared to the previous recursive implementation.
+
+    $ python benchmarks/bench_convert_params.py
+"""
+import timeit
+from moodlecli.moodle import convert_moodle_params
+
+
+def recursive_convert_moodle_params(data, prefix=""):
+    result = {}
+
+    if not isinstance(data, (list, dict)):
+        result[prefix] = data
+        return result
+
+    if not prefix:
+        prefix = "{0}"
+    else:
+        prefix += "[{0}]"
+
+    if isinstance(data, list):
+        for idx, val in enumerate(data):
+            result.update(
+                recursive_convert_moodle_params(val, prefix.format(idx))
+            )
+    elif isinstance(data, dict):
+        for key, val in data.items():
+            result.update(
+                recursive_convert_moodle_params(val, prefix.format(key))
+            )
+
+    return result
+
+
+PAYLOADS = {
+    "get_user_uuids (50k ids)": {"userids": list(range(50000))},
+    "enrol_users (5k enrolments)": {
+        "enrolments": [
+            {"roleid": 5, "userid": idx, "courseid": 1}
+            for idx in range(5000)
+        ]
+    },
+}
+
+
+def main():
+    for name, payload in PAYLOADS.items():
+        assert convert_moodle_params(payload) == \
+            recursive_convert_moodle_params(payload)
+        for func in (recursive_convert_moodle_params, convert_moodle_params):
+            seconds = min(timeit.repeat(
+                lambda: func(payload),
+                number=5,
+                repeat=7
+            )) / 5
+            print(f"{name:30} {func.__name__:33} {seconds * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Micro-benchmark of update_grades_data reusing large historical grade
+exports with many attempts per quiz. Moodle is replaced by an in process
+stub so only the time spent checking old data for staleness and copying
+it is measured.
+
+    $ python benchmarks/bench_grades_index.py --users 500 --attempts 50
+"""
+import timeit
+import click
+from moodlecli import utils
+
+
+class StubMoodle:
+    """Serves grades for users who have each attempted every quiz, where
+    users with an ID divisible by active_every have submitted a new
+    attempt since the old export"""
+
+    def __init__(self, users, quizzes, attempts, active_every):
+        self.users = users
+        self.quizzes = quizzes
+        self.attempts = attempts
+        self.active_every = active_every
+
+    def _is_active(self, user_id):
+        return self.active_every and int(user_id) % self.active_every == 0
+
+    def _summaries(self, user_id, quiz_id, attempts):
+        base_id = (int(user_id) * self.quizzes + int(quiz_id)) * 1000
+        return [
+            {
+                "id": base_id + idx,
+                "attempt": idx + 1,
+                "state": "finished",
+                "gradednotificationsenttime": 1000 + idx
+            }
+            for idx in range(attempts)
+        ]
+
+    def get_grades_by_course(self, course_id):
+        return {"usergrades": [
+            {
+                "userid": user_id,
+                "gradeitems": [
+                    {
+                        "iteminstance": quiz_id,
+                        "gradedatesubmitted": (
+                            1000 + self.attempts
+                            if self._is_active(user_id)
+                            else 1000 + self.attempts - 1
+                        )
+                    }
+                    for quiz_id in range(self.quizzes)
+                ]
+            }
+            for user_id in range(self.users)
+        ]}
+
+    def get_quizzes_by_courses(self, course_ids):
+        return {"quizzes": [{"id": idx} for idx in range(self.quizzes)]}
+
+    def get_user_quiz_attempts(self, user_id, quiz_id):
+        return {"attempts": self._summaries(
+            user_id, quiz_id, self.attempts + 1
+        )}
+
+    def get_quiz_attempt_details(self, attempt_id):
+        return {"attempt": {"id": attempt_id}, "questions": []}
+
+    def old_grades(self):
+        grades = self.get_grades_by_course(1)
+        grades["attempts"] = {
+            str(user_id): {
+                str(quiz_id): {
+                    "summaries": self._summaries(
+                        user_id, quiz_id, self.attempts
+                    ),
+                    "details": {
+                        str(summary["id"]): self.get_quiz_attempt_details(
+                            str(summary["id"])
+                        )
+                        for summary in self._summaries(
+                            user_id, quiz_id, self.attempts
+                        )
+                    }
+                }
+                for quiz_id in range(self.quizzes)
+            }
+            for user_id in range(self.users)
+        }
+        return grades
+
+
+@click.command()
+@click.option("--users", type=int, default=200, show_default=True)
+@click.option("--quizzes", type=int, default=10, show_default=True)
+@click.option("--attempts", type=int, multiple=True,
+              help="Attempts per user and quiz in the old export "
+                   "[default: 1, 10, 50]")
+@click.option("--active-every", type=int, default=10, show_default=True,
+              help="Every Nth user has a new attempt (0 for none)")
+def main(users, quizzes, attempts, active_every):
+    for attempt_count in attempts or (1, 10, 50):
+        moodle = StubMoodle(users, quizzes, attempt_count, active_every)
+        old_grades = moodle.old_grades()
+        seconds = min(timeit.repeat(
+            lambda: utils.update_grades_data(moodle, 1, old_grades),
+            number=1,
+            repeat=5
+        ))
+        print(
+            f"{users} users x {quizzes} quizzes x {attempt_count:3} "
+            f"attempts: {seconds * 1000:8.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
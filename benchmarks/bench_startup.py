@@ -0,0 +1,81 @@
+"""Startup time of the CLI for commands which don't talk to Moodle or S3,
+measured as the wall time of fresh interpreter processes.
+
+    $ python benchmarks/bench_startup.py --runs 20
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import click
+from prettytable import PrettyTable
+
+COMMANDS = [
+    ["--help"],
+    ["course-bulk-csv", "out.csv"],
+    ["enrol-bulk-csv", "out.csv"],
+    ["unenrol-bulk-csv", "out.csv"],
+    ["import-bulk-csv", "out.csv"],
+    ["export-bulk-csv", "out.csv"],
+]
+CLI_CODE = "import sys; from moodlecli.main import cli; cli(sys.argv[1:])"
+HEAVY_MODULES = ["boto3", "requests", "prettytable", "httpx"]
+HEAVY_MODULES_CODE = (
+    "import sys; from moodlecli.main import cli; "
+    "cli(sys.argv[1:], standalone_mode=False); "
+    f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+)
+
+
+def run(code, args, cwd):
+    env = {
+        **os.environ,
+        "MOODLE_URL": "http://localhost",
+        "MOODLE_TOKEN": "benchmark"
+    }
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", code, *args],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    return time.perf_counter() - start, result.stdout
+
+
+@click.command()
+@click.option("--runs", type=int, default=10, show_default=True,
+              help="Number of processes started per command")
+def main(runs):
+    t = PrettyTable()
+    t.field_names = ["command", "median (ms)", "min (ms)", "heavy imports"]
+    t.align["command"] = "l"
+    t.align["heavy imports"] = "l"
+
+    with tempfile.TemporaryDirectory() as cwd:
+        baseline = [run("pass", [], cwd)[0] for _ in range(runs)]
+        t.add_row([
+            "python -c pass",
+            f"{statistics.median(baseline) * 1000:.1f}",
+            f"{min(baseline) * 1000:.1f}",
+            ""
+        ])
+        for args in COMMANDS:
+            timings = [run(CLI_CODE, args, cwd)[0] for _ in range(runs)]
+            _, output = run(HEAVY_MODULES_CODE, args, cwd)
+            t.add_row([
+                f"moodle-cli {' '.join(args)}",
+                f"{statistics.median(timings) * 1000:.1f}",
+                f"{min(timings) * 1000:.1f}",
+                output.splitlines()[-1] if output.strip() else ""
+            ])
+
+    click.echo(t.get_string())
+
+
+if __name__ == "__main__":
+    main()
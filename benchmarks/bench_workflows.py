@@ -0,0 +1,314 @@
+"""End to end benchmarks of grade exports, bulk enrolment and bulk course
+setup against a local fake Moodle server (see fake_moodle.py) with a fixed
+latency per web service call. S3 is replaced with an in memory store.
+
+    $ python benchmarks/bench_workflows.py --latency 0.02 --courses 4
+"""
+import csv
+import io
+import json
+import os
+import sys
+import time
+from unittest import mock
+import click
+from click.testing import CliRunner
+from prettytable import PrettyTable
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_moodle import FakeMoodleServer, FakeMoodleSite  # noqa: E402
+from moodlecli import aws, utils  # noqa: E402
+from moodlecli.main import cli  # noqa: E402
+from moodlecli.moodle import MoodleClient, create_session  # noqa: E402
+
+BENCH_TOKEN = "benchmark"
+
+
+class MemoryStorage:
+    """In memory stand in for aws.S3Storage"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_json_data(self, data, bucket_name, key, output_format=None,
+                      compression=None, skip_unchanged=False):
+        self.objects[(bucket_name, key)] = json.dumps(data)
+        return True
+
+    def put_json_file(self, fileobj, bucket_name, key, compression=None,
+                      skip_unchanged=False):
+        self.objects[(bucket_name, key)] = fileobj.read().decode("utf-8")
+        return True
+
+    def get_json_data(self, bucket_name, key, default=None):
+        if (bucket_name, key) in self.objects:
+            return json.loads(self.objects[(bucket_name, key)])
+        if default is not None:
+            return default
+        raise KeyError(key)
+
+    def download_file(self, bucket_name, key, fileobj):
+        if (bucket_name, key) not in self.objects:
+            return False
+        fileobj.write(self.objects[(bucket_name, key)].encode("utf-8"))
+        return True
+
+    def delete_objects(self, bucket_name, keys):
+        for key in keys:
+            self.objects.pop((bucket_name, key), None)
+
+
+class Results:
+    def __init__(self):
+        self.table = PrettyTable()
+        self.table.field_names = [
+            "benchmark", "variant", "seconds", "requests"
+        ]
+        self.table.align["benchmark"] = "l"
+        self.table.align["variant"] = "l"
+
+    def add(self, benchmark, variant, seconds, server):
+        self.table.add_row([
+            benchmark,
+            variant,
+            f"{seconds:.3f}",
+            sum(server.calls.values())
+        ])
+        click.echo(f"{benchmark} [{variant}]: {seconds:.3f}s", err=True)
+
+
+def invoke(server, args, input=None):
+    result = CliRunner().invoke(
+        cli,
+        args,
+        input=input,
+        env={"MOODLE_URL": server.url, "MOODLE_TOKEN": BENCH_TOKEN},
+        catch_exceptions=False
+    )
+    if result.exit_code != 0:
+        raise click.ClickException(
+            f"moodle-cli {' '.join(args)} failed:\n{result.output}"
+        )
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def csv_text(fieldnames, rows):
+    f = io.StringIO()
+    writer = csv.DictWriter(f, fieldnames)
+    writer.writeheader()
+    writer.writerows(rows)
+    return f.getvalue()
+
+
+def bench_update_grades_data(results, site_args, latency, max_workers):
+    with FakeMoodleServer(FakeMoodleSite(**site_args), latency) as server:
+        client = MoodleClient(
+            create_session(max(max_workers)),
+            server.url,
+            BENCH_TOKEN
+        )
+        for workers in max_workers:
+            server.reset_calls()
+            grades = {}
+
+            def run():
+                nonlocal grades
+                grades = utils.update_grades_data(client, 1, {}, workers)
+
+            results.add(
+                "update_grades_data",
+                f"cold, max_workers={workers}",
+                timed(run),
+                server
+            )
+
+            server.reset_calls()
+            results.add(
+                "update_grades_data",
+                f"warm, max_workers={workers}",
+                timed(lambda: utils.update_grades_data(
+                    client, 1, grades, workers
+                )),
+                server
+            )
+
+            grades = utils.update_grades_data(
+                client, 1, grades, workers, fingerprints=True
+            )
+            server.reset_calls()
+            results.add(
+                "update_grades_data",
+                f"warm, fingerprints, max_workers={workers}",
+                timed(lambda: utils.update_grades_data(
+                    client, 1, grades, workers, fingerprints=True
+                )),
+                server
+            )
+
+
+def bench_export_bulk(results, site_args, latency, max_workers, parallel):
+    courses = csv_text(
+        [utils.CSV_COURSE_ID],
+        [
+            {utils.CSV_COURSE_ID: course_id}
+            for course_id in range(1, site_args["courses"] + 1)
+        ]
+    )
+    variants = [
+        ("serial", []),
+        (
+            f"--parallel {parallel} --max-workers {max_workers}",
+            ["--parallel", str(parallel), "--max-workers", str(max_workers)]
+        ),
+        (
+            f"--parallel {parallel} --max-workers {max_workers} "
+            "--quiz-chunk-size 50",
+            ["--parallel", str(parallel), "--max-workers", str(max_workers),
+             "--quiz-chunk-size", "50"]
+        ),
+    ]
+    for variant, options in variants:
+        with FakeMoodleServer(FakeMoodleSite(**site_args), latency) as \
+                server, mock.patch.object(
+                    aws, "_default_storage", MemoryStorage()
+                ):
+            args = [
+                "--pool-size", str(parallel * max_workers), "export-bulk",
+                "-", "bench-bucket", "grades", "grades", *options
+            ]
+            results.add(
+                "export-bulk grades",
+                variant,
+                timed(lambda: invoke(server, args, courses)),
+                server
+            )
+
+
+def bench_enrol_bulk(results, site_args, latency, users, batch_size):
+    variants = [
+        ("serial", []),
+        (f"--batch-size {batch_size}", ["--batch-size", str(batch_size)]),
+    ]
+    for variant, options in variants:
+        site = FakeMoodleSite(**{**site_args, "courses": 1})
+        # Up to half of the users already have accounts
+        existing_emails = [user["email"] for user in site.users.values()]
+        user_rows = [
+            {
+                utils.CSV_USER_FNAME: "First",
+                utils.CSV_USER_LNAME: f"Last{idx}",
+                utils.CSV_USER_EMAIL: (
+                    existing_emails[idx // 2]
+                    if idx % 2 and idx // 2 < len(existing_emails)
+                    else f"new{idx}@example.com"
+                ),
+                utils.CSV_USER_AUTH: "manual"
+            }
+            for idx in range(users)
+        ]
+        user_csv = csv_text(utils.enrol_bulk_input_csv_fieldnames(), user_rows)
+        with FakeMoodleServer(site, latency) as server:
+            args = ["enrol-bulk", "1", "student", "-", *options]
+            results.add(
+                "enrol-bulk",
+                f"{users} users, {variant}",
+                timed(lambda: invoke(server, args, user_csv)),
+                server
+            )
+
+
+def bench_course_bulk_setup(results, site_args, latency, courses, parallel):
+    course_csv = csv_text(
+        utils.course_bulk_input_csv_fieldnames(),
+        [
+            {
+                utils.CSV_INST_FNAME: "Instructor",
+                utils.CSV_INST_LNAME: f"Last{idx % 3}",
+                utils.CSV_INST_EMAIL: f"instructor{idx % 3}@example.com",
+                utils.CSV_INST_AUTH: "manual",
+                utils.CSV_COURSE_NAME: f"Bench course {idx}",
+                utils.CSV_COURSE_SHORTNAME: f"bench{idx}",
+                utils.CSV_COURSE_CATEGORY: "1"
+            }
+            for idx in range(courses)
+        ]
+    )
+    variants = [
+        ("serial", []),
+        (f"--parallel {parallel}", ["--parallel", str(parallel)]),
+    ]
+    for variant, options in variants:
+        site = FakeMoodleSite(**{**site_args, "courses": 1})
+        with FakeMoodleServer(site, latency) as server:
+            args = ["course-bulk-setup", "1", "-", os.devnull, *options]
+            results.add(
+                "course-bulk-setup",
+                f"{courses} courses, {variant}",
+                timed(lambda: invoke(server, args, course_csv)),
+                server
+            )
+
+
+@click.command()
+@click.option("--latency", type=float, default=0.01, show_default=True,
+              help="Seconds the fake server waits before each response")
+@click.option("--courses", type=int, default=4, show_default=True,
+              help="Number of courses exported by export-bulk")
+@click.option("--users", type=int, default=40, show_default=True,
+              help="Students per course")
+@click.option("--quizzes", type=int, default=5, show_default=True,
+              help="Quizzes per course")
+@click.option("--attempts", type=int, default=2, show_default=True,
+              help="Attempts per student and quiz")
+@click.option("--max-workers", type=int, default=8, show_default=True)
+@click.option("--parallel", type=int, default=4, show_default=True)
+@click.option("--batch-size", type=int, default=50, show_default=True)
+@click.option("--enrol-users", type=int, default=100, show_default=True,
+              help="Users in the enrol-bulk CSV")
+@click.option("--setup-courses", type=int, default=8, show_default=True,
+              help="Courses in the course-bulk-setup CSV")
+@click.option("--only", multiple=True,
+              type=click.Choice(["grades", "export", "enrol", "setup"]),
+              help="Only run some of the benchmarks")
+def main(latency, courses, users, quizzes, attempts, max_workers, parallel,
+         batch_size, enrol_users, setup_courses, only):
+    site_args = {
+        "courses": courses,
+        "users_per_course": users,
+        "quizzes_per_course": quizzes,
+        "attempts_per_quiz": attempts
+    }
+    only = set(only or ["grades", "export", "enrol", "setup"])
+    results = Results()
+
+    if "grades" in only:
+        bench_update_grades_data(
+            results,
+            {**site_args, "courses": 1},
+            latency,
+            sorted({1, max_workers})
+        )
+    if "export" in only:
+        bench_export_bulk(results, site_args, latency, max_workers, parallel)
+    if "enrol" in only:
+        bench_enrol_bulk(results, site_args, latency, enrol_users, batch_size)
+    if "setup" in only:
+        bench_course_bulk_setup(
+            results,
+            site_args,
+            latency,
+            setup_courses,
+            parallel
+        )
+
+    click.echo(results.table.get_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+"""A local fake of the Moodle web service API used by the benchmarks. It
+implements the web service functions called by moodlecli.moodle against a
+synthetic site and can add a fixed latency to every call, so the effect of
+request counts and concurrency on throughput can be measured.
+
+    with FakeMoodleServer(FakeMoodleSite(courses=5), latency=0.02) as server:
+        client = MoodleClient(create_session(), server.url, "token")
+"""
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from moodlecli import moodle
+
+BASE_TIMESTAMP = 1700000000
+
+
+def unflatten_moodle_params(params):
+    """Inverse of moodle.convert_moodle_params for parsed query / form
+    data (a dict mapping keys to single values)"""
+    data = {}
+    for key, value in params.items():
+        parts = re.findall(r"[^\[\]]+", key)
+        node = data
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return _listify(data)
+
+
+def _listify(data):
+    if not isinstance(data, dict):
+        return data
+    if data and all(key.isdigit() for key in data):
+        return [
+            _listify(data[key]) for key in sorted(data, key=int)
+        ]
+    return {key: _listify(value) for key, value in data.items()}
+
+
+class FakeMoodleSite:
+    """Synthetic Moodle site state. Every existing course has
+    users_per_course students, each of whom has submitted every one of the
+    course's quizzes_per_course quizzes attempts_per_quiz times."""
+
+    def __init__(
+        self, courses=1, users_per_course=50, quizzes_per_course=10,
+        attempts_per_quiz=2, questions_per_attempt=5
+    ):
+        self.users_per_course = users_per_course
+        self.quizzes_per_course = quizzes_per_course
+        self.attempts_per_quiz = attempts_per_quiz
+        self.questions_per_attempt = questions_per_attempt
+        self._lock = threading.Lock()
+        self.courses = {}
+        self.users = {}
+        self.enrolments = set()
+        self.roles = {
+            shortname: {"id": idx, "shortname": shortname}
+            for idx, shortname in enumerate(
+                ["manager", "editingteacher", "teacher", "student"],
+                start=1
+            )
+        }
+        for _ in range(courses):
+            course_id = self._add_course(None)
+            for _ in range(users_per_course):
+                user_id = self._add_user(None)
+                self.enrolments.add((course_id, user_id))
+
+    def _add_course(self, shortname):
+        course_id = len(self.courses) + 1
+        self.courses[course_id] = {
+            "id": course_id,
+            "shortname": shortname or f"course{course_id}",
+            "fullname": f"Course {course_id}"
+        }
+        return course_id
+
+    def _add_user(self, email):
+        user_id = len(self.users) + 1
+        email = email or f"user{user_id}@example.com"
+        self.users[user_id] = {
+            "id": user_id,
+            "username": email,
+            "email": email,
+            "firstname": "First",
+            "lastname": f"Last{user_id}"
+        }
+        return user_id
+
+    def _quiz_ids(self, course_id):
+        first = (course_id - 1) * self.quizzes_per_course + 1
+        return range(first, first + self.quizzes_per_course)
+
+    def _attempt_ids(self, user_id, quiz_id):
+        first = ((user_id * 100000) + quiz_id) * self.attempts_per_quiz
+        return range(first, first + self.attempts_per_quiz)
+
+    def _course_user_ids(self, course_id):
+        return sorted(
+            user_id for enrolled_course_id, user_id in self.enrolments
+            if enrolled_course_id == course_id
+        )
+
+    # Web service functions, keyed by name in FUNCTIONS below
+
+    def duplicate_course(self, data):
+        with self._lock:
+            course_id = self._add_course(data["shortname"])
+            return {"id": course_id, "shortname": data["shortname"]}
+
+    def import_course(self, data):
+        return None
+
+    def get_courses(self, data):
+        with self._lock:
+            return list(self.courses.values())
+
+    def get_courses_by_field(self, data):
+        with self._lock:
+            return {"courses": [
+                course for course in self.courses.values()
+                if course["shortname"] == data["value"]
+            ]}
+
+    def get_enrolled_users(self, data):
+        course_id = int(data["courseid"])
+        with self._lock:
+            return [
+                self.users[user_id]
+                for user_id in self._course_user_ids(course_id)
+            ]
+
+    def create_users(self, data):
+        with self._lock:
+            return [
+                {
+                    "id": self._add_user(user["email"]),
+                    "username": user["username"]
+                }
+                for user in data["users"]
+            ]
+
+    def _users_by_email(self, emails):
+        emails = {email.lower() for email in emails}
+        with self._lock:
+            return [
+                user for user in self.users.values() if user["email"] in emails
+            ]
+
+    def get_users(self, data):
+        emails = [
+            criteria["value"] for criteria in data["criteria"]
+            if criteria["key"] == "email"
+        ]
+        return {"users": self._users_by_email(emails), "warnings": []}
+
+    def get_users_by_field(self, data):
+        return self._users_by_email(data["values"])
+
+    def enrol_users(self, data):
+        with self._lock:
+            for enrolment in data["enrolments"]:
+                self.enrolments.add(
+                    (int(enrolment["courseid"]), int(enrolment["userid"]))
+                )
+        return None
+
+    def unenrol_users(self, data):
+        with self._lock:
+            for enrolment in data["enrolments"]:
+                self.enrolments.discard(
+                    (int(enrolment["courseid"]), int(enrolment["userid"]))
+                )
+        return None
+
+    def get_grade_items(self, data):
+        course_id = int(data["courseid"])
+        with self._lock:
+            user_ids = self._course_user_ids(course_id)
+        return {"usergrades": [
+            {
+                "courseid": course_id,
+                "userid": user_id,
+                "gradeitems": [
+                    {
+                        "iteminstance": quiz_id,
+                        "itemmodule": "quiz",
+                        "gradedatesubmitted": BASE_TIMESTAMP + quiz_id,
+                        "graderaw": 1.0
+                    }
+                    for quiz_id in self._quiz_ids(course_id)
+                ]
+            }
+            for user_id in user_ids
+        ], "warnings": []}
+
+    def get_quizzes_by_courses(self, data):
+        return {"quizzes": [
+            {
+                "id": quiz_id,
+                "course": int(course_id),
+                "name": f"Quiz {quiz_id}",
+                "sumgrades": 10
+            }
+            for course_id in data.get("courseids", [])
+            for quiz_id in self._quiz_ids(int(course_id))
+        ], "warnings": []}
+
+    def get_user_attempts(self, data):
+        user_id = int(data["userid"])
+        quiz_id = int(data["quizid"])
+        return {"attempts": [
+            {
+                "id": attempt_id,
+                "quiz": quiz_id,
+                "userid": user_id,
+                "attempt": idx + 1,
+                "state": "finished",
+                "gradednotificationsenttime": BASE_TIMESTAMP + quiz_id
+            }
+            for idx, attempt_id in enumerate(
+                self._attempt_ids(user_id, quiz_id)
+            )
+        ], "warnings": []}
+
+    def get_quiz_attempt(self, data):
+        return {
+            "attempt": {"id": int(data["attemptid"]), "state": "finished"},
+            "questions": [
+                {"slot": slot, "mark": "1.00", "responsesummary": "x" * 20}
+                for slot in range(1, self.questions_per_attempt + 1)
+            ]
+        }
+
+    def get_role_by_shortname(self, data):
+        return self.roles[data["shortname"]]
+
+    def get_self_enrolment_methods(self, data):
+        return [{
+            "id": int(data["courseid"]) * 10,
+            "courseid": int(data["courseid"]),
+            "roleid": int(data["roleid"])
+        }]
+
+    def enable_self_enrolment_method(self, data):
+        return {"id": int(data["enrolid"]), "enabled": True}
+
+    def set_self_enrolment_method_key(self, data):
+        return {"id": int(data["enrolid"])}
+
+    def get_user_uuids(self, data):
+        user_ids = [int(item["id"]) for item in data.get("user_ids", [])]
+        with self._lock:
+            user_ids = user_ids or list(self.users)
+        return [
+            {"user_id": user_id, "user_uuid": f"uuid-{user_id:012d}"}
+            for user_id in user_ids
+        ]
+
+    def get_policy_acceptances(self, data):
+        with self._lock:
+            return [
+                {"user_id": user_id, "status": 1} for user_id in self.users
+            ]
+
+
+FUNCTIONS = {
+    moodle.MOODLE_FUNC_DUPLICATE_COURSE: FakeMoodleSite.duplicate_course,
+    moodle.MOODLE_FUNC_GET_COURSES: FakeMoodleSite.get_courses,
+    moodle.MOODLE_FUNC_GET_COURSES_BY_FIELD:
+        FakeMoodleSite.get_courses_by_field,
+    moodle.MOODLE_FUNC_IMPORT_COURSE: FakeMoodleSite.import_course,
+    moodle.MOODLE_FUNC_CORE_ENROL_GET_ENROLLED_USERS:
+        FakeMoodleSite.get_enrolled_users,
+    moodle.MOODLE_FUNC_CREATE_USERS: FakeMoodleSite.create_users,
+    moodle.MOODLE_FUNC_GET_USERS: FakeMoodleSite.get_users,
+    moodle.MOODLE_FUNC_GET_USERS_BY_FIELD: FakeMoodleSite.get_users_by_field,
+    moodle.MOODLE_FUNC_ENROL_USER: FakeMoodleSite.enrol_users,
+    moodle.MOODLE_FUNC_UNENROL_USER: FakeMoodleSite.unenrol_users,
+    moodle.MOODLE_FUNC_GRADEREPORT_USER_GET_GRADE_ITEMS:
+        FakeMoodleSite.get_grade_items,
+    moodle.MOODLE_FUNC_ENABLE_SELF_ENROLMENT_METHOD:
+        FakeMoodleSite.enable_self_enrolment_method,
+    moodle.MOODLE_FUNC_GET_ROLE_BY_SHORTNAME:
+        FakeMoodleSite.get_role_by_shortname,
+    moodle.MOODLE_FUNC_GET_SELF_ENROLMENT_METHODS:
+        FakeMoodleSite.get_self_enrolment_methods,
+    moodle.MOODLE_FUNC_GET_USER_UUIDS: FakeMoodleSite.get_user_uuids,
+    moodle.MOODLE_FUNC_GET_QUIZ_ATTEMPT: FakeMoodleSite.get_quiz_attempt,
+    moodle.MOODLE_FUNC_SET_SELF_ENROLMENT_METHOD_KEY:
+        FakeMoodleSite.set_self_enrolment_method_key,
+    moodle.MOODLE_FUNC_GET_QUIZZES_BY_COURSES:
+        FakeMoodleSite.get_quizzes_by_courses,
+    moodle.MOODLE_FUNC_GET_USER_QUIZ_ATTEMPTS:
+        FakeMoodleSite.get_user_attempts,
+    moodle.MOODLE_FUNC_GET_POLICY_ACCEPTANCE_DATA:
+        FakeMoodleSite.get_policy_acceptances,
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send headers and body in a single write so responses are not held
+    # back by Nagle's algorithm / delayed ACKs on keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle(parse_qs(urlsplit(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self._handle(parse_qs(self.rfile.read(length).decode("utf-8")))
+
+    def _handle(self, query):
+        server = self.server.fake_moodle
+        params = {key: values[0] for key, values in query.items()}
+        wsfunction = params.pop("wsfunction", None)
+        params.pop("wstoken", None)
+        params.pop("moodlewsrestformat", None)
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if wsfunction in FUNCTIONS:
+            server.count(wsfunction)
+            result = FUNCTIONS[wsfunction](
+                server.site,
+                unflatten_moodle_params(params)
+            )
+        else:
+            result = {
+                "exception": "dml_missing_record_exception",
+                "message": f"Unknown web service function {wsfunction}"
+            }
+
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeMoodleServer:
+    """Serve site on a local port from a background thread, sleeping for
+    latency seconds before answering each request. Use as a context
+    manager."""
+
+    def __init__(self, site, latency=0.0):
+        self.site = site
+        self.latency = latency
+        self.calls = Counter()
+        self._calls_lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake_moodle = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}"
+
+    def count(self, wsfunction):
+        with self._calls_lock:
+            self.calls[wsfunction] += 1
+
+    def reset_calls(self):
+        with self._calls_lock:
+            self.calls.clear()
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever,
+            daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
@@ -1,23 +1,331 @@
-import boto3
+import gzip
+import hashlib
+import io
 import json
+import threading
+from contextlib import nullcontext
 
+FORMAT_JSON = "json"
+FORMAT_NDJSON = "ndjson"
+FORMATS = (FORMAT_JSON, FORMAT_NDJSON)
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
 
-def put_json_data(data, bucket_name, key):
-    s3_client = boto3.client("s3")
-    binary_data = json.dumps(data).encode('utf-8')
-    s3_client.put_object(Body=binary_data, Bucket=bucket_name, Key=key)
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSIONS = (COMPRESSION_GZIP, COMPRESSION_ZSTD)
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
 
+# Payloads at least this large are uploaded with managed multipart transfers
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+S3_MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+S3_MAX_CONCURRENCY = 4
 
-def get_json_data(bucket_name, key, default=None):
-    """This function will attempt to read / parse S3 for JSON data. If it does
-    not exist and a default value is provided, it will be returned.
-    """
-    s3_client = boto3.client("s3")
+# User metadata key holding the SHA-256 digest of an object's contents
+DIGEST_METADATA_KEY = "sha256"
+
+# Size of the blocks objects are downloaded and read in
+S3_DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+
+def _zstandard():
     try:
-        data = s3_client.get_object(Bucket=bucket_name, Key=key)
-        contents = data["Body"].read()
-        return json.loads(contents)
-    except s3_client.exceptions.NoSuchKey as e:
-        if default is not None:
-            return default
-        raise e
+        import zstandard
+    except ImportError:  # pragma: no cover
+        raise Exception(
+            "zstd compression requires the zstandard package (pip install "
+            "moodle-cli[zstd])"
+        )
+    return zstandard
+
+
+def compressed_writer(fileobj, compression=None):
+    """Return a context manager for a binary file object which compresses
+    what is written to it into fileobj. Output is flushed when the context
+    exits but fileobj is not closed."""
+    if compression == COMPRESSION_GZIP:
+        # A fixed mtime keeps output deterministic for content digests
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", mtime=0)
+    if compression == COMPRESSION_ZSTD:
+        return _zstandard().ZstdCompressor().stream_writer(
+            fileobj,
+            closefd=False
+        )
+    return nullcontext(fileobj)
+
+
+def decompressed_reader(fileobj):
+    """Return a binary file object which reads fileobj (positioned at the
+    start of data written by serialize_json_data or put_json_file) with
+    any compression removed"""
+    magic = fileobj.read(len(ZSTD_MAGIC))
+    fileobj.seek(-len(magic), io.SEEK_CUR)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    if magic.startswith(ZSTD_MAGIC):
+        return _zstandard().ZstdDecompressor().stream_reader(
+            fileobj,
+            closefd=False
+        )
+    return fileobj
+
+
+def _put_object_args(output_format=FORMAT_JSON, compression=None):
+    """Metadata set on objects so readers can detect how they are encoded"""
+    args = {}
+    if output_format == FORMAT_NDJSON:
+        args["ContentType"] = NDJSON_CONTENT_TYPE
+    if compression:
+        args["ContentEncoding"] = compression
+    return args
+
+
+def serialize_json_data(data, output_format=FORMAT_JSON, compression=None):
+    """Serialize data to bytes as a single JSON document or, for lists, as
+    line delimited JSON (ndjson) with optional gzip / zstd compression"""
+    if output_format == FORMAT_NDJSON:
+        if not isinstance(data, list):
+            raise ValueError("ndjson output is only supported for lists")
+        text = "".join(f"{json.dumps(item)}\n" for item in data)
+    else:
+        text = json.dumps(data)
+    binary_data = text.encode('utf-8')
+
+    if compression == COMPRESSION_GZIP:
+        return gzip.compress(binary_data, mtime=0)
+    if compression == COMPRESSION_ZSTD:
+        return _zstandard().ZstdCompressor().compress(binary_data)
+    return binary_data
+
+
+def deserialize_json_data(contents, content_encoding=None, content_type=None):
+    """Parse data written by serialize_json_data. Compression is detected
+    from content_encoding or the data itself, and ndjson from
+    content_type."""
+    if content_encoding == COMPRESSION_GZIP or \
+            contents.startswith(GZIP_MAGIC):
+        contents = gzip.decompress(contents)
+    elif content_encoding == COMPRESSION_ZSTD or \
+            contents.startswith(ZSTD_MAGIC):
+        contents = _zstandard().ZstdDecompressor().decompressobj().decompress(
+            contents
+        )
+
+    if content_type == NDJSON_CONTENT_TYPE:
+        return [json.loads(line) for line in contents.splitlines() if line]
+    return json.loads(contents)
+
+
+def content_digests(fileobj):
+    """Return the SHA-256 and MD5 hex digests of a binary file object from
+    its current position, which is restored afterwards"""
+    position = fileobj.tell()
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    for block in iter(lambda: fileobj.read(1024 * 1024), b""):
+        sha256.update(block)
+        md5.update(block)
+    fileobj.seek(position)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+class S3Storage:
+    """Reads and writes JSON data in S3 using a single client which is
+    created on first use and then reused, so credentials and endpoints are
+    only resolved once. Instances can be shared across threads.
+
+    boto3 is only imported once the client or transfer config is first
+    needed, so commands which never use S3 don't pay for importing it.
+    """
+
+    def __init__(self, transfer_config=None):
+        # Creating clients from the default boto3 session is not thread safe
+        self._client_lock = threading.Lock()
+        self._client = None
+        self._transfer_config = transfer_config
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                import boto3
+
+                self._client = boto3.client("s3")
+            return self._client
+
+    @property
+    def transfer_config(self):
+        with self._client_lock:
+            if self._transfer_config is None:
+                from boto3.s3.transfer import TransferConfig
+
+                self._transfer_config = TransferConfig(
+                    multipart_threshold=S3_MULTIPART_THRESHOLD,
+                    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                    max_concurrency=S3_MAX_CONCURRENCY
+                )
+            return self._transfer_config
+
+    def put_json_data(self, data, bucket_name, key,
+                      output_format=FORMAT_JSON, compression=None,
+                      skip_unchanged=False):
+        """Write data to S3 and return True. If skip_unchanged is set and
+        the object already has the same contents, nothing is written and
+        False is returned."""
+        binary_data = serialize_json_data(data, output_format, compression)
+        extra_args = _put_object_args(output_format, compression)
+        if skip_unchanged:
+            sha256, md5 = content_digests(io.BytesIO(binary_data))
+            if self.object_is_unchanged(bucket_name, key, sha256, md5):
+                return False
+            extra_args["Metadata"] = {DIGEST_METADATA_KEY: sha256}
+
+        if len(binary_data) < self.transfer_config.multipart_threshold:
+            self.client.put_object(
+                Body=binary_data,
+                Bucket=bucket_name,
+                Key=key,
+                **extra_args
+            )
+        else:
+            self.upload_fileobj(
+                io.BytesIO(binary_data),
+                bucket_name,
+                key,
+                extra_args
+            )
+        return True
+
+    def put_json_file(self, fileobj, bucket_name, key, compression=None,
+                      skip_unchanged=False):
+        """Upload JSON data which has already been serialized (and
+        compressed with compression if set) to a seekable binary file
+        object, starting from the current position. Returns False if the
+        upload was skipped because of skip_unchanged."""
+        extra_args = _put_object_args(compression=compression)
+        if skip_unchanged:
+            sha256, md5 = content_digests(fileobj)
+            if self.object_is_unchanged(bucket_name, key, sha256, md5):
+                return False
+            extra_args["Metadata"] = {DIGEST_METADATA_KEY: sha256}
+
+        self.upload_fileobj(fileobj, bucket_name, key, extra_args)
+        return True
+
+    def object_is_unchanged(self, bucket_name, key, sha256, md5):
+        """Check with a HEAD request whether the object at key has contents
+        with the given digests. Objects written with skip_unchanged store
+        their SHA-256 digest in metadata. For other objects uploaded in a
+        single part, the ETag is the MD5 digest of the contents."""
+        try:
+            head = self.client.head_object(Bucket=bucket_name, Key=key)
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise e
+        if head.get("Metadata", {}).get(DIGEST_METADATA_KEY) == sha256:
+            return True
+        return head.get("ETag", "").strip('"') == md5
+
+    def upload_fileobj(self, fileobj, bucket_name, key, extra_args=None):
+        """Upload fileobj, using a multipart upload when it is larger than
+        the multipart threshold of the transfer config"""
+        self.client.upload_fileobj(
+            fileobj,
+            bucket_name,
+            key,
+            ExtraArgs=extra_args or None,
+            Config=self.transfer_config
+        )
+
+    def get_json_data(self, bucket_name, key, default=None):
+        """This function will attempt to read / parse S3 for JSON data. If it
+        does not exist and a default value is provided, it will be returned.
+        Data written with any of the supported formats and compressions is
+        detected automatically.
+        """
+        s3_client = self.client
+        try:
+            data = s3_client.get_object(Bucket=bucket_name, Key=key)
+            contents = data["Body"].read()
+            return deserialize_json_data(
+                contents,
+                data.get("ContentEncoding"),
+                data.get("ContentType")
+            )
+        except s3_client.exceptions.NoSuchKey as e:
+            if default is not None:
+                return default
+            raise e
+
+    def download_file(self, bucket_name, key, fileobj):
+        """Write the contents of an object to fileobj (opened in binary
+        mode) block by block, without holding it in memory. Returns False
+        if the object does not exist."""
+        s3_client = self.client
+        try:
+            data = s3_client.get_object(Bucket=bucket_name, Key=key)
+        except s3_client.exceptions.NoSuchKey:
+            return False
+        for block in iter(
+            lambda: data["Body"].read(S3_DOWNLOAD_BLOCK_SIZE),
+            b""
+        ):
+            fileobj.write(block)
+        return True
+
+    def delete_objects(self, bucket_name, keys):
+        # DeleteObjects accepts at most 1000 keys per request
+        for idx in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=bucket_name,
+                Delete={
+                    "Objects": [
+                        {"Key": key} for key in keys[idx:idx + 1000]
+                    ],
+                    "Quiet": True
+                }
+            )
+
+
+_default_storage = S3Storage()
+
+
+def get_storage():
+    """Return the S3Storage shared by the module level functions"""
+    return _default_storage
+
+
+def put_json_data(data, bucket_name, key, output_format=FORMAT_JSON,
+                  compression=None, skip_unchanged=False):
+    return get_storage().put_json_data(
+        data,
+        bucket_name,
+        key,
+        output_format,
+        compression,
+        skip_unchanged
+    )
+
+
+def put_json_file(fileobj, bucket_name, key, compression=None,
+                  skip_unchanged=False):
+    return get_storage().put_json_file(
+        fileobj,
+        bucket_name,
+        key,
+        compression,
+        skip_unchanged
+    )
+
+
+def get_json_data(bucket_name, key, default=None):
+    return get_storage().get_json_data(bucket_name, key, default)
+
+
+def download_file(bucket_name, key, fileobj):
+    return get_storage().download_file(bucket_name, key, fileobj)
+
+
+def delete_objects(bucket_name, keys):
+    get_storage().delete_objects(bucket_name, keys)
@@ -0,0 +1,323 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_ATTEMPT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Attempt states reported by mod_quiz_get_user_attempts for which the
+# details returned by local_raisecli_get_quiz_attempt will no longer change
+FINALIZED_ATTEMPT_STATES = ("finished", "abandoned")
+
+
+def attempt_is_finalized(summary):
+    return summary.get("state") in FINALIZED_ATTEMPT_STATES
+
+
+class _SQLiteCache:
+    """Base class of caches stored in a SQLite file. The connection is
+    guarded by a lock so instances can be shared across threads. Subclasses
+    list the statements creating their tables in SCHEMA.
+    """
+
+    SCHEMA = ()
+    # Stay below SQLite's limit on the number of query parameters
+    QUERY_CHUNK_SIZE = 500
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+
+    def _select_in(self, query, keys):
+        """Return the rows of query for keys, which are substituted for the
+        {} in its "IN ({})" clause in chunks. Must hold the lock."""
+        rows = []
+        for idx in range(0, len(keys), self.QUERY_CHUNK_SIZE):
+            chunk = keys[idx:idx + self.QUERY_CHUNK_SIZE]
+            rows += self._conn.execute(
+                query.format(", ".join("?" * len(chunk))),
+                chunk
+            ).fetchall()
+        return rows
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class AttemptCache(_SQLiteCache):
+    """On disk cache of quiz attempt details keyed by attempt ID. When the
+    total size of the cached details exceeds max_bytes, the least recently
+    used entries are evicted.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS attempt_details ("
+        "attempt_id TEXT PRIMARY KEY, "
+        "data TEXT NOT NULL, "
+        "size INTEGER NOT NULL, "
+        "accessed REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS attempt_details_accessed "
+        "ON attempt_details (accessed)",
+    )
+
+    def __init__(self, path, max_bytes=DEFAULT_ATTEMPT_CACHE_MAX_BYTES):
+        super().__init__(path)
+        self.max_bytes = max_bytes
+        self._accessed = {}
+        with self._lock:
+            self._total_bytes = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM attempt_details"
+            ).fetchone()[0]
+
+    def get(self, attempt_id):
+        """Return cached details for attempt_id or None if not cached"""
+        return self.get_many([attempt_id]).get(str(attempt_id))
+
+    def get_many(self, attempt_ids):
+        """Return a dict mapping attempt ID to details for cached
+        attempt_ids. Access times are recorded in memory and only written
+        with the next put or close, so lookups don't write to the database.
+        """
+        with self._lock:
+            rows = self._select_in(
+                "SELECT attempt_id, data FROM attempt_details "
+                "WHERE attempt_id IN ({})",
+                [str(attempt_id) for attempt_id in attempt_ids]
+            )
+            accessed = time.time()
+            for attempt_id, _ in rows:
+                self._accessed[attempt_id] = accessed
+        return {attempt_id: json.loads(data) for attempt_id, data in rows}
+
+    def put(self, attempt_id, details):
+        self.put_many({attempt_id: details})
+
+    def put_many(self, details):
+        """Add a dict mapping attempt ID to details to the cache"""
+        if not details:
+            return
+        entries = [
+            (str(attempt_id), json.dumps(attempt_details))
+            for attempt_id, attempt_details in details.items()
+        ]
+        with self._lock, self._conn:
+            self._write_accessed()
+            for attempt_id, data in entries:
+                row = self._conn.execute(
+                    "SELECT size FROM attempt_details WHERE attempt_id = ?",
+                    (attempt_id,)
+                ).fetchone()
+                if row is not None:
+                    self._total_bytes -= row[0]
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO attempt_details "
+                    "(attempt_id, data, size, accessed) VALUES (?, ?, ?, ?)",
+                    (attempt_id, data, len(data), time.time())
+                )
+                self._total_bytes += len(data)
+            self._evict()
+
+    def _write_accessed(self):
+        self._conn.executemany(
+            "UPDATE attempt_details SET accessed = ? WHERE attempt_id = ?",
+            [
+                (accessed, attempt_id)
+                for attempt_id, accessed in self._accessed.items()
+            ]
+        )
+        self._accessed = {}
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT attempt_id, size FROM attempt_details "
+                "ORDER BY accessed LIMIT 100"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                return
+            for attempt_id, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self._conn.execute(
+                    "DELETE FROM attempt_details WHERE attempt_id = ?",
+                    (attempt_id,)
+                )
+                self._total_bytes -= size
+
+    def close(self):
+        with self._lock, self._conn:
+            self._write_accessed()
+        super().close()
+
+
+class UserUUIDCache(_SQLiteCache):
+    """On disk cache of user UUIDs keyed by user ID. UUIDs never change once
+    assigned, so entries do not expire.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS user_uuids ("
+        "user_id INTEGER PRIMARY KEY, "
+        "user_uuid TEXT NOT NULL)",
+    )
+
+    def get_many(self, user_ids):
+        """Return a dict mapping user ID to UUID for cached user_ids"""
+        with self._lock:
+            return dict(self._select_in(
+                "SELECT user_id, user_uuid FROM user_uuids "
+                "WHERE user_id IN ({})",
+                [int(user_id) for user_id in user_ids]
+            ))
+
+    def put_many(self, uuids):
+        """Add a dict mapping user ID to UUID to the cache"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO user_uuids (user_id, user_uuid) "
+                "VALUES (?, ?)",
+                [(int(user_id), uuid) for user_id, uuid in uuids.items()]
+            )
+
+
+DEFAULT_METADATA_TTL = 3600  # seconds
+
+
+class MetadataCache:
+    """Cache of Moodle metadata lookups (e.g. roles) whose entries expire
+    ttl seconds after they were added. If path is set, entries are loaded
+    from and saved to a JSON file there so they can be reused by later CLI
+    invocations. Instances can be shared across threads.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_METADATA_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self._entries = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+
+    @staticmethod
+    def _entry_key(namespace, key):
+        return f"{namespace}:{json.dumps(key)}"
+
+    def get(self, namespace, key):
+        """Return a copy of the cached value or None if it is not cached or
+        has expired"""
+        entry_key = self._entry_key(namespace, key)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.time():
+                del self._entries[entry_key]
+                return None
+            return json.loads(json.dumps(value))
+
+    def put(self, namespace, key, value):
+        with self._lock:
+            self._entries[self._entry_key(namespace, key)] = [
+                time.time() + self.ttl,
+                json.loads(json.dumps(value))
+            ]
+
+    def invalidate(self, namespace):
+        """Remove all entries in namespace"""
+        prefix = f"{namespace}:"
+        with self._lock:
+            for entry_key in list(self._entries):
+                if entry_key.startswith(prefix):
+                    del self._entries[entry_key]
+
+    def save(self):
+        """Write unexpired entries to path. The file is replaced atomically
+        so concurrent CLI invocations never read a partial file."""
+        if self.path is None:
+            return
+        now = time.time()
+        with self._lock:
+            contents = json.dumps({
+                entry_key: entry for entry_key, entry in self._entries.items()
+                if entry[0] > now
+            })
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(contents)
+        os.replace(tmp_path, self.path)
+
+
+DEFAULT_ROSTER_TTL = 900  # seconds
+
+
+class RosterCache(_SQLiteCache):
+    """On disk cache of course rosters (the users returned by
+    core_enrol_get_enrolled_users). Each snapshot is keyed by course ID and
+    the requested user fields, and records when it was fetched so it is
+    only reused for ttl seconds.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS course_rosters ("
+        "course_id TEXT NOT NULL, "
+        "user_fields TEXT NOT NULL, "
+        "fetched REAL NOT NULL, "
+        "data TEXT NOT NULL, "
+        "PRIMARY KEY (course_id, user_fields))",
+    )
+
+    def __init__(self, path, ttl=DEFAULT_ROSTER_TTL):
+        super().__init__(path)
+        self.ttl = ttl
+
+    @staticmethod
+    def _fields_key(user_fields):
+        return ",".join(sorted(user_fields or []))
+
+    def get(self, course_id, user_fields=None):
+        """Return the roster for course_id or None if it is not cached or
+        its snapshot is older than ttl"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM course_rosters "
+                "WHERE course_id = ? AND user_fields = ? AND fetched > ?",
+                (
+                    str(course_id),
+                    self._fields_key(user_fields),
+                    time.time() - self.ttl
+                )
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, course_id, user_fields, users):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO course_rosters "
+                "(course_id, user_fields, fetched, data) VALUES (?, ?, ?, ?)",
+                (
+                    str(course_id),
+                    self._fields_key(user_fields),
+                    now,
+                    json.dumps(users)
+                )
+            )
+            # Expired snapshots are never read again
+            self._conn.execute(
+                "DELETE FROM course_rosters WHERE fetched <= ?",
+                (now - self.ttl,)
+            )
@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+from time import monotonic
+from . import aws
+
+S3_LOCATION_PREFIX = "s3://"
+# Recorded items are written to S3 once this many are buffered or this many
+# seconds have passed since the last write, whichever comes first
+S3_JOURNAL_FLUSH_ITEMS = 100
+S3_JOURNAL_FLUSH_INTERVAL = 5  # seconds
+
+
+class FileJournal:
+    """Checkpoint journal stored in a local file as one JSON object per
+    line. The first line holds the scope and every following line a
+    completed item, so recording an item is a single append."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def load(self):
+        """Return (scope, completed items) or (None, []) if the journal
+        does not exist"""
+        lines = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        lines.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Partial line from an interrupted write
+                        break
+        except FileNotFoundError:
+            return None, []
+        if not lines:
+            return None, []
+        return lines[0]["scope"], [line["done"] for line in lines[1:]]
+
+    def start(self, scope, items):
+        self._file = open(self.path, "w")
+        self._write({"scope": scope})
+        for item in items:
+            self._write({"done": item})
+
+    def record(self, items, all_items):
+        for item in items:
+            self._write({"done": item})
+
+    def _write(self, entry):
+        self._file.write(f"{json.dumps(entry)}\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class S3Journal:
+    """Checkpoint journal stored as a single JSON object in S3. Since the
+    whole object is rewritten on every write, recorded items are buffered
+    and written once flush_items have been recorded or flush_interval
+    seconds have passed, and on close. Items recorded since the last write
+    are redone if the process is killed before it can close the journal.
+    """
+
+    def __init__(self, bucket_name, key, flush_items=S3_JOURNAL_FLUSH_ITEMS,
+                 flush_interval=S3_JOURNAL_FLUSH_INTERVAL):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.flush_items = flush_items
+        self.flush_interval = flush_interval
+        self._scope = None
+        self._done = []
+        self._unflushed = 0
+        self._flushed_at = monotonic()
+
+    def load(self):
+        data = aws.get_json_data(self.bucket_name, self.key, {})
+        return data.get("scope"), data.get("done", [])
+
+    def start(self, scope, items):
+        self._scope = scope
+        self._done = list(items)
+        self._flush()
+
+    def record(self, items, all_items):
+        self._done = list(all_items)
+        self._unflushed += len(items)
+        if self._unflushed >= self.flush_items or \
+                monotonic() - self._flushed_at >= self.flush_interval:
+            self._flush()
+
+    def _flush(self):
+        aws.put_json_data(
+            {"scope": self._scope, "done": self._done},
+            self.bucket_name,
+            self.key
+        )
+        self._unflushed = 0
+        self._flushed_at = monotonic()
+
+    def close(self):
+        if self._unflushed:
+            self._flush()
+
+
+class NullJournal:
+    """Journal which keeps nothing, for runs without a checkpoint"""
+
+    def load(self):
+        return None, []
+
+    def start(self, scope, items):
+        pass
+
+    def record(self, items, all_items):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_journal(location):
+    """Return a journal for a local path or an s3://bucket/key location, or
+    a NullJournal if location is None"""
+    if location is None:
+        return NullJournal()
+    if location.startswith(S3_LOCATION_PREFIX):
+        bucket_name, _, key = location[len(S3_LOCATION_PREFIX):].partition(
+            "/"
+        )
+        if not bucket_name or not key:
+            raise ValueError(
+                f"Checkpoint location {location} should be s3://bucket/key"
+            )
+        return S3Journal(bucket_name, key)
+    return FileJournal(location)
+
+
+class Checkpoint:
+    """Records which items (e.g. course IDs) of a bulk run have been
+    completed so that a rerun can skip them. scope identifies the run (e.g.
+    the command and its arguments) and a journal is only resumed from if it
+    was written for the same scope. Instances can be shared across threads.
+    """
+
+    def __init__(self, journal, scope, resume=False):
+        self.journal = journal
+        self._lock = threading.Lock()
+        self._completed = []
+        if resume:
+            journal_scope, completed = journal.load()
+            if journal_scope is not None and journal_scope != scope:
+                raise ValueError(
+                    f"Checkpoint was written for '{journal_scope}' and "
+                    f"cannot be used to resume '{scope}'"
+                )
+            self._completed = list(dict.fromkeys(completed))
+        self._completed_set = set(self._completed)
+        journal.start(scope, self._completed)
+
+    def pending(self, items, key=str):
+        """Return the items whose key has not been completed"""
+        with self._lock:
+            return [
+                item for item in items
+                if str(key(item)) not in self._completed_set
+            ]
+
+    def mark_done(self, *items):
+        with self._lock:
+            new_items = [
+                str(item) for item in dict.fromkeys(items)
+                if str(item) not in self._completed_set
+            ]
+            if not new_items:
+                return
+            self._completed += new_items
+            self._completed_set.update(new_items)
+            self.journal.record(new_items, self._completed)
+
+    def close(self):
+        with self._lock:
+            self.journal.close()
@@ -1,23 +1,64 @@
 import os
 import json
 import csv
+import tempfile
 import click
-import requests
-from .moodle import MoodleClient
+from .moodle import (
+    MoodleClient,
+    create_session,
+    MOODLE_GET_RETRIES,
+    MOODLE_POOL_SIZE,
+)
 from . import utils
 from . import aws
+from . import cache
+from . import checkpoint
+from .stats import RequestStats
 
 CONTEXT_MOODLE_CLIENT_KEY = "MOODLE_CLIENT"
+CONTEXT_MOODLE_CLIENT_FACTORY_KEY = "MOODLE_CLIENT_FACTORY"
 
 
 @click.pass_context
-def get_moodle_client(ctx):
+def get_moodle_client(ctx, concurrency=1):
+    # The client is created on first use so that commands which don't talk
+    # to Moodle (e.g. the CSV templates) don't import requests. Commands
+    # making concurrent requests pass their concurrency so the connection
+    # pool is sized for it.
+    if CONTEXT_MOODLE_CLIENT_KEY not in ctx.obj:
+        ctx.obj[CONTEXT_MOODLE_CLIENT_KEY] = \
+            ctx.obj[CONTEXT_MOODLE_CLIENT_FACTORY_KEY](concurrency)
     return ctx.obj[CONTEXT_MOODLE_CLIENT_KEY]
 
 
 @click.group()
+@click.option('--pool-size', type=click.IntRange(min=1),
+              default=MOODLE_POOL_SIZE, show_default=True,
+              help="Number of connections to Moodle kept alive. Raised to "
+                   "the number of concurrent requests of commands run with "
+                   "--max-workers or --parallel.")
+@click.option('--retries', type=click.IntRange(min=0),
+              default=MOODLE_GET_RETRIES, show_default=True,
+              help="Number of times failed read requests to Moodle are "
+                   "retried")
+@click.option('--stats', 'show_stats', is_flag=True,
+              help="Print a summary of Moodle requests on exit")
+@click.option('--stats-file', type=click.Path(dir_okay=False),
+              help="Write Moodle request stats to this file on exit")
+@click.option('--stats-format', type=click.Choice(['json', 'prometheus']),
+              default='json', show_default=True,
+              help="Format of the file written with --stats-file")
+@click.option('--metadata-cache', 'metadata_path',
+              type=click.Path(dir_okay=False),
+              help="JSON file used to cache role, course and self enrolment "
+                   "method lookups between invocations")
+@click.option('--metadata-ttl', type=click.IntRange(min=1),
+              default=cache.DEFAULT_METADATA_TTL, show_default=True,
+              help="Seconds role, course and self enrolment method "
+                   "lookups are cached for")
 @click.pass_context
-def cli(ctx):
+def cli(ctx, pool_size, retries, show_stats, stats_file, stats_format,
+        metadata_path, metadata_ttl):
     moodle_url = os.getenv("MOODLE_URL")
     moodle_token = os.getenv("MOODLE_TOKEN")
     if not moodle_url or not moodle_token:
@@ -27,14 +68,36 @@ def cli(ctx):
         )
         ctx.exit(1)
 
-    moodle = MoodleClient(
-        requests.Session(),
-        moodle_url,
-        moodle_token
-    )
+    request_stats = None
+    if show_stats or stats_file:
+        request_stats = RequestStats()
+
+        def report_stats():
+            if show_stats:
+                click.echo(request_stats.to_table(), err=True)
+            if stats_file:
+                request_stats.write(stats_file, stats_format)
+
+        ctx.call_on_close(report_stats)
+
+    # Lookups are always cached for the run, and only saved between
+    # invocations if a file was given
+    metadata_cache = cache.MetadataCache(metadata_path, metadata_ttl)
+    if metadata_path:
+        ctx.call_on_close(metadata_cache.save)
+
+    def create_moodle_client(concurrency=1):
+        return MoodleClient(
+            create_session(max(pool_size, concurrency)),
+            moodle_url,
+            moodle_token,
+            retries,
+            request_stats,
+            metadata_cache
+        )
 
     ctx.obj = {
-        CONTEXT_MOODLE_CLIENT_KEY: moodle
+        CONTEXT_MOODLE_CLIENT_FACTORY_KEY: create_moodle_client
     }
 
 
@@ -134,9 +197,17 @@ def course_bulk_csv(output_csv):
 @click.argument('base_course_id')
 @click.argument('coursedata_csv', type=click.File(mode='r'))
 @click.argument('courseoutput_csv', type=click.File(mode='w'))
-def course_bulk_setup(base_course_id, coursedata_csv, courseoutput_csv):
+@click.option('--parallel', type=click.IntRange(min=1), default=1,
+              help="Number of courses to set up concurrently")
+@click.option('--copy-deadline', type=click.IntRange(min=0),
+              default=utils.COURSE_COPY_POLL_DEADLINE, show_default=True,
+              help="Seconds to keep polling for a course copy which timed "
+                   "out before failing")
+def course_bulk_setup(
+    base_course_id, coursedata_csv, courseoutput_csv, parallel, copy_deadline
+):
     """Bulk setup of courses using an existing base course"""
-    moodle = get_moodle_client()
+    moodle = get_moodle_client(parallel)
 
     # Query required role data from instance
     # Note: The "teacher" shortname is the non-editing teacher role
@@ -147,14 +218,15 @@ def course_bulk_setup(base_course_id, coursedata_csv, courseoutput_csv):
 
     course_reader = csv.DictReader(coursedata_csv)
     try:
-        for course in course_reader:
-            updated_course = utils.setup_duplicate_course(
-                moodle,
-                base_course_id,
-                course,
-                teacher_role["id"],
-                student_role["id"]
-            )
+        for updated_course in utils.setup_duplicate_courses(
+            moodle,
+            base_course_id,
+            course_reader,
+            teacher_role["id"],
+            student_role["id"],
+            parallel,
+            utils.CourseCopyPoller(moodle, deadline=copy_deadline)
+        ):
             updated_courses.append(updated_course)
     finally:
         writer = csv.DictWriter(
@@ -165,6 +237,37 @@ def course_bulk_setup(base_course_id, coursedata_csv, courseoutput_csv):
         writer.writerows(updated_courses)
 
 
+def open_checkpoint(location, resume, scope):
+    """Return a checkpoint.Checkpoint for the run identified by scope. It
+    only records progress if a location was given."""
+    if resume and location is None:
+        raise click.UsageError("--resume requires --checkpoint")
+    try:
+        run_checkpoint = checkpoint.Checkpoint(
+            checkpoint.open_journal(location),
+            scope,
+            resume
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    click.get_current_context().call_on_close(run_checkpoint.close)
+    return run_checkpoint
+
+
+def checkpoint_options(func):
+    func = click.option(
+        '--resume', is_flag=True,
+        help="Skip work recorded as completed in --checkpoint by a previous "
+             "run"
+    )(func)
+    func = click.option(
+        '--checkpoint', 'checkpoint_location',
+        help="Local file or s3://bucket/key where completed work is "
+             "recorded so that a failed run can be resumed"
+    )(func)
+    return func
+
+
 @cli.command()
 @click.argument('output_csv', type=click.File(mode='w'))
 def enrol_bulk_csv(output_csv):
@@ -180,13 +283,52 @@ def enrol_bulk_csv(output_csv):
 @click.argument('course_id')
 @click.argument('role_shortname')
 @click.argument('userdata_csv', type=click.File(mode='r'))
-def enrol_bulk(course_id, role_shortname, userdata_csv):
+@click.option('--batch-size', type=click.IntRange(min=1),
+              help="Look up, create and enrol users in batches of this size "
+                   "instead of one user at a time")
+@checkpoint_options
+def enrol_bulk(
+    course_id, role_shortname, userdata_csv, batch_size, checkpoint_location,
+    resume
+):
     """Bulk enrol users to course with role"""
     moodle = get_moodle_client()
+    run_checkpoint = open_checkpoint(
+        checkpoint_location,
+        resume,
+        f"enrol-bulk {course_id} {role_shortname}"
+    )
 
     role = moodle.get_role_by_shortname(role_shortname)
 
-    user_reader = csv.DictReader(userdata_csv)
+    user_reader = run_checkpoint.pending(
+        csv.DictReader(userdata_csv),
+        lambda user: user[utils.CSV_USER_EMAIL].lower()
+    )
+    if batch_size:
+        user_ids = utils.create_or_get_users(
+            moodle,
+            [
+                {
+                    "firstname": user[utils.CSV_USER_FNAME],
+                    "lastname": user[utils.CSV_USER_LNAME],
+                    "email": user[utils.CSV_USER_EMAIL],
+                    "auth": user[utils.CSV_USER_AUTH]
+                }
+                for user in user_reader
+            ],
+            batch_size
+        )
+        for users_batch, user_ids_batch in zip(
+            utils.chunks(user_reader, batch_size),
+            utils.chunks(user_ids, batch_size)
+        ):
+            moodle.enrol_users(course_id, user_ids_batch, role["id"])
+            run_checkpoint.mark_done(*[
+                user[utils.CSV_USER_EMAIL].lower() for user in users_batch
+            ])
+        return
+
     for user in user_reader:
         user_id = utils.create_or_get_user(
             moodle,
@@ -196,6 +338,7 @@ def enrol_bulk(course_id, role_shortname, userdata_csv):
             user[utils.CSV_USER_AUTH]
         )
         moodle.enrol_user(course_id, user_id, role["id"])
+        run_checkpoint.mark_done(user[utils.CSV_USER_EMAIL].lower())
 
 
 @cli.command()
@@ -212,11 +355,24 @@ def unenrol_bulk_csv(output_csv):
 @cli.command()
 @click.argument('course_id')
 @click.argument('userdata_csv', type=click.File(mode='r'))
-def unenrol_bulk(course_id, userdata_csv):
+@click.option('--batch-size', type=click.IntRange(min=1),
+              help="Look up and unenrol users in batches of this size "
+                   "instead of one user at a time")
+def unenrol_bulk(course_id, userdata_csv, batch_size):
     """Bulk unenrol users from course"""
     moodle = get_moodle_client()
 
     user_reader = csv.DictReader(userdata_csv)
+    if batch_size:
+        user_ids = utils.get_user_ids_by_emails(
+            moodle,
+            [user[utils.CSV_USER_EMAIL] for user in user_reader],
+            batch_size
+        )
+        for user_ids_batch in utils.chunks(user_ids.values(), batch_size):
+            moodle.unenrol_users(course_id, user_ids_batch)
+        return
+
     for user in user_reader:
         existing_user = moodle.get_user_by_email(
           user['user_email']
@@ -240,51 +396,399 @@ def import_bulk_csv(output_csv):
 @cli.command()
 @click.argument('source_course_id')
 @click.argument('targetcourses_csv', type=click.File(mode='r'))
-def import_bulk(source_course_id, targetcourses_csv):
+@checkpoint_options
+def import_bulk(
+    source_course_id, targetcourses_csv, checkpoint_location, resume
+):
     """Bulk operation to import content into multiple courses"""
     moodle = get_moodle_client()
+    run_checkpoint = open_checkpoint(
+        checkpoint_location,
+        resume,
+        f"import-bulk {source_course_id}"
+    )
 
-    target_course_reader = csv.DictReader(targetcourses_csv)
+    target_course_reader = run_checkpoint.pending(
+        csv.DictReader(targetcourses_csv),
+        lambda target_course: target_course[utils.CSV_COURSE_ID]
+    )
     for target_course in target_course_reader:
         moodle.import_course(
             source_course_id,
             target_course[utils.CSV_COURSE_ID]
         )
+        run_checkpoint.mark_done(target_course[utils.CSV_COURSE_ID])
+
+
+def open_cache(cache_class, path, *args):
+    """Open a cache_class instance at path which is closed when the command
+    finishes, or return None if path isn't set"""
+    if path is None:
+        return None
+    opened_cache = cache_class(path, *args)
+    click.get_current_context().call_on_close(opened_cache.close)
+    return opened_cache
+
+
+def open_attempt_cache(path, max_mb):
+    return open_cache(cache.AttemptCache, path, max_mb * 1024 * 1024)
+
+
+def attempt_cache_options(func):
+    func = click.option(
+        '--attempt-cache-size', type=click.IntRange(min=1),
+        default=cache.DEFAULT_ATTEMPT_CACHE_MAX_BYTES // (1024 * 1024),
+        show_default=True,
+        help="Maximum size in MB of the attempt details cache"
+    )(func)
+    func = click.option(
+        '--attempt-cache', type=click.Path(dir_okay=False),
+        help="SQLite file used to cache details of finalized quiz attempts"
+    )(func)
+    return func
+
+
+def uuid_options(func):
+    func = click.option(
+        '--uuid-cache', type=click.Path(dir_okay=False),
+        help="SQLite file used to cache user UUIDs (implies only looking up "
+             "UUIDs of exported users)"
+    )(func)
+    func = click.option(
+        '--uuid-chunk-size', type=click.IntRange(min=1),
+        help="Only look up UUIDs of exported users, with this many user IDs "
+             "per request, instead of downloading UUIDs for all users"
+    )(func)
+    return func
+
+
+def course_user_uuids(moodle, user_data, uuid_chunk_size, uuid_cache):
+    """Look up UUIDs for only the users in user_data"""
+    return utils.get_scoped_user_uuids(
+        moodle,
+        [user["id"] for user in user_data],
+        uuid_chunk_size or utils.USER_UUID_CHUNK_SIZE,
+        uuid_cache
+    )
+
+
+def parse_user_fields(ctx, param, value):
+    if value is None:
+        return None
+    return [field.strip() for field in value.split(',') if field.strip()]
+
+
+def roster_options(func):
+    func = click.option(
+        '--roster-ttl', type=click.IntRange(min=1),
+        default=cache.DEFAULT_ROSTER_TTL, show_default=True,
+        help="Seconds course rosters in --roster-cache are reused for"
+    )(func)
+    func = click.option(
+        '--roster-cache', type=click.Path(dir_okay=False),
+        help="SQLite file used to cache course rosters so repeated exports "
+             "reuse them"
+    )(func)
+    func = click.option(
+        '--user-fields', callback=parse_user_fields,
+        help="Comma separated user fields to export (e.g. "
+             "id,username,email) instead of full user profiles"
+    )(func)
+    return func
+
+
+def compression_option(func):
+    return click.option(
+        '--compression', type=click.Choice(['none', *aws.COMPRESSIONS]),
+        default='none', show_default=True,
+        callback=lambda ctx, param, value: None if value == 'none' else value,
+        help="Compression applied to data written to S3"
+    )(func)
+
+
+def format_option(func):
+    return click.option(
+        '--format', 'output_format', type=click.Choice(aws.FORMATS),
+        default=aws.FORMAT_JSON, show_default=True,
+        help="Layout of data written to S3 (ndjson writes one JSON "
+             "document per line and is only supported for list data)"
+    )(func)
+
+
+def skip_unchanged_option(func):
+    return click.option(
+        '--skip-unchanged', is_flag=True,
+        help="Skip uploads when the object in S3 already has identical "
+             "contents (checked with a HEAD request)"
+    )(func)
+
+
+def incremental_option(func):
+    return click.option(
+        '--incremental', is_flag=True,
+        help="Only write grade changes since the previous incremental "
+             "export as a delta object listed in KEY.manifest.json (see "
+             "compact-grades)"
+    )(func)
+
+
+def fingerprints_option(func):
+    return click.option(
+        '--fingerprints', is_flag=True,
+        help="Store a fingerprint of each user's grades in the export and "
+             "copy the attempts of users whose fingerprint is unchanged "
+             "from the previous export without checking them"
+    )(func)
+
+
+def grades_manifest_key(key):
+    return f"{key}.manifest.json"
+
+
+def export_course_grades_delta(moodle, course_id, bucket_name, key,
+                               max_workers, compression=None, quizzes=None):
+    """Write grade changes since the last incremental export as a delta
+    object and record it in the manifest stored next to key"""
+    manifest_key = grades_manifest_key(key)
+    manifest = aws.get_json_data(bucket_name, manifest_key, {})
+    if "fingerprints" in manifest:
+        state = manifest
+    else:
+        # Start from the latest full export if there is one
+        state = utils.grades_delta_state(
+            aws.get_json_data(bucket_name, key, {})
+        )
+
+    delta, new_state = utils.build_grades_delta(
+        moodle,
+        course_id,
+        state,
+        max_workers,
+        quizzes
+    )
+    deltas = manifest.get("deltas", [])
+    if delta["usergrades"] or delta["attempts"] or delta["removed"]:
+        delta_key = f"{key}.deltas/{new_state['watermark']}.json"
+        if delta_key in deltas:
+            # Regrades and overrides don't always move the watermark
+            delta_key = \
+                f"{key}.deltas/{new_state['watermark']}-{len(deltas)}.json"
+        aws.put_json_data(
+            delta,
+            bucket_name,
+            delta_key,
+            compression=compression
+        )
+        deltas.append(delta_key)
+    elif "fingerprints" in manifest:
+        return
+
+    aws.put_json_data(
+        {**new_state, "deltas": deltas},
+        bucket_name,
+        manifest_key
+    )
+
+
+def check_incremental_options(incremental, **options):
+    """Reject options which don't apply to incremental grade exports"""
+    if not incremental:
+        return
+    for name, value in options.items():
+        if value:
+            option = name.replace('_', '-')
+            raise click.UsageError(
+                f"--{option} cannot be used with --incremental"
+            )
+
+
+def export_course_grades(
+    moodle, course_id, bucket_name, key, max_workers, stream,
+    attempt_cache=None, incremental=False, compression=None,
+    skip_unchanged=False, fingerprints=False, quizzes=None
+):
+    """Export grades for a course to key. Returns False if the upload was
+    skipped because the grades were unchanged. quizzes can be set to the
+    course's prefetched quizzes."""
+    if incremental:
+        # Deltas are only written when grades change
+        export_course_grades_delta(
+            moodle,
+            course_id,
+            bucket_name,
+            key,
+            max_workers,
+            compression,
+            quizzes
+        )
+        return True
+
+    if stream:
+        with tempfile.TemporaryFile() as old_file, \
+                tempfile.TemporaryFile() as f:
+            # The previous export is downloaded to disk and its attempts are
+            # parsed one user at a time while the new export is written
+            old_grades = {}
+            if aws.download_file(bucket_name, key, old_file):
+                old_file.seek(0)
+                old_grades = utils.read_grades_stream(
+                    aws.decompressed_reader(old_file)
+                )
+            with aws.compressed_writer(f, compression) as writer:
+                utils.write_grades_data(
+                    moodle,
+                    course_id,
+                    old_grades,
+                    writer,
+                    max_workers,
+                    attempt_cache,
+                    fingerprints,
+                    quizzes
+                )
+            f.seek(0)
+            return aws.put_json_file(
+                f,
+                bucket_name,
+                key,
+                compression,
+                skip_unchanged
+            )
+    else:
+        old_grades = aws.get_json_data(bucket_name, key, {})
+        new_grades = utils.update_grades_data(
+            moodle,
+            course_id,
+            old_grades,
+            max_workers,
+            attempt_cache,
+            fingerprints,
+            quizzes
+        )
+        return aws.put_json_data(
+            new_grades,
+            bucket_name,
+            key,
+            compression=compression,
+            skip_unchanged=skip_unchanged
+        )
 
 
 @cli.command()
 @click.argument('source_course_id')
 @click.argument('bucket_name')
 @click.argument('key')
-def export_grades(source_course_id, bucket_name, key):
+@click.option('--max-workers', type=click.IntRange(min=1), default=1,
+              help="Maximum number of concurrent requests to Moodle")
+@click.option('--stream', is_flag=True,
+              help="Read the previous export and write grades through "
+                   "temporary files one user at a time instead of building "
+                   "them in memory")
+@attempt_cache_options
+@incremental_option
+@compression_option
+@skip_unchanged_option
+@fingerprints_option
+def export_grades(
+    source_course_id, bucket_name, key, max_workers, stream, attempt_cache,
+    attempt_cache_size, incremental, compression, skip_unchanged,
+    fingerprints
+):
     """Output to JSON the grades for a given course into a s3 bucket"""
-    moodle = get_moodle_client()
+    check_incremental_options(
+        incremental,
+        stream=stream,
+        attempt_cache=attempt_cache,
+        fingerprints=fingerprints,
+        skip_unchanged=skip_unchanged
+    )
+    moodle = get_moodle_client(max_workers)
 
-    old_grades = aws.get_json_data(bucket_name, key, {})
-    new_grades = utils.update_grades_data(
+    written = export_course_grades(
         moodle,
         source_course_id,
-        old_grades
+        bucket_name,
+        key,
+        max_workers,
+        stream,
+        open_attempt_cache(attempt_cache, attempt_cache_size),
+        incremental,
+        compression,
+        skip_unchanged,
+        fingerprints
     )
-    aws.put_json_data(new_grades, bucket_name, key)
+    if not written:
+        click.echo(f"Grades unchanged, skipped upload of {key}")
+
+
+@cli.command()
+@click.argument('bucket_name')
+@click.argument('key')
+@compression_option
+def compact_grades(bucket_name, key, compression):
+    """Merge the deltas written by export-grades --incremental into the
+    full grades object stored at KEY"""
+    manifest_key = grades_manifest_key(key)
+    manifest = aws.get_json_data(bucket_name, manifest_key, {})
+    delta_keys = manifest.get("deltas", [])
+    if not delta_keys:
+        return
+
+    grades = aws.get_json_data(bucket_name, key, {})
+    for delta_key in delta_keys:
+        utils.merge_grades_delta(
+            grades,
+            aws.get_json_data(bucket_name, delta_key)
+        )
+    aws.put_json_data(grades, bucket_name, key, compression=compression)
+
+    manifest["deltas"] = []
+    aws.put_json_data(manifest, bucket_name, manifest_key)
+    aws.delete_objects(bucket_name, delta_keys)
 
 
 @cli.command()
 @click.argument('source_course_id')
 @click.argument('bucket_name')
 @click.argument('key')
-def export_users(source_course_id, bucket_name, key):
+@format_option
+@compression_option
+@skip_unchanged_option
+@uuid_options
+@roster_options
+def export_users(source_course_id, bucket_name, key, output_format,
+                 compression, skip_unchanged, uuid_chunk_size, uuid_cache,
+                 user_fields, roster_cache, roster_ttl):
     """Collects user data and unique ids from moodle, injects
     the uuids into the user data, then outputs the user data to s3"""
     moodle = get_moodle_client()
 
-    user_data = moodle.get_users_by_course(
-        source_course_id
+    user_data = utils.get_course_users(
+        moodle,
+        source_course_id,
+        user_fields,
+        open_cache(cache.RosterCache, roster_cache, roster_ttl)
     )
-    uuid_data = utils.maybe_user_uuids(moodle)
+    if uuid_chunk_size is None and uuid_cache is None:
+        uuid_data = utils.maybe_user_uuids(moodle)
+    else:
+        uuid_data = course_user_uuids(
+            moodle,
+            user_data,
+            uuid_chunk_size,
+            open_cache(cache.UserUUIDCache, uuid_cache)
+        )
     user_data = utils.inject_uuids(uuid_data, user_data)
 
-    aws.put_json_data(user_data, bucket_name, key)
+    written = aws.put_json_data(
+        user_data,
+        bucket_name,
+        key,
+        output_format=output_format,
+        compression=compression,
+        skip_unchanged=skip_unchanged
+    )
+    if not written:
+        click.echo(f"Users unchanged, skipped upload of {key}")
 
 
 @cli.command()
@@ -293,29 +797,135 @@ def export_users(source_course_id, bucket_name, key):
 @click.argument('directory')
 @click.argument('data_type',
                 type=click.Choice(['grades', 'users'], case_sensitive=False))
-def export_bulk(input_csv, bucket_name, directory, data_type):
+@click.option('--max-workers', type=click.IntRange(min=1), default=1,
+              help="Maximum number of concurrent requests to Moodle")
+@click.option('--parallel', type=click.IntRange(min=1), default=1,
+              help="Number of courses to export concurrently")
+@click.option('--stream', is_flag=True,
+              help="Read the previous export and write grades through "
+                   "temporary files one user at a time instead of building "
+                   "them in memory")
+@click.option('--quiz-chunk-size', type=click.IntRange(min=1),
+              help="Fetch quiz metadata for all courses up front, with this "
+                   "many course IDs per request, instead of once per course")
+@attempt_cache_options
+@incremental_option
+@format_option
+@compression_option
+@skip_unchanged_option
+@fingerprints_option
+@uuid_options
+@roster_options
+@checkpoint_options
+@click.pass_context
+def export_bulk(
+    ctx, input_csv, bucket_name, directory, data_type, max_workers, parallel,
+    stream, quiz_chunk_size, attempt_cache, attempt_cache_size, incremental,
+    output_format, compression, skip_unchanged, fingerprints,
+    uuid_chunk_size, uuid_cache, user_fields, roster_cache, roster_ttl,
+    checkpoint_location, resume
+):
     """Outputs either grade data or user data (with unique ids) to a
     specified s3 bucket"""
+    if data_type == 'grades' and output_format != aws.FORMAT_JSON:
+        raise click.UsageError("Grades can only be exported as json")
+    if data_type == 'grades':
+        check_incremental_options(
+            incremental,
+            stream=stream,
+            attempt_cache=attempt_cache,
+            fingerprints=fingerprints,
+            skip_unchanged=skip_unchanged
+        )
 
-    moodle = get_moodle_client()
-    course_ids = csv.DictReader(input_csv)
-    if data_type == 'users':
+    moodle = get_moodle_client(parallel * max_workers)
+    run_checkpoint = open_checkpoint(
+        checkpoint_location,
+        resume,
+        f"export-bulk {bucket_name} {directory} {data_type}"
+    )
+    all_course_ids = [
+        row[utils.CSV_COURSE_ID] for row in csv.DictReader(input_csv)
+    ]
+    course_ids = run_checkpoint.pending(all_course_ids)
+    if len(course_ids) < len(all_course_ids):
+        click.echo(
+            f"Skipping {len(all_course_ids) - len(course_ids)} courses "
+            "exported by a previous run"
+        )
+    scoped_uuids = uuid_chunk_size is not None or uuid_cache is not None
+    if data_type == 'users' and not scoped_uuids:
         uuid_data = utils.maybe_user_uuids(moodle)
-    for row in course_ids:
-        id = row[utils.CSV_COURSE_ID]
+    uuid_cache = open_cache(cache.UserUUIDCache, uuid_cache)
+    roster_cache = open_cache(cache.RosterCache, roster_cache, roster_ttl)
+    attempt_cache = open_attempt_cache(attempt_cache, attempt_cache_size)
+    course_quizzes = {}
+    if data_type == 'grades' and quiz_chunk_size is not None:
+        course_quizzes = utils.get_quizzes_by_course_ids(
+            moodle,
+            course_ids,
+            quiz_chunk_size
+        )
+    unchanged = []
+
+    def export_course(id):
         key = f'{directory}/{id}.json'
         if data_type == 'grades':
-            old_grades = aws.get_json_data(bucket_name, key, {})
-            new_grades = utils.update_grades_data(
+            written = export_course_grades(
                 moodle,
                 id,
-                old_grades
+                bucket_name,
+                key,
+                max_workers,
+                stream,
+                attempt_cache,
+                incremental,
+                compression,
+                skip_unchanged,
+                fingerprints,
+                course_quizzes.get(str(id))
             )
-            aws.put_json_data(new_grades, bucket_name, key)
         elif data_type == 'users':
-            user_data = moodle.get_users_by_course(id)
-            user_data = utils.inject_uuids(uuid_data, user_data)
-            aws.put_json_data(user_data, bucket_name, key)
+            user_data = utils.get_course_users(
+                moodle,
+                id,
+                user_fields,
+                roster_cache
+            )
+            if scoped_uuids:
+                course_uuid_data = course_user_uuids(
+                    moodle,
+                    user_data,
+                    uuid_chunk_size,
+                    uuid_cache
+                )
+            else:
+                course_uuid_data = uuid_data
+            user_data = utils.inject_uuids(course_uuid_data, user_data)
+            written = aws.put_json_data(
+                user_data,
+                bucket_name,
+                key,
+                output_format=output_format,
+                compression=compression,
+                skip_unchanged=skip_unchanged
+            )
+        if not written:
+            unchanged.append(id)
+        run_checkpoint.mark_done(id)
+
+    results = utils.map_isolated(export_course, course_ids, parallel)
+    failures = [(id, error) for id, error in results if error is not None]
+
+    click.echo(
+        f"Exported {len(results) - len(failures)} of {len(results)} courses"
+    )
+    if skip_unchanged:
+        click.echo(f"Skipped upload of {len(unchanged)} unchanged courses")
+    for id, error in failures:
+        click.echo(f"Failed to export course {id}: {error!r}")
+    if failures:
+        ctx.exit(1)
 
 
 @cli.command()
@@ -333,10 +943,19 @@ def export_bulk_csv(output_csv):
 @click.argument('policyversionid')
 @click.argument('bucket_name')
 @click.argument('key')
-def export_policy_acceptances(policyversionid, bucket_name, key):
+@format_option
+@compression_option
+def export_policy_acceptances(policyversionid, bucket_name, key,
+                              output_format, compression):
     """Get policy acceptance data and save to JSON in S3"""
     moodle = get_moodle_client()
 
     policy_acceptance_data = moodle.get_policy_acceptance_data(
         policyversionid=policyversionid)
-    aws.put_json_data(policy_acceptance_data, bucket_name, key)
+    aws.put_json_data(
+        policy_acceptance_data,
+        bucket_name,
+        key,
+        output_format=output_format,
+        compression=compression
+    )
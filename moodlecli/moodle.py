@@ -1,3 +1,5 @@
+import random
+from time import perf_counter, sleep
 from . import utils
 
 MOODLE_WEBSERVICE_PATH = "/webservice/rest/server.php"
@@ -9,6 +11,7 @@ MOODLE_FUNC_IMPORT_COURSE = "core_course_import_course"
 MOODLE_FUNC_CORE_ENROL_GET_ENROLLED_USERS = "core_enrol_get_enrolled_users"
 MOODLE_FUNC_CREATE_USERS = "core_user_create_users"
 MOODLE_FUNC_GET_USERS = "core_user_get_users"
+MOODLE_FUNC_GET_USERS_BY_FIELD = "core_user_get_users_by_field"
 MOODLE_FUNC_ENROL_USER = "enrol_manual_enrol_users"
 MOODLE_FUNC_UNENROL_USER = "enrol_manual_unenrol_users"
 MOODLE_FUNC_GRADEREPORT_USER_GET_GRADE_ITEMS = \
@@ -27,37 +30,54 @@ MOODLE_FUNC_GET_USER_QUIZ_ATTEMPTS = "mod_quiz_get_user_attempts"
 MOODLE_FUNC_GET_POLICY_ACCEPTANCE_DATA =  \
     "local_raisecli_get_policy_acceptance_data"
 MOODLE_REQUEST_TIMEOUT = 360  # 6 minutes
+MOODLE_POOL_SIZE = 10
+MOODLE_GET_RETRIES = 3
+MOODLE_RETRY_BACKOFF = 1  # seconds
+MOODLE_RETRY_BACKOFF_MAX = 60  # seconds
+MOODLE_RETRYABLE_STATUS_CODES = (429, 502, 503, 504)
+# Moodle exceptions which are caused by transient conditions on the server
+# (e.g. the database being unavailable) rather than by the request itself
+MOODLE_RETRYABLE_EXCEPTIONS = (
+    "dml_connection_exception",
+    "dml_read_exception",
+    "dml_sessionwait_exception",
+)
+# Debug info core_user_create_users reports when an account already exists
+MOODLE_DUPLICATE_USER_ERRORS = (
+    "Username already exists",
+    "Email address already exists",
+)
 
 
 def convert_moodle_params(data, prefix=""):
     """Given a dict / array, convert into a flat dict that Moodle expects
     where the key names define the structure.
     """
-    result = {}
-
-    if not isinstance(data, (list, dict)):
-        result[prefix] = data
-        return result
-
-    if not prefix:
-        prefix = "{0}"
-    else:
-        prefix += "[{0}]"
-
     if isinstance(data, list):
-        for idx, val in enumerate(data):
-            elem_data = convert_moodle_params(
-                val,
-                prefix.format(idx)
-            )
-            result.update(elem_data)
+        items = enumerate(data)
     elif isinstance(data, dict):
-        for key, val in data.items():
-            elem_data = convert_moodle_params(
-                val,
-                prefix.format(key)
-            )
-            result.update(elem_data)
+        items = iter(data.items())
+    else:
+        return {prefix: data}
+
+    result = {}
+    # Iterators over the containers currently being flattened with their
+    # keys. Scalars are added to result as they are reached so keys are in
+    # the same depth first order as the structure of data.
+    stack = [(prefix, items)]
+    while stack:
+        key, items = stack[-1]
+        for child_key, child in items:
+            child_key = f"{key}[{child_key}]" if key else str(child_key)
+            if isinstance(child, list):
+                stack.append((child_key, enumerate(child)))
+                break
+            if isinstance(child, dict):
+                stack.append((child_key, iter(child.items())))
+                break
+            result[child_key] = child
+        else:
+            stack.pop()
 
     return result
 
@@ -78,12 +98,73 @@ def check_for_moodle_error(result):
     return result_json
 
 
+def is_retryable_error(error):
+    """Determine whether a failed request may succeed if tried again"""
+    # requests is imported when needed to keep CLI startup fast
+    import requests
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+
+    # HTTP status errors raised by raise_for_status() carry the response
+    response = getattr(error, "response", None)
+    if response is not None:
+        return response.status_code in MOODLE_RETRYABLE_STATUS_CODES
+
+    # Errors raised by check_for_moodle_error include the Moodle payload
+    if error.args and isinstance(error.args[0], dict):
+        return error.args[0].get("exception") in MOODLE_RETRYABLE_EXCEPTIONS
+
+    return False
+
+
+def is_duplicate_user_error(error):
+    """Determine whether creating users failed because one of them already
+    has an account"""
+    if error.args and isinstance(error.args[0], dict):
+        debuginfo = error.args[0].get("debuginfo") or ""
+        return any(
+            message in debuginfo for message in MOODLE_DUPLICATE_USER_ERRORS
+        )
+    return False
+
+
+def retry_delay(attempt):
+    """Exponential backoff with jitter for the given retry attempt (starting
+    at zero)"""
+    delay = min(MOODLE_RETRY_BACKOFF_MAX, MOODLE_RETRY_BACKOFF * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def create_session(pool_size=MOODLE_POOL_SIZE):
+    """Create a requests session which keeps up to pool_size connections to
+    Moodle alive. The pool size should be at least the number of concurrent
+    requests the session will be used for."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 class MoodleClient:
-    def __init__(self, session, moodle_url, moodle_token):
+    def __init__(
+        self, session, moodle_url, moodle_token, retries=MOODLE_GET_RETRIES,
+        stats=None, metadata_cache=None
+    ):
         self.session = session
         self.moodle_url = moodle_url
         self.service_endpoint = f"{moodle_url}{MOODLE_WEBSERVICE_PATH}"
         self.token = moodle_token
+        self.retries = retries
+        # Optional stats.RequestStats which is updated for every request
+        self.stats = stats
+        # Optional cache.MetadataCache for roles, courses by shortname and
+        # self enrolment methods
+        self.metadata_cache = metadata_cache
 
     def _create_params(self, service_function, data):
         params = {
@@ -95,23 +176,76 @@ class MoodleClient:
             params.update(convert_moodle_params(data))
         return params
 
+    def _record_request(self, service_function, start, res, error):
+        if self.stats is None:
+            return
+        self.stats.record(
+            service_function,
+            perf_counter() - start,
+            len(res.content) if res is not None else 0,
+            error
+        )
+
+    def _send(self, send_func, service_function, *args, **kwargs):
+        """Send a single request using send_func (e.g. session.get) and
+        check the result for errors"""
+        start = perf_counter()
+        res = None
+        error = True
+        try:
+            res = send_func(
+                self.service_endpoint,
+                *args,
+                timeout=MOODLE_REQUEST_TIMEOUT,
+                **kwargs
+            )
+            result = check_for_moodle_error(res)
+            error = False
+            return result
+        finally:
+            self._record_request(service_function, start, res, error)
+
     def _post(self, service_function, data):
         """POST to service function with provided data as parameters"""
-        res = self.session.post(
-            self.service_endpoint,
-            self._create_params(service_function, data),
-            timeout=MOODLE_REQUEST_TIMEOUT
+        return self._send(
+            self.session.post,
+            service_function,
+            self._create_params(service_function, data)
         )
-        return check_for_moodle_error(res)
 
     def _get(self, service_function, data=None):
-        """GET to service function with provided data as parameters"""
-        res = self.session.get(
-            self.service_endpoint,
-            params=self._create_params(service_function, data),
-            timeout=MOODLE_REQUEST_TIMEOUT
-        )
-        return check_for_moodle_error(res)
+        """GET to service function with provided data as parameters. Since
+        these requests are idempotent they are retried with backoff when
+        failing with retryable errors."""
+        params = self._create_params(service_function, data)
+        attempt = 0
+        while True:
+            try:
+                return self._send(
+                    self.session.get,
+                    service_function,
+                    params=params
+                )
+            except Exception as e:
+                if attempt >= self.retries or not is_retryable_error(e):
+                    raise
+            sleep(retry_delay(attempt))
+            attempt += 1
+
+    def _cached_get(
+        self, namespace, key, service_function, data, cacheable=bool
+    ):
+        """GET from service function, using the metadata cache if there is
+        one. Results are only cached if cacheable(result) is true."""
+        if self.metadata_cache is None:
+            return self._get(service_function, data)
+
+        result = self.metadata_cache.get(namespace, key)
+        if result is None:
+            result = self._get(service_function, data)
+            if cacheable(result):
+                self.metadata_cache.put(namespace, key, result)
+        return result
 
     def copy_course(
         self, source_id, course_name, course_shortname, course_category_id,
@@ -149,25 +283,47 @@ class MoodleClient:
             "field": "shortname",
             "value": shortname
         }
-        return self._get(MOODLE_FUNC_GET_COURSES_BY_FIELD, data)
+        # Missing courses are not cached since they may be mid copy
+        return self._cached_get(
+            "course_by_shortname",
+            shortname,
+            MOODLE_FUNC_GET_COURSES_BY_FIELD,
+            data,
+            lambda result: bool(result["courses"])
+        )
 
     def get_self_enrolment_methods(self, course_id, role_id):
         data = {
             "courseid": course_id,
             "roleid": role_id
         }
-        return self._get(MOODLE_FUNC_GET_SELF_ENROLMENT_METHODS, data)
+        return self._cached_get(
+            "self_enrolment_methods",
+            [course_id, role_id],
+            MOODLE_FUNC_GET_SELF_ENROLMENT_METHODS,
+            data
+        )
 
     def get_role_by_shortname(self, shortname):
         data = {
             "shortname": shortname
         }
-        return self._get(MOODLE_FUNC_GET_ROLE_BY_SHORTNAME, data)
+        return self._cached_get(
+            "role_by_shortname",
+            shortname,
+            MOODLE_FUNC_GET_ROLE_BY_SHORTNAME,
+            data
+        )
+
+    def _invalidate_self_enrolment_methods(self):
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate("self_enrolment_methods")
 
     def enable_self_enrolment_method(self, enrol_id):
         data = {
             "enrolid": enrol_id
         }
+        self._invalidate_self_enrolment_methods()
         return self._post(MOODLE_FUNC_ENABLE_SELF_ENROLMENT_METHOD, data)
 
     def set_self_enrolment_method_key(self, enrol_id, enrol_key):
@@ -175,6 +331,7 @@ class MoodleClient:
             "enrolid": enrol_id,
             "enrolkey": enrol_key
         }
+        self._invalidate_self_enrolment_methods()
         return self._post(MOODLE_FUNC_SET_SELF_ENROLMENT_METHOD_KEY, data)
 
     def get_user_by_email(self, email):
@@ -195,7 +352,14 @@ class MoodleClient:
         else:
             return None
 
-    def create_user(self, firstname, lastname, email, auth):
+    def get_users_by_field(self, field, values):
+        data = {
+            "field": field,
+            "values": values
+        }
+        return self._get(MOODLE_FUNC_GET_USERS_BY_FIELD, data)
+
+    def _new_user_data(self, firstname, lastname, email, auth):
         # Moodle requires lower case in usernames and for consistency we'll
         # go ahead and use the same value for email
         lowercase_email = email.lower()
@@ -210,12 +374,33 @@ class MoodleClient:
         # and email one to the user.
         if auth == "manual":
             user_data["password"] = utils.generate_password()
+        return user_data
+
+    def create_user(self, firstname, lastname, email, auth):
         data = {
-            "users": [user_data]
+            "users": [
+                self._new_user_data(firstname, lastname, email, auth)
+            ]
         }
         res = self._post(MOODLE_FUNC_CREATE_USERS, data)
         return res[0]
 
+    def create_users(self, users):
+        """Create multiple users in a single request. Each item in users
+        is a dict with firstname, lastname, email and auth keys."""
+        data = {
+            "users": [
+                self._new_user_data(
+                    user["firstname"],
+                    user["lastname"],
+                    user["email"],
+                    user["auth"]
+                )
+                for user in users
+            ]
+        }
+        return self._post(MOODLE_FUNC_CREATE_USERS, data)
+
     def enrol_user(self, course_id, user_id, role_id):
         data = {
             "enrolments": [{
@@ -226,6 +411,19 @@ class MoodleClient:
         }
         return self._post(MOODLE_FUNC_ENROL_USER, data)
 
+    def enrol_users(self, course_id, user_ids, role_id):
+        data = {
+            "enrolments": [
+                {
+                    "courseid": course_id,
+                    "userid": user_id,
+                    "roleid": role_id
+                }
+                for user_id in user_ids
+            ]
+        }
+        return self._post(MOODLE_FUNC_ENROL_USER, data)
+
     def unenrol_user(self, course_id, user_id):
         data = {
             "enrolments": [{
@@ -235,16 +433,36 @@ class MoodleClient:
         }
         return self._post(MOODLE_FUNC_UNENROL_USER, data)
 
+    def unenrol_users(self, course_id, user_ids):
+        data = {
+            "enrolments": [
+                {
+                    "courseid": course_id,
+                    "userid": user_id,
+                }
+                for user_id in user_ids
+            ]
+        }
+        return self._post(MOODLE_FUNC_UNENROL_USER, data)
+
     def get_grades_by_course(self, course_id):
         data = {
             'courseid': course_id
         }
         return self._get(MOODLE_FUNC_GRADEREPORT_USER_GET_GRADE_ITEMS, data)
 
-    def get_users_by_course(self, course_id):
+    def get_users_by_course(self, course_id, user_fields=None):
+        """Return users enrolled in course. If user_fields is given only
+        those profile fields (and the user ID) are returned for each user,
+        which avoids transferring custom fields and preferences."""
         data = {
             "courseid": course_id
         }
+        if user_fields:
+            data["options"] = [{
+                "name": "userfields",
+                "value": ",".join(user_fields)
+            }]
         return self._get(MOODLE_FUNC_CORE_ENROL_GET_ENROLLED_USERS, data)
 
     def get_course_enrolment_url(self, course_id):
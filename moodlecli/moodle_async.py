@@ -0,0 +1,108 @@
+import asyncio
+import httpx
+from time import perf_counter
+from .moodle import (
+    MoodleClient,
+    check_for_moodle_error,
+    is_retryable_error,
+    retry_delay,
+    MOODLE_FUNC_CREATE_USERS,
+    MOODLE_FUNC_GET_USERS,
+    MOODLE_GET_RETRIES,
+    MOODLE_REQUEST_TIMEOUT,
+)
+
+MOODLE_MAX_CONCURRENCY = 10
+
+
+class AsyncMoodleClient(MoodleClient):
+    """Async counterpart of MoodleClient which uses an httpx.AsyncClient as
+    its session. Web service methods have the same names and arguments as
+    in MoodleClient but return awaitables. At most max_concurrency requests
+    are in flight at any time, so callers can schedule many calls at once
+    (e.g. with asyncio.gather).
+
+    Since the utils helpers call MoodleClient methods synchronously, they
+    should not be given an instance of this class.
+    """
+
+    def __init__(
+        self, session, moodle_url, moodle_token, retries=MOODLE_GET_RETRIES,
+        stats=None, max_concurrency=MOODLE_MAX_CONCURRENCY
+    ):
+        super().__init__(session, moodle_url, moodle_token, retries, stats)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _send(self, send_func, service_function, **kwargs):
+        """Send a single request using send_func (e.g. session.get) once a
+        slot is available and check the result for errors"""
+        async with self._semaphore:
+            start = perf_counter()
+            res = None
+            error = True
+            try:
+                res = await send_func(
+                    self.service_endpoint,
+                    timeout=MOODLE_REQUEST_TIMEOUT,
+                    **kwargs
+                )
+                result = check_for_moodle_error(res)
+                error = False
+                return result
+            finally:
+                self._record_request(service_function, start, res, error)
+
+    async def _post(self, service_function, data):
+        """POST to service function with provided data as parameters"""
+        return await self._send(
+            self.session.post,
+            service_function,
+            data=self._create_params(service_function, data)
+        )
+
+    async def _get(self, service_function, data=None):
+        """GET to service function with provided data as parameters. Failed
+        requests are retried with the same policy as MoodleClient."""
+        params = self._create_params(service_function, data)
+        attempt = 0
+        while True:
+            try:
+                return await self._send(
+                    self.session.get,
+                    service_function,
+                    params=params
+                )
+            except Exception as e:
+                retryable = isinstance(e, httpx.TransportError) or \
+                    is_retryable_error(e)
+                if attempt >= self.retries or not retryable:
+                    raise
+            await asyncio.sleep(retry_delay(attempt))
+            attempt += 1
+
+    async def get_user_by_email(self, email):
+        data = {
+            "criteria": [{
+                "key": "email",
+                "value": email
+            }]
+        }
+        res = await self._get(MOODLE_FUNC_GET_USERS, data)
+        user_data = res["users"]
+
+        if len(user_data) > 1:
+            raise Exception(f"Multiple users returned with email {email}")
+
+        if user_data:
+            return user_data[0]
+        else:
+            return None
+
+    async def create_user(self, firstname, lastname, email, auth):
+        data = {
+            "users": [
+                self._new_user_data(firstname, lastname, email, auth)
+            ]
+        }
+        res = await self._post(MOODLE_FUNC_CREATE_USERS, data)
+        return res[0]
@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 360)
+
+
+class RequestStats:
+    """Thread safe collection of request counts, errors, response sizes and
+    latency histograms per Moodle web service function"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._functions = {}
+
+    def record(self, wsfunction, elapsed, response_bytes, error):
+        with self._lock:
+            function_stats = self._functions.setdefault(wsfunction, {
+                "count": 0,
+                "errors": 0,
+                "response_bytes": 0,
+                "total_seconds": 0.0,
+                "max_seconds": 0.0,
+                "buckets": [0] * len(LATENCY_BUCKETS)
+            })
+            function_stats["count"] += 1
+            function_stats["errors"] += int(error)
+            function_stats["response_bytes"] += response_bytes
+            function_stats["total_seconds"] += elapsed
+            function_stats["max_seconds"] = max(
+                function_stats["max_seconds"],
+                elapsed
+            )
+            for idx, upper_bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= upper_bound:
+                    function_stats["buckets"][idx] += 1
+                    break
+
+    def summary(self):
+        """Return a dict of stats by web service function. Histogram bucket
+        counts are not cumulative."""
+        with self._lock:
+            return json.loads(json.dumps(self._functions))
+
+    def to_table(self):
+        from prettytable import PrettyTable
+
+        t = PrettyTable()
+        t.field_names = [
+            "wsfunction", "count", "errors", "total (s)", "mean (s)",
+            "max (s)", "bytes"
+        ]
+        by_total_seconds = sorted(
+            self.summary().items(),
+            key=lambda item: item[1]["total_seconds"],
+            reverse=True
+        )
+        for wsfunction, function_stats in by_total_seconds:
+            mean_seconds = \
+                function_stats["total_seconds"] / function_stats["count"]
+            t.add_row([
+                wsfunction,
+                function_stats["count"],
+                function_stats["errors"],
+                f"{function_stats['total_seconds']:.3f}",
+                f"{mean_seconds:.3f}",
+                f"{function_stats['max_seconds']:.3f}",
+                function_stats["response_bytes"]
+            ])
+
+        t.align["wsfunction"] = "l"
+        return t.get_string()
+
+    def to_json(self):
+        return json.dumps({
+            "latency_buckets": LATENCY_BUCKETS,
+            "functions": self.summary()
+        }, indent=4)
+
+    def to_prometheus(self):
+        """Render stats in the Prometheus text exposition format"""
+        lines = []
+        counters = [
+            ("moodlecli_requests_total", "count",
+             "Moodle web service requests"),
+            ("moodlecli_request_errors_total", "errors",
+             "Moodle web service requests which failed"),
+            ("moodlecli_response_bytes_total", "response_bytes",
+             "Bytes received from Moodle web service requests"),
+        ]
+        summary = self.summary()
+        for name, field, description in counters:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for wsfunction, function_stats in summary.items():
+                lines.append(
+                    f'{name}{{wsfunction="{wsfunction}"}} '
+                    f'{function_stats[field]}'
+                )
+
+        name = "moodlecli_request_duration_seconds"
+        lines.append(f"# HELP {name} Moodle web service request latency")
+        lines.append(f"# TYPE {name} histogram")
+        for wsfunction, function_stats in summary.items():
+            cumulative = 0
+            for upper_bound, count in zip(
+                LATENCY_BUCKETS,
+                function_stats["buckets"]
+            ):
+                cumulative += count
+                lines.append(
+                    f'{name}_bucket{{wsfunction="{wsfunction}",'
+                    f'le="{upper_bound}"}} {cumulative}'
+                )
+            lines.append(
+                f'{name}_bucket{{wsfunction="{wsfunction}",le="+Inf"}} '
+                f'{function_stats["count"]}'
+            )
+            lines.append(
+                f'{name}_sum{{wsfunction="{wsfunction}"}} '
+                f'{function_stats["total_seconds"]}'
+            )
+            lines.append(
+                f'{name}_count{{wsfunction="{wsfunction}"}} '
+                f'{function_stats["count"]}'
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, output_format):
+        """Write stats as json or prometheus to path. The file is replaced
+        atomically so collectors never read a partial file."""
+        if output_format == "prometheus":
+            contents = self.to_prometheus()
+        else:
+            contents = self.to_json()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
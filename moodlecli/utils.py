@@ -1,8 +1,14 @@
+import hashlib
+import io
+import json
 import string
+import threading
 import random
-from prettytable import PrettyTable
-from requests.exceptions import ConnectionError, Timeout
-from time import sleep
+from time import monotonic, sleep
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from contextlib import nullcontext
+from .cache import attempt_is_finalized
+from . import moodle
 
 CSV_INST_FNAME = 'instructor_firstname'
 CSV_INST_LNAME = 'instructor_lastname'
@@ -19,6 +25,24 @@ CSV_COURSE_ID = "course_id"
 CSV_COURSE_ENROLMENT_URL = "course_enrolment_url"
 CSV_COURSE_ENROLMENT_KEY = "course_enrolment_key"
 
+# Number of users whose attempts are gathered together when building grades
+GRADES_USER_BATCH_SIZE = 100
+
+# Characters read at a time when parsing previous grades exports
+GRADES_STREAM_BLOCK_SIZE = 64 * 1024
+
+# Polling schedule (in seconds) used to find course copies which timed out
+COURSE_COPY_POLL_INITIAL_INTERVAL = 5
+COURSE_COPY_POLL_MAX_INTERVAL = 60
+COURSE_COPY_POLL_BACKOFF = 2
+COURSE_COPY_POLL_DEADLINE = 3600
+
+# Number of user IDs sent per request when looking up specific user UUIDs
+USER_UUID_CHUNK_SIZE = 500
+
+# Number of course IDs sent per request when prefetching quiz metadata
+QUIZ_COURSE_CHUNK_SIZE = 50
+
 
 def generate_password(length=12):
     """Create a password value"""
@@ -132,7 +156,97 @@ def create_or_get_user(moodle_client, firstname, lastname, email, auth):
     return user_id
 
 
+def chunks(items, size):
+    """Split items into consecutive lists of at most size elements"""
+    items = list(items)
+    return [items[idx:idx + size] for idx in range(0, len(items), size)]
+
+
+def get_user_ids_by_emails(moodle_client, emails, batch_size):
+    """Look up accounts for emails with at most batch_size values per
+    request. Returns a dict mapping lower case email to user ID for accounts
+    which exist.
+
+    core_user_get_users_by_field matches emails exactly, so emails which
+    are not found as given or in lower case are looked up by username,
+    which is the lower case email for accounts created by this tool.
+    """
+    lookup_values = set()
+    for email in emails:
+        lookup_values.update([email, email.lower()])
+
+    user_ids = {}
+    for values in chunks(sorted(lookup_values), batch_size):
+        for existing_user in moodle_client.get_users_by_field(
+            "email", values
+        ):
+            email = existing_user["email"].lower()
+            if user_ids.get(email, existing_user["id"]) != existing_user["id"]:
+                raise Exception(f"Multiple users returned with email {email}")
+            user_ids[email] = existing_user["id"]
+
+    unmatched = sorted({
+        email.lower() for email in emails if email.lower() not in user_ids
+    })
+    for values in chunks(unmatched, batch_size):
+        for existing_user in moodle_client.get_users_by_field(
+            "username", values
+        ):
+            user_ids[existing_user["username"]] = existing_user["id"]
+    return user_ids
+
+
+def create_or_get_users(moodle_client, users, batch_size):
+    """Batched version of create_or_get_user. Each item in users is a dict
+    with firstname, lastname, email and auth keys. Existing accounts are
+    looked up and missing accounts are created with at most batch_size users
+    per request. Returns a list of user IDs in the same order as users.
+
+    Accounts whose email differs in case from the given one and whose
+    username isn't the email are only found when creating them fails, in
+    which case that chunk of users is looked up one at a time with
+    get_user_by_email, which Moodle matches case insensitively.
+    """
+    unique_users = {}
+    for user in users:
+        unique_users.setdefault(user["email"].lower(), user)
+
+    user_ids = get_user_ids_by_emails(
+        moodle_client,
+        [user["email"] for user in unique_users.values()],
+        batch_size
+    )
+
+    missing_users = [
+        user for email, user in unique_users.items() if email not in user_ids
+    ]
+    for new_users in chunks(missing_users, batch_size):
+        try:
+            created_users = moodle_client.create_users(new_users)
+        except Exception as e:
+            if not moodle.is_duplicate_user_error(e):
+                raise
+            created_users = []
+            for user in new_users:
+                existing_user = moodle_client.get_user_by_email(user["email"])
+                if existing_user:
+                    user_ids[user["email"].lower()] = existing_user["id"]
+            new_users = [
+                user for user in new_users
+                if user["email"].lower() not in user_ids
+            ]
+            if new_users:
+                created_users = moodle_client.create_users(new_users)
+        for new_user in created_users:
+            # Usernames are set to the lower case email for new users
+            user_ids[new_user["username"]] = new_user["id"]
+
+    return [user_ids[user["email"].lower()] for user in users]
+
+
 def stylize_courses(courses_json):
+    from prettytable import PrettyTable
+
     t = PrettyTable()
     fields = ['fullname', 'id', 'visible', 'categoryid']
     t.field_names = fields
@@ -146,19 +260,174 @@ def stylize_courses(courses_json):
     return t.get_string(sortby='id')
 
 
+class CourseCopyPoller:
+    """Waits for course copies to show up in Moodle after the copy request
+    timed out. Threads waiting on the same poller share a polling schedule:
+    each poll checks all pending shortnames with a single query (by
+    shortname when only one copy is pending, otherwise using the full course
+    list) and every waiting thread resumes as soon as its course is found.
+    The interval between polls grows exponentially up to max_interval, and
+    waiting for a course fails once deadline seconds have passed.
+    """
+
+    def __init__(
+        self,
+        moodle_client,
+        initial_interval=COURSE_COPY_POLL_INITIAL_INTERVAL,
+        max_interval=COURSE_COPY_POLL_MAX_INTERVAL,
+        backoff=COURSE_COPY_POLL_BACKOFF,
+        deadline=COURSE_COPY_POLL_DEADLINE
+    ):
+        self.moodle_client = moodle_client
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._pending = set()
+        self._found = {}
+        self._poll_count = 0
+
+    def wait_for(self, shortname):
+        """Block until a course with shortname exists and return its ID"""
+        with self._lock:
+            self._pending.add(shortname)
+        start = monotonic()
+        interval = self.initial_interval
+        try:
+            while True:
+                with self._lock:
+                    last_poll_count = self._poll_count
+                sleep(interval)
+                with self._poll_lock:
+                    with self._lock:
+                        # Skip polling if another thread did while we slept
+                        should_poll = shortname not in self._found and \
+                            self._poll_count == last_poll_count
+                    if should_poll:
+                        self._poll()
+                with self._lock:
+                    if shortname in self._found:
+                        course_id = self._found[shortname]
+                        print(f"Found copy: Course ID {course_id}")
+                        return course_id
+                if monotonic() - start > self.deadline:
+                    raise Exception(
+                        f"Timed out waiting for course {shortname} to be "
+                        "created"
+                    )
+                interval = min(self.max_interval, interval * self.backoff)
+        finally:
+            with self._lock:
+                self._pending.discard(shortname)
+                self._found.pop(shortname, None)
+
+    def _poll(self):
+        with self._lock:
+            pending = self._pending - self._found.keys()
+
+        print("Querying current courses")
+        if len(pending) == 1:
+            courses = self.moodle_client.get_course_by_shortname(
+                next(iter(pending))
+            )["courses"]
+        else:
+            courses = self.moodle_client.get_courses()
+
+        with self._lock:
+            for course in courses:
+                if course["shortname"] in pending:
+                    self._found[course["shortname"]] = course["id"]
+            self._poll_count += 1
+
+
+def setup_duplicate_courses(
+    moodle_client, base_course_id, courses, instructor_role_id,
+    student_role_id, max_workers=1, poller=None
+):
+    """Setup new courses using setup_duplicate_course for each item in
+    courses, yielding the updated course data in input order. Up to
+    max_workers courses are set up concurrently. If a course fails, courses
+    which have not started yet are skipped while those in progress are
+    allowed to finish and are yielded before the first error is raised.
+
+    Course copies which time out are found using poller, which defaults to
+    a CourseCopyPoller shared by all courses.
+    """
+    poller = poller or CourseCopyPoller(moodle_client)
+
+    if max_workers <= 1:
+        for coursedata in courses:
+            yield setup_duplicate_course(
+                moodle_client,
+                base_course_id,
+                coursedata,
+                instructor_role_id,
+                student_role_id,
+                poller=poller
+            )
+        return
+
+    # Serialize instructor account lookups so concurrent rows with the same
+    # instructor don't both try to create the account
+    user_lock = threading.Lock()
+    # Set by the worker as soon as a course fails, rather than when its
+    # result is reached in input order, so no further courses are started
+    failed = threading.Event()
+
+    def setup_course(coursedata):
+        if failed.is_set():
+            raise CancelledError()
+        try:
+            return setup_duplicate_course(
+                moodle_client,
+                base_course_id,
+                coursedata,
+                instructor_role_id,
+                student_role_id,
+                user_lock,
+                poller
+            )
+        except Exception:
+            failed.set()
+            raise
+
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(setup_course, coursedata)
+            for coursedata in courses
+        ]
+        for future in futures:
+            try:
+                result = future.result()
+            except CancelledError:
+                continue
+            except Exception as e:
+                if error is None:
+                    error = e
+                continue
+            yield result
+
+    if error is not None:
+        raise error
+
+
 def setup_duplicate_course(
     moodle_client, base_course_id, coursedata, instructor_role_id,
-    student_role_id
+    student_role_id, user_lock=None, poller=None
 ):
     """Setup a new course using a base and data from bulk CSV"""
     # Retrieve or create teacher account
-    instructor_user_id = create_or_get_user(
-        moodle_client,
-        coursedata[CSV_INST_FNAME],
-        coursedata[CSV_INST_LNAME],
-        coursedata[CSV_INST_EMAIL],
-        coursedata[CSV_INST_AUTH],
-        )
+    with user_lock or nullcontext():
+        instructor_user_id = create_or_get_user(
+            moodle_client,
+            coursedata[CSV_INST_FNAME],
+            coursedata[CSV_INST_LNAME],
+            coursedata[CSV_INST_EMAIL],
+            coursedata[CSV_INST_AUTH],
+            )
     course = create_course(
         moodle_client,
         base_course_id,
@@ -168,6 +437,7 @@ def setup_duplicate_course(
         instructor_role_id,
         instructor_user_id,
         student_role_id,
+        poller,
     )
     coursedata[CSV_COURSE_ID] = course["course_id"]
     coursedata[CSV_COURSE_ENROLMENT_URL] = course["course_enrolment_url"]
@@ -185,10 +455,13 @@ def create_course(
     instructor_role_id,
     instructor_user_id,
     student_role_id,
+    poller=None,
 ):
     """The code below was extracted from setup_duplicate_course to
     allow for the ROPE processor to create a Moodle course w/o managing
     the create_course code in two separate code bases"""
+    from requests.exceptions import ConnectionError, Timeout
+
     try:
         # Create a duplicate course using the base course
         new_course = moodle_client.copy_course(
@@ -203,18 +476,8 @@ def create_course(
         # (refer to https://github.com/openstax/k12/issues/316 for details)
         print("Remote disconnected during course copy!")
         print(f"Polling for course {course_shortname}...")
-        course_found = False
-        while not course_found:
-            sleep(30)
-            print("Querying current courses")
-            data = moodle_client.get_course_by_shortname(
-                course_shortname
-            )
-            if len(data["courses"]) == 0:
-                continue
-            new_course_id = data["courses"][0]["id"]
-            print(f"Found copy: Course ID {new_course_id}")
-            course_found = True
+        poller = poller or CourseCopyPoller(moodle_client)
+        new_course_id = poller.wait_for(course_shortname)
 
     # Enrol teacher user as a course instructor
     moodle_client.enrol_user(
@@ -280,7 +543,114 @@ def maybe_user_uuids(moodle_client, user_ids=[]):
             raise e
 
 
-def update_grades_data(moodle_client, course_id, old_grades):
+def get_scoped_user_uuids(
+    moodle_client, user_ids, chunk_size=USER_UUID_CHUNK_SIZE,
+    uuid_cache=None
+):
+    """Look up UUIDs for only user_ids, with at most chunk_size IDs per
+    request, instead of downloading UUIDs for every user. UUIDs found in
+    uuid_cache (a cache.UserUUIDCache) are not requested and those fetched
+    are added to it. Returns data in the form used by inject_uuids.
+    """
+    missing_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+    uuid_data = []
+    if uuid_cache is not None:
+        cached = uuid_cache.get_many(missing_ids)
+        uuid_data = [
+            {"user_id": user_id, "user_uuid": user_uuid}
+            for user_id, user_uuid in cached.items()
+        ]
+        missing_ids = [
+            user_id for user_id in missing_ids if user_id not in cached
+        ]
+
+    for chunk in chunks(missing_ids, chunk_size):
+        chunk_data = maybe_user_uuids(moodle_client, chunk)
+        if uuid_cache is not None:
+            uuid_cache.put_many({
+                item["user_id"]: item["user_uuid"] for item in chunk_data
+            })
+        uuid_data.extend(chunk_data)
+    return uuid_data
+
+
+def get_course_users(
+    moodle_client, course_id, user_fields=None, roster_cache=None
+):
+    """Return the users enrolled in course_id, limited to user_fields (the
+    user ID is always included) if given. A snapshot in roster_cache (a
+    cache.RosterCache) is reused if it has not expired, otherwise the
+    roster is fetched and added to it.
+    """
+    if user_fields:
+        user_fields = list(dict.fromkeys(["id", *user_fields]))
+    if roster_cache is not None:
+        users = roster_cache.get(course_id, user_fields)
+        if users is not None:
+            return users
+
+    users = moodle_client.get_users_by_course(course_id, user_fields)
+    if roster_cache is not None:
+        roster_cache.put(course_id, user_fields, users)
+    return users
+
+
+def get_quizzes_by_course_ids(
+    moodle_client, course_ids, chunk_size=QUIZ_COURSE_CHUNK_SIZE
+):
+    """Fetch quiz metadata for all course_ids with at most chunk_size IDs
+    per request. Returns a dict mapping each course ID (as a string) to its
+    quizzes in the form used by update_grades_data.
+    """
+    course_ids = list(dict.fromkeys(str(id) for id in course_ids))
+    quizzes = {course_id: [] for course_id in course_ids}
+    for chunk in chunks(course_ids, chunk_size):
+        result = moodle_client.get_quizzes_by_courses(
+            [int(course_id) for course_id in chunk]
+        )
+        for quiz in result["quizzes"]:
+            quizzes.setdefault(str(quiz["course"]), []).append(quiz)
+    return quizzes
+
+
+def _map_concurrently(func, args_list, max_workers=1):
+    """Call func with each tuple of arguments in args_list and return the
+    results in the same order. Calls are made from a pool of up to
+    max_workers threads when max_workers is greater than one.
+    """
+    if max_workers <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, *args) for args in args_list]
+        return [future.result() for future in futures]
+
+
+def map_isolated(func, items, max_workers=1):
+    """Call func for each item using up to max_workers threads. Failures are
+    isolated to the item that raised them. Returns a list of
+    (item, exception) tuples in input order where exception is None for items
+    that succeeded.
+    """
+    def _call(item):
+        try:
+            func(item)
+        except Exception as e:
+            return e
+        return None
+
+    errors = _map_concurrently(
+        _call,
+        [(item,) for item in items],
+        max_workers
+    )
+    return list(zip(items, errors))
+
+
+def update_grades_data(
+    moodle_client, course_id, old_grades, max_workers=1, attempt_cache=None,
+    fingerprints=False, quizzes=None
+):
     """This utility function builds a single object which includes data from
     multiple Moodle endpoints. The final object includes the following:
     {
@@ -305,36 +675,586 @@ def update_grades_data(moodle_client, course_id, old_grades):
     The function expects the same structure when parsing to determine if
     data from old_grades can be used as a cache to avoid unnecessary calls
     to Moodle.
-    """
 
-    def _attempts_data_is_stale(attempts, user_id, quiz_id, new_attempt_ts):
-        old_user_attempts = attempts.get(user_id, {})
-        old_quiz_attempts = old_user_attempts.get(quiz_id, {})
+    Attempt summaries and details which are not available from old_grades are
+    requested from Moodle using up to max_workers concurrent requests. The
+    resulting object is the same regardless of the value of max_workers.
 
-        # Use the gradednotificationsenttime to decide whether data is stale
-        latest_found_ts = 0
-        for summary in old_quiz_attempts.get("summaries", []):
-            tmp_attempt_ts = summary["gradednotificationsenttime"]
-            if (tmp_attempt_ts is not None) and \
-               (latest_found_ts < tmp_attempt_ts):
-                latest_found_ts = tmp_attempt_ts
+    If an attempt_cache (see cache.AttemptCache) is provided, details for
+    finalized attempts which are missing from old_grades are read from it
+    before falling back to Moodle, and details fetched for finalized
+    attempts are added to it.
 
-        return new_attempt_ts > latest_found_ts
+    If fingerprints is set, a hash of each user's usergrades entry is stored
+    under "fingerprints" (keyed by user ID, before "attempts"). Users whose
+    fingerprint matches the one in old_grades have their attempts copied
+    from old_grades as is, without checking them for changes.
 
-    # Always pull latest grades and quiz data. The grades data is the basis
-    # of the data object returned by this function.
-    new_grades = moodle_client.get_grades_by_course(course_id)
-    new_quizzes = moodle_client.get_quizzes_by_courses([course_id])
+    quizzes can be set to the course's quizzes if they have already been
+    fetched (see get_quizzes_by_course_ids) to avoid requesting them again.
+    """
+    new_grades = _get_grades_base(
+        moodle_client, course_id, fingerprints, quizzes
+    )
+    # Entries are removed as they are consumed, so work on a shallow copy
+    old_attempts = dict(old_grades.get("attempts", {}))
 
-    new_grades["quizzes"] = new_quizzes["quizzes"]
     new_grades["attempts"] = {}
+    for user_id, user_attempts in _iter_user_attempts(
+        moodle_client,
+        new_grades["usergrades"],
+        old_attempts,
+        max_workers,
+        attempt_cache,
+        unchanged_user_ids=_unchanged_user_ids(new_grades, old_grades)
+    ):
+        new_grades["attempts"][user_id] = user_attempts
 
-    new_usergrades = new_grades["usergrades"]
+    return new_grades
+
+
+def write_grades_data(
+    moodle_client, course_id, old_grades, fileobj, max_workers=1,
+    attempt_cache=None, fingerprints=False, quizzes=None
+):
+    """Write the same JSON data produced by update_grades_data to fileobj
+    (opened in binary mode) one user at a time so the full set of attempts
+    is never held in memory. Entries in old_grades are removed as they are
+    consumed, so callers should not reuse old_grades afterwards.
+
+    If old_grades is read with read_grades_stream, the previous export's
+    attempts are also only parsed one user at a time, so memory use does
+    not grow with the size of the course.
+    """
+    new_grades = _get_grades_base(
+        moodle_client, course_id, fingerprints, quizzes
+    )
+    unchanged_user_ids = _unchanged_user_ids(new_grades, old_grades)
     old_attempts = old_grades.get("attempts", {})
 
+    # The attempts are always the last key of the object, so everything
+    # else can be serialized up front
+    header = json.dumps(new_grades)[:-1]
+    if new_grades:
+        header += ", "
+    fileobj.write(f'{header}"attempts": {{'.encode("utf-8"))
+
+    separator = ""
+    for user_id, user_attempts in _iter_user_attempts(
+        moodle_client,
+        new_grades["usergrades"],
+        old_attempts,
+        max_workers,
+        attempt_cache,
+        unchanged_user_ids=unchanged_user_ids
+    ):
+        entry = f"{json.dumps(user_id)}: {json.dumps(user_attempts)}"
+        fileobj.write(f"{separator}{entry}".encode("utf-8"))
+        separator = ", "
+
+    fileobj.write(b"}}")
+
+
+class _JSONStreamReader:
+    """Reads JSON values one at a time from a text file object"""
+
+    def __init__(self, fileobj, block_size=GRADES_STREAM_BLOCK_SIZE):
+        self._fileobj = fileobj
+        self._block_size = block_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _read(self, size):
+        data = self._fileobj.read(size)
+        if not data:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def next_char(self):
+        """Skip whitespace and return the next character without consuming
+        it, or an empty string at the end of the data"""
+        while True:
+            while self._pos < len(self._buffer) and \
+                    self._buffer[self._pos] in " \t\r\n":
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read(self._block_size):
+                return ""
+
+    def expect(self, chars):
+        """Consume and return the next character, which must be one of
+        chars"""
+        char = self.next_char()
+        if not char or char not in chars:
+            raise ValueError(
+                f"Expected one of {chars!r} in JSON data but found {char!r}"
+            )
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.next_char()
+        size = self._block_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A value ending with the buffer may continue in the file
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._read(size)
+            # Grow reads so large values aren't decoded again too often
+            size = max(size, len(self._buffer))
+
+    def object_items(self):
+        """Yield the (key, value) pairs of the next JSON object"""
+        self.expect("{")
+        if self.next_char() == "}":
+            self.expect("}")
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key, self.value()
+            if self.expect(",}") == "}":
+                return
+
+
+class _StreamedAttempts:
+    """The "attempts" of grades data which are parsed from a stream one
+    user at a time as they are popped. Users are expected in roughly the
+    same order as they were written, and entries read past to find another
+    user are kept until they are popped. If user_ids is set, users not in it
+    are known to be missing and are never searched for."""
+
+    def __init__(self, items, user_ids=None):
+        self._items = items
+        self._user_ids = user_ids
+        self._skipped = {}
+
+    def pop(self, user_id, default=None):
+        if user_id in self._skipped:
+            return self._skipped.pop(user_id)
+        if self._user_ids is not None and user_id not in self._user_ids:
+            return default
+        for key, value in self._items:
+            if key == user_id:
+                return value
+            self._skipped[key] = value
+        return default
+
+
+def read_grades_stream(fileobj, block_size=GRADES_STREAM_BLOCK_SIZE):
+    """Read grades data (as written by write_grades_data) from a binary file
+    object. Keys are parsed up to "attempts", which is returned as an object
+    that parses each user's attempts when they are popped, so the data is
+    never loaded in full. Users missing from "usergrades", which is written
+    before "attempts", are not searched for. Keys after "attempts" are not
+    read, but write_grades_data and update_grades_data always write it last.
+    """
+    reader = _JSONStreamReader(
+        io.TextIOWrapper(fileobj, encoding="utf-8"),
+        block_size
+    )
+    grades = {}
+    reader.expect("{")
+    if reader.next_char() == "}":
+        return grades
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key == "attempts":
+            user_ids = None
+            if "usergrades" in grades:
+                user_ids = {
+                    str(usergrade["userid"])
+                    for usergrade in grades["usergrades"]
+                }
+            grades["attempts"] = _StreamedAttempts(
+                reader.object_items(),
+                user_ids
+            )
+            return grades
+        grades[key] = reader.value()
+        if reader.expect(",}") == "}":
+            return grades
+
+
+def grades_watermark(grades):
+    """Return the latest gradedatesubmitted or gradedategraded found in
+    grades (as returned by update_grades_data) or 0 if there is none"""
+    watermark = 0
+    for usergrade in grades.get("usergrades", []):
+        for gradeitem in usergrade["gradeitems"]:
+            for field in ("gradedatesubmitted", "gradedategraded"):
+                timestamp = gradeitem.get(field)
+                if timestamp is not None:
+                    watermark = max(watermark, timestamp)
+    return watermark
+
+
+def _has_ungraded_attempts(summaries):
+    return any(
+        summary["gradednotificationsenttime"] is None
+        for summary in summaries
+    )
+
+
+def grades_delta_state(grades):
+    """Return the state build_grades_delta compares the latest data from
+    Moodle against for grades (as returned by update_grades_data):
+
+    * "watermark": see grades_watermark
+    * "fingerprints": the fingerprint of each user's usergrades entry (see
+      usergrade_fingerprint), keyed by user ID
+    * "pending": the fingerprint of the attempt summaries of each
+      "{user_id}/{quiz_id}" combo which has attempts that are not graded
+    * "attempts": the fingerprint of the summary of each attempt whose
+      details are known, by attempt ID for each "{user_id}/{quiz_id}" combo
+    """
+    return {
+        "watermark": grades_watermark(grades),
+        "fingerprints": {
+            str(usergrade["userid"]): usergrade_fingerprint(usergrade)
+            for usergrade in grades.get("usergrades", [])
+        },
+        "pending": {
+            f"{user_id}/{quiz_id}": _fingerprint(quiz_attempts["summaries"])
+            for user_id, user_attempts in grades.get("attempts", {}).items()
+            for quiz_id, quiz_attempts in user_attempts.items()
+            if _has_ungraded_attempts(quiz_attempts["summaries"])
+        },
+        "attempts": {
+            f"{user_id}/{quiz_id}": {
+                str(summary["id"]): _fingerprint(summary)
+                for summary in quiz_attempts["summaries"]
+                if str(summary["id"]) in quiz_attempts["details"]
+            }
+            for user_id, user_attempts in grades.get("attempts", {}).items()
+            for quiz_id, quiz_attempts in user_attempts.items()
+        }
+    }
+
+
+def build_grades_delta(
+    moodle_client, course_id, state, max_workers=1, quizzes=None
+):
+    """Build the changes to grades data for a course since state (see
+    grades_delta_state) was recorded. The delta has the same structure as
+    the object built by update_grades_data, but only includes:
+
+    * usergrades for users whose usergrades entry changed, which includes
+      new submissions as well as manual grading, regrades and overrides
+    * attempts for all quizzes those users submitted, since a changed grade
+      does not say which attempts changed
+    * attempts for user + quiz combos which had attempts that were not
+      graded yet, if their summaries changed
+    * "removed": the IDs of users who are no longer in the course
+
+    Attempts include the full latest "summaries" and the "details" of
+    those which are new or whose summary changed (Moodle updates an
+    attempt's sumgrades whenever its details are graded again). The delta
+    also includes "since" and "watermark" keys for the range of changes it
+    covers. Returns a tuple of the delta and the new state. Deltas can be
+    applied to a full object using merge_grades_delta. quizzes is used as
+    in update_grades_data.
+    """
+    new_grades = _get_grades_base(moodle_client, course_id, quizzes=quizzes)
+    old_fingerprints = state.get("fingerprints", {})
+    old_pending = state.get("pending", {})
+
+    fingerprints = {}
+    changed_user_ids = set()
+    refreshed_user_quizzes = []
+    for usergrade in new_grades["usergrades"]:
+        user_id = str(usergrade["userid"])
+        fingerprints[user_id] = usergrade_fingerprint(usergrade)
+        changed = fingerprints[user_id] != old_fingerprints.get(user_id)
+        if changed:
+            changed_user_ids.add(user_id)
+        for gradeitem in usergrade["gradeitems"]:
+            if gradeitem["gradedatesubmitted"] is None:
+                continue
+            quiz_id = str(gradeitem["iteminstance"])
+            if changed or f"{user_id}/{quiz_id}" in old_pending:
+                refreshed_user_quizzes.append((user_id, quiz_id))
+
+    all_summaries = _map_concurrently(
+        moodle_client.get_user_quiz_attempts,
+        refreshed_user_quizzes,
+        max_workers
+    )
+
+    # Forget combos of users who are no longer in the course
+    pending = {
+        pending_key: summaries_fingerprint
+        for pending_key, summaries_fingerprint in old_pending.items()
+        if pending_key.split("/")[0] in fingerprints
+    }
+    attempt_fingerprints = {
+        pending_key: quiz_fingerprints
+        for pending_key, quiz_fingerprints
+        in state.get("attempts", {}).items()
+        if pending_key.split("/")[0] in fingerprints
+    }
+    watermark = max(state.get("watermark", 0), grades_watermark(new_grades))
+    changed_user_quizzes = []
+    for (user_id, quiz_id), data in zip(refreshed_user_quizzes, all_summaries):
+        summaries = data["attempts"]
+        pending_key = f"{user_id}/{quiz_id}"
+        summaries_fingerprint = _fingerprint(summaries)
+        if user_id not in changed_user_ids and \
+                pending.get(pending_key) == summaries_fingerprint:
+            continue
+        pending.pop(pending_key, None)
+        if _has_ungraded_attempts(summaries):
+            pending[pending_key] = summaries_fingerprint
+        for summary in summaries:
+            graded_ts = summary["gradednotificationsenttime"]
+            if graded_ts is not None:
+                watermark = max(watermark, graded_ts)
+        changed_user_quizzes.append((user_id, quiz_id, summaries))
+
+    attempt_ids = []
+    for user_id, quiz_id, summaries in changed_user_quizzes:
+        pending_key = f"{user_id}/{quiz_id}"
+        old_quiz_fingerprints = attempt_fingerprints.get(pending_key, {})
+        quiz_fingerprints = {}
+        for summary in summaries:
+            attempt_id = str(summary["id"])
+            quiz_fingerprints[attempt_id] = _fingerprint(summary)
+            if old_quiz_fingerprints.get(attempt_id) != \
+                    quiz_fingerprints[attempt_id]:
+                attempt_ids.append(attempt_id)
+        attempt_fingerprints[pending_key] = quiz_fingerprints
+    fetched_details = dict(zip(
+        attempt_ids,
+        _map_concurrently(
+            moodle_client.get_quiz_attempt_details,
+            [(attempt_id,) for attempt_id in attempt_ids],
+            max_workers
+        )
+    ))
+
+    delta = new_grades
+    delta["usergrades"] = [
+        usergrade for usergrade in new_grades["usergrades"]
+        if str(usergrade["userid"]) in changed_user_ids
+    ]
+    delta["removed"] = sorted(old_fingerprints.keys() - fingerprints.keys())
+    delta["since"] = state.get("watermark", 0)
+    delta["watermark"] = watermark
+    delta["attempts"] = {}
+    for user_id, quiz_id, summaries in changed_user_quizzes:
+        delta["attempts"].setdefault(user_id, {})[quiz_id] = {
+            "summaries": summaries,
+            "details": {
+                str(summary["id"]): fetched_details[str(summary["id"])]
+                for summary in summaries
+                if str(summary["id"]) in fetched_details
+            }
+        }
+
+    new_state = {
+        "watermark": watermark,
+        "fingerprints": fingerprints,
+        "pending": pending,
+        "attempts": attempt_fingerprints
+    }
+    return delta, new_state
+
+
+def merge_grades_delta(grades, delta):
+    """Apply a delta built by build_grades_delta to grades (as returned by
+    update_grades_data), updating grades in place and returning it"""
+    removed = set(delta.get("removed", []))
+    grades["usergrades"] = [
+        usergrade for usergrade in grades.get("usergrades", [])
+        if str(usergrade["userid"]) not in removed
+    ]
+    for user_id in removed:
+        grades.get("attempts", {}).pop(user_id, None)
+        grades.get("fingerprints", {}).pop(user_id, None)
+
+    usergrades = grades["usergrades"]
+    usergrade_idx = {
+        usergrade["userid"]: idx for idx, usergrade in enumerate(usergrades)
+    }
+    for usergrade in delta["usergrades"]:
+        if usergrade["userid"] in usergrade_idx:
+            usergrades[usergrade_idx[usergrade["userid"]]] = usergrade
+        else:
+            usergrades.append(usergrade)
+
+    grades["quizzes"] = delta["quizzes"]
+
+    # Fingerprints of replaced usergrades no longer describe the attempts
+    old_fingerprints = grades.get("fingerprints", {})
+    for usergrade in delta["usergrades"]:
+        old_fingerprints.pop(str(usergrade["userid"]), None)
+
+    attempts = grades.setdefault("attempts", {})
+    for user_id, user_attempts in delta["attempts"].items():
+        for quiz_id, quiz_attempts in user_attempts.items():
+            old_quiz_attempts = attempts.setdefault(user_id, {}).setdefault(
+                quiz_id,
+                {"summaries": [], "details": {}}
+            )
+            old_quiz_attempts["summaries"] = quiz_attempts["summaries"]
+            # Keep the details of unchanged attempts, but drop those of
+            # attempts which no longer exist
+            details = {
+                **old_quiz_attempts["details"],
+                **quiz_attempts["details"]
+            }
+            old_quiz_attempts["details"] = {
+                str(summary["id"]): details[str(summary["id"])]
+                for summary in quiz_attempts["summaries"]
+                if str(summary["id"]) in details
+            }
+
+    return grades
+
+
+def _fingerprint(data):
+    data = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def usergrade_fingerprint(usergrade):
+    """Return a hash of a usergrades entry (as returned by
+    get_grades_by_course) which changes whenever any of its grade items do
+    """
+    return _fingerprint(usergrade)
+
+
+def _get_grades_base(
+    moodle_client, course_id, fingerprints=False, quizzes=None
+):
+    # Always pull latest grades and quiz data (unless the quizzes were
+    # prefetched). The grades data is the basis of the data object built
+    # from it.
+    new_grades = moodle_client.get_grades_by_course(course_id)
+    if quizzes is None:
+        quizzes = moodle_client.get_quizzes_by_courses([course_id])["quizzes"]
+
+    new_grades["quizzes"] = quizzes
+    if fingerprints:
+        new_grades["fingerprints"] = {
+            str(usergrade["userid"]): usergrade_fingerprint(usergrade)
+            for usergrade in new_grades["usergrades"]
+        }
+    return new_grades
+
+
+def _unchanged_user_ids(new_grades, old_grades):
+    """Return the IDs of users whose fingerprint in new_grades matches the
+    one in old_grades, whose old attempts can therefore be reused"""
+    new_fingerprints = new_grades.get("fingerprints", {})
+    old_fingerprints = old_grades.get("fingerprints", {})
+    return {
+        user_id for user_id, fingerprint in new_fingerprints.items()
+        if old_fingerprints.get(user_id) == fingerprint
+    }
+
+
+def _iter_user_attempts(
+    moodle_client, new_usergrades, old_attempts, max_workers=1,
+    attempt_cache=None, batch_size=GRADES_USER_BATCH_SIZE,
+    unchanged_user_ids=frozenset()
+):
+    """Yield (user_id, attempts) tuples in the order of new_usergrades where
+    attempts is the per quiz data stored under "attempts" by
+    update_grades_data. Users are processed in batches so that Moodle
+    requests for a batch can be made concurrently. The old attempts of
+    users in unchanged_user_ids are yielded as is, unless they include
+    attempts that were not graded yet.
+
+    Each batch pops its users' entries from old_attempts (a dict or the
+    attempts returned by read_grades_stream), so only the old data of one
+    batch is in use at a time.
+    """
+    for idx in range(0, len(new_usergrades), batch_size):
+        batch = new_usergrades[idx:idx + batch_size]
+        batch_old_attempts = {}
+        for usergrade in batch:
+            user_id = str(usergrade["userid"])
+            user_attempts = old_attempts.pop(user_id, None)
+            if user_attempts is not None:
+                batch_old_attempts[user_id] = user_attempts
+        # Summaries with ungraded attempts can change without the user's
+        # usergrades entry changing, so those users are always checked
+        reused_user_ids = {
+            user_id
+            for user_id in unchanged_user_ids & batch_old_attempts.keys()
+            if not any(
+                _has_ungraded_attempts(quiz_attempts["summaries"])
+                for quiz_attempts in batch_old_attempts[user_id].values()
+            )
+        }
+
+        batch_attempts = dict(_get_user_attempts_batch(
+            moodle_client,
+            [
+                usergrade for usergrade in batch
+                if str(usergrade["userid"]) not in reused_user_ids
+            ],
+            batch_old_attempts,
+            max_workers,
+            attempt_cache
+        ))
+        for usergrade in batch:
+            user_id = str(usergrade["userid"])
+            if user_id in reused_user_ids:
+                yield user_id, batch_old_attempts[user_id]
+            else:
+                yield user_id, batch_attempts[user_id]
+
+
+def _index_user_attempts(user_attempts):
+    """Map each quiz ID in a user's old attempts data to a tuple of the
+    latest gradednotificationsenttime of its attempt summaries (0 if none
+    were graded) and its attempt details"""
+    index = {}
+    for quiz_id, quiz_attempts in user_attempts.items():
+        latest_ts = 0
+        for summary in quiz_attempts.get("summaries", []):
+            attempt_ts = summary["gradednotificationsenttime"]
+            if attempt_ts is not None and attempt_ts > latest_ts:
+                latest_ts = attempt_ts
+        index[quiz_id] = (latest_ts, quiz_attempts.get("details", {}))
+    return index
+
+
+def _get_user_attempts_batch(
+    moodle_client, new_usergrades, old_attempts, max_workers, attempt_cache
+):
+    # Index the old attempts of the users in this batch once, rather than
+    # rescanning them for every lookup
+    old_index = {}
+    no_old_attempts = (0, {})
+
+    # Determine which user + quiz combos need their attempt summaries
+    # refreshed from Moodle. Data is stale if an attempt was submitted after
+    # the latest gradednotificationsenttime of the old summaries.
+    user_ids = []
+    user_quizzes = []
+    stale_user_quizzes = []
     for new_usergrade in new_usergrades:
         user_id = str(new_usergrade["userid"])
-        new_grades["attempts"][user_id] = {}
+        user_ids.append(user_id)
+        old_index[user_id] = _index_user_attempts(
+            old_attempts.get(user_id, {})
+        )
 
         for new_gradeitem in new_usergrade["gradeitems"]:
             gradedatesubmitted = new_gradeitem["gradedatesubmitted"]
@@ -342,37 +1262,84 @@ def update_grades_data(moodle_client, course_id, old_grades):
                 # Nothing more to do for this user + quiz combo
                 continue
             quiz_id = str(new_gradeitem["iteminstance"])
-            new_grades["attempts"][user_id][quiz_id] = {}
-            tmp_attempts = {}
-            if _attempts_data_is_stale(
-                old_attempts,
-                user_id,
-                quiz_id,
-                gradedatesubmitted
-            ):
-                # Fetch latest attempt summaries
-                data = moodle_client.get_user_quiz_attempts(user_id, quiz_id)
-                tmp_attempts["summaries"] = data["attempts"]
+            user_quizzes.append((user_id, quiz_id))
+            latest_ts, _ = old_index[user_id].get(quiz_id, no_old_attempts)
+            if gradedatesubmitted > latest_ts:
+                stale_user_quizzes.append((user_id, quiz_id))
+
+    fetched_summaries = dict(zip(
+        stale_user_quizzes,
+        _map_concurrently(
+            moodle_client.get_user_quiz_attempts,
+            stale_user_quizzes,
+            max_workers
+        )
+    ))
+
+    # Collect summaries (fetched or copied from the old dataset) and
+    # determine which attempt details are missing
+    all_summaries = {}
+    cached_details = {}
+    missing_attempt_ids = []
+    finalized_attempt_ids = set()
+    for user_id, quiz_id in user_quizzes:
+        if (user_id, quiz_id) in fetched_summaries:
+            # Use latest attempt summaries
+            summaries = fetched_summaries[(user_id, quiz_id)]["attempts"]
+        else:
+            # Copy data from old dataset
+            summaries = old_attempts[user_id][quiz_id]["summaries"]
+        all_summaries[(user_id, quiz_id)] = summaries
+
+        _, old_details = old_index[user_id].get(quiz_id, no_old_attempts)
+        for summary in summaries:
+            attempt_id = str(summary["id"])
+            if old_details.get(attempt_id):
+                continue
+            if attempt_cache is not None and attempt_is_finalized(summary):
+                finalized_attempt_ids.add(attempt_id)
+            missing_attempt_ids.append(attempt_id)
+
+    # Only details missing from the old dataset are looked up in the cache
+    if finalized_attempt_ids:
+        cached_details = attempt_cache.get_many(finalized_attempt_ids)
+        missing_attempt_ids = [
+            attempt_id for attempt_id in missing_attempt_ids
+            if attempt_id not in cached_details
+        ]
+
+    fetched_details = dict(zip(
+        missing_attempt_ids,
+        _map_concurrently(
+            moodle_client.get_quiz_attempt_details,
+            [(attempt_id,) for attempt_id in missing_attempt_ids],
+            max_workers
+        )
+    ))
+    if finalized_attempt_ids:
+        attempt_cache.put_many({
+            attempt_id: attempt_details
+            for attempt_id, attempt_details in fetched_details.items()
+            if attempt_id in finalized_attempt_ids
+        })
+
+    batch_attempts = {user_id: {} for user_id in user_ids}
+    for user_id, quiz_id in user_quizzes:
+        tmp_attempts = {}
+        tmp_attempts["summaries"] = all_summaries[(user_id, quiz_id)]
+        tmp_attempts["details"] = {}
+        _, old_details = old_index[user_id].get(quiz_id, no_old_attempts)
+        for summary in tmp_attempts["summaries"]:
+            attempt_id = str(summary["id"])
+            maybe_attempt_details = old_details.get(attempt_id) or \
+                cached_details.get(attempt_id)
+
+            if maybe_attempt_details:
+                attempt_details = maybe_attempt_details
             else:
-                # Copy data from old dataset
-                tmp_attempts["summaries"] = \
-                    old_attempts[user_id][quiz_id]["summaries"]
-
-            tmp_attempts["details"] = {}
-            for summary in tmp_attempts["summaries"]:
-                attempt_id = str(summary["id"])
-                maybe_attempt_details = old_attempts.get(user_id, {}).get(
-                    quiz_id,
-                    {}
-                ).get("details", {}).get(attempt_id)
-
-                if maybe_attempt_details:
-                    attempt_details = maybe_attempt_details
-                else:
-                    attempt_details = \
-                        moodle_client.get_quiz_attempt_details(attempt_id)
-                tmp_attempts["details"][attempt_id] = attempt_details
-
-            new_grades["attempts"][user_id][quiz_id] = tmp_attempts
+                attempt_details = fetched_details[attempt_id]
+            tmp_attempts["details"][attempt_id] = attempt_details
 
-    return new_grades
+        batch_attempts[user_id][quiz_id] = tmp_attempts
+
+    return batch_attempts.items()
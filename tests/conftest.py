@@ -0,0 +1,11 @@
+from moodlecli import aws
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def s3_storage(mocker):
+    """Give each test its own S3 storage so clients stubbed by one test are
+    not reused by another"""
+    storage = aws.S3Storage()
+    mocker.patch("moodlecli.aws._default_storage", storage)
+    return storage
@@ -1,6 +1,7 @@
 from moodlecli import aws
 import boto3
 import botocore.stub
+from boto3.s3.transfer import TransferConfig
 import io
 import json
 import pytest
@@ -79,3 +80,330 @@ def test_get_json_data_default_nonexisting(mocker):
     res = aws.get_json_data(test_bucket, test_key, test_data)
     stubber.assert_no_pending_responses()
     assert res == test_data
+
+
+def test_delete_objects(mocker):
+    s3_client = boto3.client("s3")
+    stubber = botocore.stub.Stubber(s3_client)
+
+    test_bucket = "test-bucket"
+    keys = [f"deltas/{idx}.json" for idx in range(1001)]
+
+    stubber.add_response(
+        "delete_objects",
+        {},
+        expected_params={
+            "Bucket": test_bucket,
+            "Delete": {
+                "Objects": [{"Key": key} for key in keys[:1000]],
+                "Quiet": True
+            }
+        }
+    )
+    stubber.add_response(
+        "delete_objects",
+        {},
+        expected_params={
+            "Bucket": test_bucket,
+            "Delete": {"Objects": [{"Key": keys[1000]}], "Quiet": True}
+        }
+    )
+    stubber.activate()
+    mocker.patch("boto3.client", lambda service: s3_client)
+
+    aws.delete_objects(test_bucket, keys)
+    stubber.assert_no_pending_responses()
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+def test_serialize_json_data_round_trip(compression):
+    test_data = {"foo": ["bar", 1, None]}
+
+    contents = aws.serialize_json_data(test_data, compression=compression)
+
+    assert aws.deserialize_json_data(contents) == test_data
+
+
+def test_serialize_json_data_ndjson():
+    test_data = [{"id": 1}, {"id": 2}]
+
+    contents = aws.serialize_json_data(test_data, aws.FORMAT_NDJSON)
+
+    assert contents == b'{"id": 1}\n{"id": 2}\n'
+    assert aws.deserialize_json_data(
+        contents,
+        content_type=aws.NDJSON_CONTENT_TYPE
+    ) == test_data
+
+
+def test_serialize_json_data_ndjson_requires_list():
+    with pytest.raises(ValueError):
+        aws.serialize_json_data({"foo": "bar"}, aws.FORMAT_NDJSON)
+
+
+def test_compressed_writer():
+    test_data = {"foo": "bar"}
+    f = io.BytesIO()
+
+    with aws.compressed_writer(f, "gzip") as writer:
+        writer.write(json.dumps(test_data).encode("utf-8"))
+
+    assert aws.deserialize_json_data(f.getvalue()) == test_data
+    assert not f.closed
+
+
+def test_put_json_data_compressed_ndjson(mocker):
+    s3_client = boto3.client("s3")
+    stubber = botocore.stub.Stubber(s3_client)
+
+    test_key = "data.ndjson.gz"
+    test_bucket = "test-bucket"
+    test_data = [{"id": 1}, {"id": 2}]
+
+    stubber.add_response(
+        "put_object",
+        {},
+        expected_params={
+            "Bucket": test_bucket,
+            "Key": test_key,
+            "Body": botocore.stub.ANY,
+            "ContentType": aws.NDJSON_CONTENT_TYPE,
+            "ContentEncoding": "gzip"
+        }
+    )
+    stubber.activate()
+    mocker.patch("boto3.client", lambda service: s3_client)
+
+    aws.put_json_data(
+        test_data,
+        test_bucket,
+        test_key,
+        output_format=aws.FORMAT_NDJSON,
+        compression="gzip"
+    )
+    stubber.assert_no_pending_responses()
+
+
+def test_get_json_data_compressed(mocker):
+    s3_client = boto3.client("s3")
+    stubber = botocore.stub.Stubber(s3_client)
+
+    test_key = "data.json.zst"
+    test_bucket = "test-bucket"
+    test_data = {"foo": "bar"}
+
+    stubber.add_response(
+        "get_object",
+        {
+            "Body": io.BytesIO(
+                aws.serialize_json_data(test_data, compression="zstd")
+            )
+        },
+        expected_params={
+            "Bucket": test_bucket,
+            "Key": test_key,
+        }
+    )
+    stubber.activate()
+    mocker.patch("boto3.client", lambda service: s3_client)
+
+    res = aws.get_json_data(test_bucket, test_key)
+    stubber.assert_no_pending_responses()
+    assert res == test_data
+
+
+def test_s3_storage_reuses_client(mocker):
+    s3_client = boto3.client("s3")
+    client_mock = mocker.patch("boto3.client", return_value=s3_client)
+
+    storage = aws.S3Storage()
+
+    assert storage.client is s3_client
+    assert storage.client is s3_client
+    client_mock.assert_called_once_with("s3")
+
+
+def test_put_json_file(mocker):
+    s3_client = boto3.client("s3")
+    stubber = botocore.stub.Stubber(s3_client)
+
+    test_key = "data.json.gz"
+    test_bucket = "test-bucket"
+
+    stubber.add_response(
+        "put_object",
+        {},
+        expected_params={
+            "Bucket": test_bucket,
+            "Key": test_key,
+            "Body": botocore.stub.ANY,
+            "ContentEncoding": "gzip"
+        }
+    )
+    stubber.activate()
+    mocker.patch("boto3.client", lambda service: s3_client)
+
+    contents = aws.serialize_json_data({"foo": "bar"}, compression="gzip")
+    aws.put_json_file(
+        io.BytesIO(contents),
+        test_bucket,
+        test_key,
+        compression="gzip"
+    )
+    stubber.assert_no_pending_responses()
+
+
+def test_put_json_data_multipart(mocker):
+    storage = aws.S3Storage(
+        TransferConfig(multipart_threshold=5 * 1024 * 1024)
+    )
+    upload_mock = mocker.patch.object(storage.client, "upload_fileobj")
+    put_mock = mocker.patch.object(storage.client, "put_object")
+    test_data = ["x" * 1024] * 6 * 1024
+
+    storage.put_json_data(test_data, "test-bucket", "data.json")
+
+    put_mock.assert_not_called()
+    upload_mock.assert_called_once()
+    fileobj = upload_mock.call_args.args[0]
+    assert json.loads(fileobj.getvalue()) == test_data
+    assert upload_mock.call_args.kwargs["Config"] is storage.transfer_config
+
+
+def test_put_json_data_skip_unchanged_digest(mocker):
+    s3_client = boto3.client("s3")
+    stubber = botocore.stub.Stubber(s3_client)
+
+    test_key = "data.json"
+    test_bucket = "test-bucket"
+    test_data = {"foo": "bar"}
+    sha256, _ = aws.content_digests(
+        io.BytesIO(aws.serialize_json_data(test_data))
+    )
+
+    stubber.add_response(
+        "head_object",
+        {"ETag": '"multipart-2"', "Metadata": {"sha256": sha256}},
+        expected_params={"Bucket": test_bucket, "Key": test_key}
+    )
+    stubber.activate()
+    mocker.patch("boto3.client", lambda service: s3_client)
+
+    assert not aws.put_json_data(
+        test_data,
+        test_bucket,
+        test_key,
+        skip_unchanged=True
+    )
+    stubber.assert_no_pending_responses()
+
+
+def test_put_json_data_skip_unchanged_etag(mocker):
+    s3_client = boto3.client("s3")
+    stubber = botocore.stub.Stubber(s3_client)
+
+    test_key = "data.json"
+    test_bucket = "test-bucket"
+    test_data = {"foo": "bar"}
+    _, md5 = aws.content_digests(
+        io.BytesIO(aws.serialize_json_data(test_data))
+    )
+
+    stubber.add_response(
+        "head_object",
+        {"ETag": f'"{md5}"'},
+        expected_params={"Bucket": test_bucket, "Key": test_key}
+    )
+    stubber.activate()
+    mocker.patch("boto3.client", lambda service: s3_client)
+
+    assert not aws.put_json_data(
+        test_data,
+        test_bucket,
+        test_key,
+        skip_unchanged=True
+    )
+    stubber.assert_no_pending_responses()
+
+
+@pytest.mark.parametrize("head_error", [None, "404"])
+def test_put_json_data_skip_unchanged_writes_changes(mocker, head_error):
+    s3_client = boto3.client("s3")
+    stubber = botocore.stub.Stubber(s3_client)
+
+    test_key = "data.json"
+    test_bucket = "test-bucket"
+    test_data = {"foo": "bar"}
+    binary_data = aws.serialize_json_data(test_data)
+    sha256, _ = aws.content_digests(io.BytesIO(binary_data))
+
+    if head_error is None:
+        stubber.add_response(
+            "head_object",
+            {"ETag": '"stale"', "Metadata": {"sha256": "stale"}},
+            expected_params={"Bucket": test_bucket, "Key": test_key}
+        )
+    else:
+        stubber.add_client_error(
+            "head_object",
+            service_error_code=head_error,
+            http_status_code=404,
+            expected_params={"Bucket": test_bucket, "Key": test_key}
+        )
+    stubber.add_response(
+        "put_object",
+        {},
+        expected_params={
+            "Bucket": test_bucket,
+            "Key": test_key,
+            "Body": binary_data,
+            "Metadata": {"sha256": sha256}
+        }
+    )
+    stubber.activate()
+    mocker.patch("boto3.client", lambda service: s3_client)
+
+    assert aws.put_json_data(
+        test_data,
+        test_bucket,
+        test_key,
+        skip_unchanged=True
+    )
+    stubber.assert_no_pending_responses()
+
+
+def test_serialize_json_data_gzip_deterministic():
+    test_data = {"foo": "bar"}
+
+    assert aws.serialize_json_data(test_data, compression="gzip") == \
+        aws.serialize_json_data(test_data, compression="gzip")
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+def test_download_file_decompressed(mocker, compression):
+    s3_client = boto3.client("s3")
+    stubber = botocore.stub.Stubber(s3_client)
+    test_data = {"foo": "bar" * 1000}
+
+    stubber.add_response(
+        "get_object",
+        {"Body": io.BytesIO(
+            aws.serialize_json_data(test_data, compression=compression)
+        )},
+        expected_params={"Bucket": "test-bucket", "Key": "data.json"}
+    )
+    stubber.add_client_error(
+        "get_object",
+        service_error_code="NoSuchKey",
+        expected_params={"Bucket": "test-bucket", "Key": "missing.json"}
+    )
+    stubber.activate()
+    mocker.patch("boto3.client", lambda service: s3_client)
+
+    fileobj = io.BytesIO()
+    assert aws.download_file("test-bucket", "data.json", fileobj)
+    fileobj.seek(0)
+    assert json.load(aws.decompressed_reader(fileobj)) == test_data
+
+    assert not aws.download_file("test-bucket", "missing.json", io.BytesIO())
+    stubber.assert_no_pending_responses()
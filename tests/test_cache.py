@@ -0,0 +1,155 @@
+from moodlecli import cache
+
+
+def test_attempt_is_finalized():
+    assert cache.attempt_is_finalized({"state": "finished"})
+    assert cache.attempt_is_finalized({"state": "abandoned"})
+    assert not cache.attempt_is_finalized({"state": "inprogress"})
+    assert not cache.attempt_is_finalized({})
+
+
+def test_attempt_cache_get_put(tmp_path):
+    path = tmp_path / "attempts.sqlite"
+    attempt_cache = cache.AttemptCache(path)
+
+    assert attempt_cache.get("101") is None
+    attempt_cache.put("101", {"attempt": {"id": 101}, "questions": []})
+    attempt_cache.put(102, {"attempt": {"id": 102}, "questions": []})
+    assert attempt_cache.get(101) == {"attempt": {"id": 101}, "questions": []}
+    attempt_cache.close()
+
+    # Entries persist across instances
+    attempt_cache = cache.AttemptCache(path)
+    assert attempt_cache.get("102") == {
+        "attempt": {"id": 102}, "questions": []
+    }
+    attempt_cache.close()
+
+
+def test_attempt_cache_evicts_least_recently_used(tmp_path, mocker):
+    clock = mocker.patch("moodlecli.cache.time.time")
+    clock.side_effect = range(100)
+    details = {"data": "x" * 100}
+    size = len(cache.json.dumps(details))
+    attempt_cache = cache.AttemptCache(tmp_path / "a.sqlite", size * 2)
+
+    attempt_cache.put("1", details)
+    attempt_cache.put("2", details)
+    assert attempt_cache.get("1") == details
+    attempt_cache.put("3", details)
+
+    assert attempt_cache.get("2") is None
+    assert attempt_cache.get("1") == details
+    assert attempt_cache.get("3") == details
+
+    # Replacing an entry does not count its old size
+    attempt_cache.put("3", details)
+    assert attempt_cache.get("1") == details
+    attempt_cache.close()
+
+
+def test_attempt_cache_defers_access_times(tmp_path, mocker):
+    clock = mocker.patch("moodlecli.cache.time.time")
+    clock.return_value = 1
+    path = tmp_path / "attempts.sqlite"
+    attempt_cache = cache.AttemptCache(path)
+    attempt_cache.put_many({"1": {"id": 1}, 2: {"id": 2}})
+
+    clock.return_value = 5
+    assert attempt_cache.get_many(["1", "2", "3"]) == {
+        "1": {"id": 1}, "2": {"id": 2}
+    }
+
+    def accessed():
+        conn = cache.sqlite3.connect(path)
+        rows = conn.execute(
+            "SELECT attempt_id, accessed FROM attempt_details "
+            "ORDER BY attempt_id"
+        ).fetchall()
+        conn.close()
+        return rows
+
+    assert accessed() == [("1", 1), ("2", 1)]
+    attempt_cache.close()
+    assert accessed() == [("1", 5), ("2", 5)]
+
+
+def test_metadata_cache_expires(mocker):
+    clock = mocker.patch("moodlecli.cache.time.time")
+    clock.return_value = 1000
+    metadata_cache = cache.MetadataCache(ttl=60)
+
+    assert metadata_cache.get("role", "student") is None
+    metadata_cache.put("role", "student", {"id": 5})
+    clock.return_value = 1059
+    assert metadata_cache.get("role", "student") == {"id": 5}
+    clock.return_value = 1060
+    assert metadata_cache.get("role", "student") is None
+
+
+def test_metadata_cache_invalidate():
+    metadata_cache = cache.MetadataCache()
+
+    metadata_cache.put("role", "student", {"id": 5})
+    metadata_cache.put("methods", [1, 5], [{"id": 7}])
+    metadata_cache.invalidate("methods")
+
+    assert metadata_cache.get("role", "student") == {"id": 5}
+    assert metadata_cache.get("methods", [1, 5]) is None
+
+
+def test_metadata_cache_persists(tmp_path, mocker):
+    clock = mocker.patch("moodlecli.cache.time.time")
+    clock.return_value = 1000
+    path = tmp_path / "metadata.json"
+    metadata_cache = cache.MetadataCache(path, ttl=60)
+
+    metadata_cache.put("role", "student", {"id": 5})
+    metadata_cache.put("role", "teacher", {"id": 3})
+    clock.return_value = 1030
+    metadata_cache.put("role", "manager", {"id": 1})
+    clock.return_value = 1070
+    metadata_cache.save()
+
+    # Expired entries are not saved
+    metadata_cache = cache.MetadataCache(path, ttl=60)
+    assert metadata_cache.get("role", "manager") == {"id": 1}
+    assert metadata_cache._entries.keys() == {'role:"manager"'}
+
+
+def test_user_uuid_cache(tmp_path):
+    path = tmp_path / "uuids.sqlite"
+    uuid_cache = cache.UserUUIDCache(path)
+
+    assert uuid_cache.get_many([1, 2]) == {}
+    uuid_cache.put_many({1: "a", "2": "b"})
+    assert uuid_cache.get_many(["1", 2, 3]) == {1: "a", 2: "b"}
+    uuid_cache.close()
+
+    uuid_cache = cache.UserUUIDCache(path)
+    assert uuid_cache.get_many(range(1000)) == {1: "a", 2: "b"}
+    uuid_cache.close()
+
+
+def test_roster_cache_expires(tmp_path, mocker):
+    clock = mocker.patch("moodlecli.cache.time.time")
+    clock.return_value = 1000
+    path = tmp_path / "rosters.sqlite"
+    roster_cache = cache.RosterCache(path, ttl=60)
+
+    assert roster_cache.get(2) is None
+    roster_cache.put(2, None, [{"id": 1}])
+    roster_cache.put("2", ["id", "email"], [{"id": 1, "email": "a@x.com"}])
+    roster_cache.close()
+
+    # Snapshots persist across instances and are keyed by user fields
+    roster_cache = cache.RosterCache(path, ttl=60)
+    clock.return_value = 1059
+    assert roster_cache.get("2") == [{"id": 1}]
+    assert roster_cache.get(2, ["email", "id"]) == [
+        {"id": 1, "email": "a@x.com"}
+    ]
+    assert roster_cache.get(2, ["id"]) is None
+    clock.return_value = 1060
+    assert roster_cache.get(2) is None
+    roster_cache.close()
@@ -0,0 +1,65 @@
+from moodlecli import checkpoint
+import pytest
+
+
+def test_open_journal():
+    assert isinstance(checkpoint.open_journal(None), checkpoint.NullJournal)
+    assert isinstance(
+        checkpoint.open_journal("run.checkpoint"),
+        checkpoint.FileJournal
+    )
+    journal = checkpoint.open_journal("s3://bucket/path/run.json")
+    assert (journal.bucket_name, journal.key) == ("bucket", "path/run.json")
+    with pytest.raises(ValueError):
+        checkpoint.open_journal("s3://bucket")
+
+
+def test_checkpoint_s3_journal(mocker):
+    objects = {}
+
+    def put_json_data(data, bucket_name, key):
+        objects[(bucket_name, key)] = data
+
+    def get_json_data(bucket_name, key, default=None):
+        return objects.get((bucket_name, key), default)
+
+    mocker.patch("moodlecli.aws.put_json_data", side_effect=put_json_data)
+    mocker.patch("moodlecli.aws.get_json_data", side_effect=get_json_data)
+
+    run_checkpoint = checkpoint.Checkpoint(
+        checkpoint.S3Journal("bucket", "run.json", flush_items=3),
+        "scope",
+        resume=True
+    )
+    run_checkpoint.mark_done(1, "2")
+    run_checkpoint.mark_done(2)
+    # Items are buffered until enough of them have been recorded
+    assert objects[("bucket", "run.json")]["done"] == []
+    run_checkpoint.mark_done(3)
+    assert objects[("bucket", "run.json")] == {
+        "scope": "scope",
+        "done": ["1", "2", "3"]
+    }
+    run_checkpoint.mark_done(4)
+    run_checkpoint.close()
+    assert objects[("bucket", "run.json")]["done"] == ["1", "2", "3", "4"]
+
+    run_checkpoint = checkpoint.Checkpoint(
+        checkpoint.S3Journal("bucket", "run.json", flush_interval=0),
+        "scope",
+        resume=True
+    )
+    assert run_checkpoint.pending([1, 2, 3, 4, 5]) == [5]
+    # Items are written once flush_interval has passed
+    run_checkpoint.mark_done(5)
+    assert objects[("bucket", "run.json")]["done"] == [
+        "1", "2", "3", "4", "5"
+    ]
+
+    # Without resume the journal is started from scratch
+    run_checkpoint = checkpoint.Checkpoint(
+        checkpoint.S3Journal("bucket", "run.json"),
+        "scope"
+    )
+    assert run_checkpoint.pending([1, 2, 3]) == [1, 2, 3]
+    assert objects[("bucket", "run.json")]["done"] == []
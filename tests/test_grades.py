@@ -1,5 +1,6 @@
-from moodlecli import utils, moodle
+from moodlecli import aws, utils, moodle, cache
 import pytest
+import io
 import json
 import csv
 from click.testing import CliRunner
@@ -288,6 +289,655 @@ def test_update_grades_data_stale_cache(moodle_mock):
     }
 
 
+def test_update_grades_data_concurrent_matches_serial(mocker):
+    moodle_mock = mocker.Mock()
+    moodle_mock.get_grades_by_course.side_effect = lambda course_id: {
+        "usergrades": [
+            {
+                "userid": user_id,
+                "gradeitems": [
+                    {"iteminstance": 21, "gradedatesubmitted": 33},
+                    {"iteminstance": 22, "gradedatesubmitted": 44},
+                    {"iteminstance": 23, "gradedatesubmitted": None}
+                ]
+            }
+            for user_id in range(10, 20)
+        ]
+    }
+    moodle_mock.get_quizzes_by_courses.return_value = {
+        "quizzes": [{"name": "Quiz 1", "sumgrades": 10}]
+    }
+    moodle_mock.get_user_quiz_attempts.side_effect = \
+        lambda user_id, quiz_id: {
+            "attempts": [
+                {
+                    "id": int(f"{user_id}{quiz_id}{attempt}"),
+                    "attempt": attempt,
+                    "gradednotificationsenttime": 44
+                }
+                for attempt in range(2)
+            ]
+        }
+    moodle_mock.get_quiz_attempt_details.side_effect = \
+        lambda attempt_id: {"attempt": {"id": attempt_id}, "questions": []}
+    old_grades = {
+        "attempts": {
+            "10": {
+                "21": {
+                    "summaries": [
+                        {
+                            "id": 10210,
+                            "attempt": 0,
+                            "gradednotificationsenttime": 33
+                        }
+                    ],
+                    "details": {
+                        "10210": {"attempt": {"id": "cached"}, "questions": []}
+                    }
+                }
+            }
+        }
+    }
+
+    serial_res = utils.update_grades_data(moodle_mock, 10, old_grades)
+    serial_calls = moodle_mock.get_quiz_attempt_details.call_count
+    moodle_mock.get_quiz_attempt_details.reset_mock()
+
+    concurrent_res = utils.update_grades_data(
+        moodle_mock, 10, old_grades, max_workers=4
+    )
+
+    assert json.dumps(concurrent_res) == json.dumps(serial_res)
+    assert moodle_mock.get_quiz_attempt_details.call_count == serial_calls
+    assert serial_calls == 38
+    assert concurrent_res["attempts"]["10"]["21"]["details"]["10210"] == \
+        {"attempt": {"id": "cached"}, "questions": []}
+
+
+def test_update_grades_data_attempt_cache(moodle_mock, tmp_path):
+    moodle_mock.get_user_quiz_attempts.return_value = {
+        "attempts": [
+            {
+                "id": 101,
+                "attempt": 1,
+                "state": "finished",
+                "gradednotificationsenttime": 22
+            },
+            {
+                "id": 102,
+                "attempt": 2,
+                "state": "inprogress",
+                "gradednotificationsenttime": 33
+            }
+        ]
+    }
+    attempt_cache = cache.AttemptCache(tmp_path / "attempts.sqlite")
+
+    res = utils.update_grades_data(
+        moodle_mock, 10, {}, attempt_cache=attempt_cache
+    )
+    assert moodle_mock.get_quiz_attempt_details.call_count == 2
+    assert attempt_cache.get("101") == {"attempt": {}, "questions": []}
+    assert attempt_cache.get("102") is None
+
+    # Only the attempt which is not finalized is requested again
+    moodle_mock.get_quiz_attempt_details.reset_mock()
+    moodle_mock.get_grades_by_course.return_value.pop("attempts")
+    cached_res = utils.update_grades_data(
+        moodle_mock, 10, {}, attempt_cache=attempt_cache
+    )
+    moodle_mock.get_quiz_attempt_details.assert_called_once_with("102")
+    assert cached_res == res
+    attempt_cache.close()
+
+
+def test_update_grades_data_prefetched_quizzes(moodle_mock):
+    quizzes = [{"name": "Quiz 2", "sumgrades": 5}]
+
+    res = utils.update_grades_data(moodle_mock, 10, {}, quizzes=quizzes)
+
+    moodle_mock.get_quizzes_by_courses.assert_not_called()
+    assert res["quizzes"] == quizzes
+
+
+def test_update_grades_data_attempt_cache_after_old_grades(
+    moodle_mock, mocker
+):
+    usergrades = moodle_mock.get_grades_by_course.return_value
+    moodle_mock.get_grades_by_course.side_effect = \
+        lambda course_id: json.loads(json.dumps(usergrades))
+    old_grades = utils.update_grades_data(moodle_mock, 10, {})
+    moodle_mock.get_quiz_attempt_details.reset_mock()
+    # The summaries are refreshed and report a finalized attempt
+    moodle_mock.get_user_quiz_attempts.return_value["attempts"][0][
+        "state"
+    ] = "finished"
+    usergrades["usergrades"][0]["gradeitems"][0]["gradedatesubmitted"] = 34
+    attempt_cache = mocker.Mock()
+
+    res = utils.update_grades_data(
+        moodle_mock, 10, old_grades, attempt_cache=attempt_cache
+    )
+
+    # Details found in old_grades are neither looked up nor fetched
+    attempt_cache.get_many.assert_not_called()
+    moodle_mock.get_quiz_attempt_details.assert_not_called()
+    assert res["attempts"]["11"]["22"]["details"] == \
+        old_grades["attempts"]["11"]["22"]["details"]
+
+
+def test_write_grades_data_matches_update_grades_data(moodle_mock):
+    old_grades = {
+        "attempts": {
+            "11": {
+                "22": {
+                    "summaries": [
+                        {
+                            "id": 101,
+                            "attempt": 1,
+                            "gradednotificationsenttime": 22
+                        }
+                    ],
+                    "details": {
+                        "101": {"attempt": {"cached": True}, "questions": []}
+                    }
+                }
+            },
+            "12": {}
+        }
+    }
+    usergrades = moodle_mock.get_grades_by_course.return_value
+    moodle_mock.get_grades_by_course.side_effect = \
+        lambda course_id: json.loads(json.dumps(usergrades))
+    expected = utils.update_grades_data(
+        moodle_mock, 10, json.loads(json.dumps(old_grades))
+    )
+
+    output = io.BytesIO()
+    utils.write_grades_data(moodle_mock, 10, old_grades, output)
+
+    assert output.getvalue() == json.dumps(expected).encode("utf-8")
+    assert list(old_grades["attempts"].keys()) == ["12"]
+
+
+def test_update_grades_data_fingerprints(moodle_mock):
+    usergrades = [
+        {
+            "userid": 11,
+            "gradeitems": [{"iteminstance": 22, "gradedatesubmitted": 33}]
+        },
+        {
+            "userid": 12,
+            "gradeitems": [{"iteminstance": 22, "gradedatesubmitted": 34}]
+        }
+    ]
+    moodle_mock.get_grades_by_course.side_effect = \
+        lambda course_id: {"usergrades": json.loads(json.dumps(usergrades))}
+
+    old_grades = utils.update_grades_data(
+        moodle_mock, 10, {}, fingerprints=True
+    )
+    assert list(old_grades.keys()) == [
+        "usergrades", "quizzes", "fingerprints", "attempts"
+    ]
+    assert old_grades["fingerprints"] == {
+        "11": utils.usergrade_fingerprint(usergrades[0]),
+        "12": utils.usergrade_fingerprint(usergrades[1])
+    }
+    assert old_grades["fingerprints"]["11"] != \
+        old_grades["fingerprints"]["12"]
+
+    # Only user 12 has new grades, so user 11's attempts are carried over
+    # without checking them
+    usergrades[1]["gradeitems"][0]["gradedatesubmitted"] = 40
+    moodle_mock.get_user_quiz_attempts.reset_mock()
+    res = utils.update_grades_data(
+        moodle_mock, 10, old_grades, fingerprints=True
+    )
+    moodle_mock.get_user_quiz_attempts.assert_called_once_with("12", "22")
+    assert res["attempts"]["11"] is old_grades["attempts"]["11"]
+    assert res["fingerprints"]["12"] == utils.usergrade_fingerprint(
+        usergrades[1]
+    )
+
+    # The streamed output is the same
+    moodle_mock.get_user_quiz_attempts.reset_mock()
+    output = io.BytesIO()
+    utils.write_grades_data(
+        moodle_mock,
+        10,
+        json.loads(json.dumps(old_grades)),
+        output,
+        fingerprints=True
+    )
+    moodle_mock.get_user_quiz_attempts.assert_called_once_with("12", "22")
+    assert output.getvalue() == json.dumps(res).encode("utf-8")
+
+
+def test_update_grades_data_fingerprints_ungraded_attempts(moodle_mock):
+    moodle_mock.get_user_quiz_attempts.return_value = {
+        "attempts": [
+            {"id": 101, "attempt": 1, "gradednotificationsenttime": 22},
+            {"id": 102, "attempt": 2, "gradednotificationsenttime": None}
+        ]
+    }
+    old_grades = utils.update_grades_data(
+        moodle_mock, 10, {}, fingerprints=True
+    )
+
+    # The fingerprint is unchanged, but attempt 102 may have been graded
+    # since, so the user's summaries are checked again
+    moodle_mock.get_user_quiz_attempts.reset_mock()
+    moodle_mock.get_user_quiz_attempts.return_value = {
+        "attempts": [
+            {"id": 101, "attempt": 1, "gradednotificationsenttime": 22},
+            {"id": 102, "attempt": 2, "gradednotificationsenttime": 40}
+        ]
+    }
+    res = utils.update_grades_data(
+        moodle_mock, 10, old_grades, fingerprints=True
+    )
+
+    moodle_mock.get_user_quiz_attempts.assert_called_once_with("11", "22")
+    assert res["attempts"]["11"]["22"]["summaries"][1][
+        "gradednotificationsenttime"
+    ] == 40
+
+
+def test_export_grades_stream(moodle_requests_mock, tmp_path, mocker):
+    runner = CliRunner()
+    uploaded = {}
+
+    def put_json_file(fileobj, bucket_name, key, compression=None,
+                      skip_unchanged=False):
+        uploaded[(bucket_name, key)] = json.loads(fileobj.read())
+        return True
+
+    mocker.patch("moodlecli.aws.download_file", return_value=False)
+    mocker.patch("moodlecli.aws.put_json_file", side_effect=put_json_file)
+
+    result = runner.invoke(
+        cli,
+        ["export-grades", "21", "test-bucket", "grades.json", "--stream",
+         "--attempt-cache", str(tmp_path / "attempts.sqlite")],
+        env=TEST_ENV
+    )
+
+    assert result.exit_code == 0
+    assert uploaded[("test-bucket", "grades.json")]["attempts"] == {
+        "11": {
+            "22": {
+                "summaries": [
+                    {
+                        "id": 101,
+                        "attempt": 1,
+                        "gradednotificationsenttime": 22
+                    },
+                    {
+                        "id": 102,
+                        "attempt": 2,
+                        "gradednotificationsenttime": 33
+                    }
+                ],
+                "details": {
+                    "101": {"attempt": {}, "questions": []},
+                    "102": {"attempt": {}, "questions": []}
+                }
+            }
+        }
+    }
+
+
+def test_read_grades_stream(moodle_mock):
+    old_grades = {
+        "attempts": {
+            "11": {"22": {"summaries": [], "details": {}}},
+            "12": {},
+            "13": {"22": {"summaries": [{"id": 1}], "details": {"1": "x"}}}
+        }
+    }
+    output = io.BytesIO()
+    utils.write_grades_data(
+        moodle_mock, 10, json.loads(json.dumps(old_grades)), output
+    )
+    expected = json.loads(output.getvalue())
+    expected["usergrades"] = [
+        {"userid": user_id, "gradeitems": []} for user_id in (11, 12, 13)
+    ]
+    expected["attempts"] = old_grades["attempts"]
+    output = io.BytesIO(
+        json.dumps(expected, indent=1).encode("utf-8")
+    )
+
+    # Small blocks make values span several reads
+    grades = utils.read_grades_stream(output, block_size=7)
+
+    assert grades["usergrades"] == expected["usergrades"]
+    assert grades["quizzes"] == expected["quizzes"]
+    assert grades["attempts"].pop("13") == old_grades["attempts"]["13"]
+    assert grades["attempts"].pop("11") == old_grades["attempts"]["11"]
+    assert grades["attempts"].pop("14") is None
+    assert grades["attempts"].pop("12") == {}
+
+
+def test_read_grades_stream_new_user():
+    old_grades = {
+        "usergrades": [
+            {"userid": user_id, "gradeitems": []} for user_id in range(10)
+        ],
+        "attempts": {str(user_id): {} for user_id in range(10)}
+    }
+    grades = utils.read_grades_stream(
+        io.BytesIO(json.dumps(old_grades).encode("utf-8"))
+    )
+
+    # Users who weren't in the previous export are known to be missing, so
+    # the attempts of later users aren't read looking for them
+    assert grades["attempts"].pop("0") == {}
+    assert grades["attempts"].pop("new_user") is None
+    assert grades["attempts"]._skipped == {}
+    assert grades["attempts"].pop("1") == {}
+    assert grades["attempts"]._skipped == {}
+
+
+def test_export_grades_stream_previous_export(
+    moodle_requests_mock, requests_mock, mocker
+):
+    runner = CliRunner()
+    details = {"attempt": {"cached": True}, "questions": []}
+    previous = {
+        "usergrades": [
+            {
+                "userid": 11,
+                "gradeitems": [{"iteminstance": 22, "gradedatesubmitted": 33}]
+            }
+        ],
+        "quizzes": [],
+        "attempts": {
+            "11": {
+                "22": {
+                    "summaries": [
+                        {
+                            "id": 101,
+                            "attempt": 1,
+                            "gradednotificationsenttime": 22
+                        },
+                        {
+                            "id": 102,
+                            "attempt": 2,
+                            "gradednotificationsenttime": 33
+                        }
+                    ],
+                    "details": {"101": details, "102": details}
+                }
+            }
+        }
+    }
+    uploaded = {}
+
+    def download_file(bucket_name, key, fileobj):
+        fileobj.write(aws.serialize_json_data(previous, compression="gzip"))
+        return True
+
+    def put_json_file(fileobj, bucket_name, key, compression=None,
+                      skip_unchanged=False):
+        uploaded[key] = json.loads(fileobj.read())
+        return True
+
+    mocker.patch("moodlecli.aws.download_file", side_effect=download_file)
+    mocker.patch("moodlecli.aws.put_json_file", side_effect=put_json_file)
+
+    result = runner.invoke(
+        cli,
+        ["export-grades", "21", "test-bucket", "grades.json", "--stream"],
+        env=TEST_ENV
+    )
+
+    assert result.exit_code == 0
+    assert uploaded["grades.json"]["attempts"] == previous["attempts"]
+    # Everything was reused from the previous export
+    assert [
+        request.qs["wsfunction"] for request in requests_mock.request_history
+    ] == [
+        [moodle.MOODLE_FUNC_GRADEREPORT_USER_GET_GRADE_ITEMS],
+        [moodle.MOODLE_FUNC_GET_QUIZZES_BY_COURSES]
+    ]
+
+
+def test_grades_watermark():
+    assert utils.grades_watermark({}) == 0
+    assert utils.grades_watermark({
+        "usergrades": [
+            {"userid": 1, "gradeitems": [{"gradedatesubmitted": None}]},
+            {"userid": 2, "gradeitems": [{"gradedatesubmitted": 33},
+                                         {"gradedatesubmitted": 21}]}
+        ]
+    }) == 33
+
+
+def test_build_and_merge_grades_delta(moodle_mock):
+    old_grades = {
+        "usergrades": [
+            {
+                "userid": 11,
+                "gradeitems": [
+                    {"iteminstance": 22, "gradedatesubmitted": 22},
+                    {"iteminstance": 23, "gradedatesubmitted": None}
+                ]
+            },
+            {
+                # Left the course before the delta was built
+                "userid": 12,
+                "gradeitems": [{"iteminstance": 22, "gradedatesubmitted": 5}]
+            }
+        ],
+        "quizzes": [{"name": "Quiz 1", "sumgrades": 10}],
+        "attempts": {
+            "11": {
+                "22": {
+                    "summaries": [
+                        {
+                            "id": 101,
+                            "attempt": 1,
+                            "gradednotificationsenttime": 22
+                        }
+                    ],
+                    "details": {
+                        "101": {"attempt": {}, "questions": []}
+                    }
+                }
+            },
+            "12": {
+                "22": {
+                    "summaries": [
+                        {
+                            "id": 201,
+                            "attempt": 1,
+                            "gradednotificationsenttime": 5
+                        }
+                    ],
+                    "details": {
+                        "201": {"attempt": {}, "questions": []}
+                    }
+                }
+            }
+        }
+    }
+
+    usergrades = moodle_mock.get_grades_by_course.return_value
+    moodle_mock.get_grades_by_course.side_effect = \
+        lambda course_id: json.loads(json.dumps(usergrades))
+
+    delta, state = utils.build_grades_delta(
+        moodle_mock, 10, utils.grades_delta_state(old_grades)
+    )
+
+    assert state["watermark"] == 33
+    assert delta["since"] == 22
+    assert delta["watermark"] == 33
+    assert delta["removed"] == ["12"]
+    assert "12" not in state["fingerprints"]
+    moodle_mock.get_user_quiz_attempts.assert_called_once_with("11", "22")
+    # The details of attempt 101 are known and its summary is unchanged
+    assert moodle_mock.get_quiz_attempt_details.call_args_list == [
+        (("102",),)
+    ]
+    assert list(delta["attempts"]["11"]["22"]["details"]) == ["102"]
+
+    merged = utils.merge_grades_delta(old_grades, delta)
+    expected = utils.update_grades_data(moodle_mock, 10, {})
+    assert merged == expected
+
+
+def test_merge_grades_delta_drops_fingerprints():
+    grades = {
+        "usergrades": [{"userid": 11}, {"userid": 12}],
+        "fingerprints": {"11": "a", "12": "b"}
+    }
+    delta = {
+        "usergrades": [{"userid": 12}],
+        "quizzes": [],
+        "attempts": {},
+        "removed": []
+    }
+
+    merged = utils.merge_grades_delta(grades, delta)
+
+    assert merged["fingerprints"] == {"11": "a"}
+
+
+def test_build_grades_delta_no_changes(moodle_mock):
+    state = utils.grades_delta_state(
+        utils.update_grades_data(moodle_mock, 10, {})
+    )
+    moodle_mock.get_user_quiz_attempts.reset_mock()
+
+    delta, new_state = utils.build_grades_delta(moodle_mock, 10, state)
+
+    assert new_state == state
+    assert delta["usergrades"] == []
+    assert delta["attempts"] == {}
+    moodle_mock.get_user_quiz_attempts.assert_not_called()
+
+
+def test_build_grades_delta_regrade(moodle_mock):
+    usergrades = moodle_mock.get_grades_by_course.return_value
+    gradeitem = usergrades["usergrades"][0]["gradeitems"][0]
+    gradeitem.update({"graderaw": 5, "gradedategraded": 40})
+    moodle_mock.get_grades_by_course.side_effect = \
+        lambda course_id: json.loads(json.dumps(usergrades))
+    grades = utils.update_grades_data(moodle_mock, 10, {})
+    state = utils.grades_delta_state(grades)
+    assert state["watermark"] == 40
+
+    # A regrade changes the grade but not gradedatesubmitted, and the
+    # sumgrades of the regraded attempt
+    gradeitem.update({"graderaw": 9, "gradedategraded": 99})
+    moodle_mock.get_user_quiz_attempts.return_value["attempts"][1][
+        "sumgrades"
+    ] = 9
+    moodle_mock.get_quiz_attempt_details.reset_mock()
+    moodle_mock.get_quiz_attempt_details.return_value = {
+        "attempt": {"sumgrades": 9}, "questions": []
+    }
+    delta, state = utils.build_grades_delta(moodle_mock, 10, state)
+
+    assert state["watermark"] == 99
+    assert delta["usergrades"][0]["gradeitems"][0]["graderaw"] == 9
+    merged = utils.merge_grades_delta(grades, delta)
+    assert merged["usergrades"][0]["gradeitems"][0]["graderaw"] == 9
+    assert merged["attempts"]["11"]["22"]["details"]["102"] == {
+        "attempt": {"sumgrades": 9}, "questions": []
+    }
+    moodle_mock.get_quiz_attempt_details.assert_called_once_with("102")
+
+
+def test_build_grades_delta_ungraded_attempts(moodle_mock):
+    summaries = [
+        {"id": 101, "attempt": 1, "gradednotificationsenttime": 22},
+        {"id": 102, "attempt": 2, "gradednotificationsenttime": None}
+    ]
+    moodle_mock.get_user_quiz_attempts.side_effect = \
+        lambda user_id, quiz_id: {
+            "attempts": json.loads(json.dumps(summaries))
+        }
+    usergrades = moodle_mock.get_grades_by_course.return_value
+    moodle_mock.get_grades_by_course.side_effect = \
+        lambda course_id: json.loads(json.dumps(usergrades))
+    state = utils.grades_delta_state(
+        utils.update_grades_data(moodle_mock, 10, {})
+    )
+    assert list(state["pending"].keys()) == ["11/22"]
+
+    # Summaries with ungraded attempts are checked on every run but only
+    # included in a delta once they change
+    moodle_mock.get_user_quiz_attempts.reset_mock()
+    delta, state = utils.build_grades_delta(moodle_mock, 10, state)
+    moodle_mock.get_user_quiz_attempts.assert_called_once_with("11", "22")
+    assert delta["attempts"] == {}
+
+    summaries[1]["gradednotificationsenttime"] = 50
+    delta, state = utils.build_grades_delta(moodle_mock, 10, state)
+    assert delta["attempts"]["11"]["22"]["summaries"] == summaries
+    assert delta["watermark"] == 50
+    assert state["pending"] == {}
+
+
+def test_export_grades_incremental_and_compact(moodle_requests_mock, mocker):
+    runner = CliRunner()
+    objects = {}
+
+    def get_json_data(bucket_name, key, default=None):
+        if key in objects:
+            return json.loads(objects[key])
+        if default is not None:
+            return default
+        raise Exception("NoSuchKey")
+
+    def put_json_data(data, bucket_name, key, **kwargs):
+        objects[key] = json.dumps(data)
+
+    def delete_objects(bucket_name, keys):
+        for key in keys:
+            del objects[key]
+
+    mocker.patch("moodlecli.aws.get_json_data", side_effect=get_json_data)
+    mocker.patch("moodlecli.aws.put_json_data", side_effect=put_json_data)
+    mocker.patch("moodlecli.aws.delete_objects", side_effect=delete_objects)
+
+    for _ in range(2):
+        result = runner.invoke(
+            cli,
+            ["export-grades", "21", "test-bucket", "grades.json",
+             "--incremental"],
+            env=TEST_ENV
+        )
+        assert result.exit_code == 0
+
+    # The second run had no changes so nothing new was written
+    manifest = json.loads(objects["grades.json.manifest.json"])
+    assert manifest["watermark"] == 33
+    assert manifest["deltas"] == ["grades.json.deltas/33.json"]
+    assert "grades.json" not in objects
+
+    result = runner.invoke(
+        cli,
+        ["compact-grades", "test-bucket", "grades.json"],
+        env=TEST_ENV
+    )
+    assert result.exit_code == 0
+    assert sorted(objects.keys()) == [
+        "grades.json", "grades.json.manifest.json"
+    ]
+    assert json.loads(objects["grades.json.manifest.json"])["deltas"] == []
+    assert json.loads(objects["grades.json"])["attempts"]["11"]["22"][
+        "details"
+    ] == {
+        "101": {"attempt": {}, "questions": []},
+        "102": {"attempt": {}, "questions": []}
+    }
+
+
 def test_export_grades(moodle_requests_mock, tmp_path, mocker):
     runner = CliRunner()
 
@@ -359,6 +1009,77 @@ def test_export_grades(moodle_requests_mock, tmp_path, mocker):
     stubber.assert_no_pending_responses()
 
 
+def test_export_grades_max_workers(moodle_requests_mock, tmp_path, mocker):
+    runner = CliRunner()
+
+    s3_client = boto3.client("s3")
+    stubber = botocore.stub.Stubber(s3_client)
+
+    test_key = "/grades/course1.json"
+    test_bucket = "test-bucket"
+
+    stubber.add_client_error(
+        "get_object",
+        service_error_code="NoSuchKey",
+        expected_params={
+            "Bucket": test_bucket,
+            "Key": test_key,
+        },
+    )
+
+    expected_put_data = {
+        "usergrades": [
+            {
+                "userid": 11,
+                "gradeitems": [
+                    {"iteminstance": 22, "gradedatesubmitted": 33}
+                ]
+            }
+        ],
+        "quizzes": [{"name": "Quiz 1", "sumgrades": 10}],
+        "attempts": {
+            "11": {
+                "22": {
+                    "summaries": [
+                        {
+                            "id": 101,
+                            "attempt": 1,
+                            "gradednotificationsenttime": 22
+                        },
+                        {
+                            "id": 102,
+                            "attempt": 2,
+                            "gradednotificationsenttime": 33
+                        }
+                    ],
+                    "details": {
+                        "101": {"attempt": {}, "questions": []},
+                        "102": {"attempt": {}, "questions": []}
+                    }
+                }
+            }
+        }
+    }
+
+    expected_params = {
+        "Bucket": test_bucket,
+        "Body": json.dumps(expected_put_data).encode("utf-8"),
+        "Key": test_key
+    }
+    stubber.add_response("put_object", {}, expected_params)
+    stubber.activate()
+    mocker.patch("boto3.client", lambda service: s3_client)
+
+    result = runner.invoke(
+        cli,
+        ["export-grades", "21", test_bucket, test_key, "--max-workers", "2"],
+        env=TEST_ENV
+    )
+
+    assert result.exit_code == 0
+    stubber.assert_no_pending_responses()
+
+
 def test_export_bulk_grades(moodle_requests_mock, tmp_path, mocker):
     runner = CliRunner()
 
@@ -437,3 +1158,85 @@ def test_export_bulk_grades(moodle_requests_mock, tmp_path, mocker):
 
         assert result_grades.exit_code == 0
         stubber.assert_no_pending_responses()
+
+
+def test_export_bulk_grades_prefetch_quizzes(
+    moodle_requests_mock, requests_mock, tmp_path, mocker
+):
+    def get_quizzes(request, context):
+        course_ids = [
+            int(value[0]) for key, value in request.qs.items()
+            if key.startswith("courseids")
+        ]
+        return {"quizzes": [
+            {"id": course_id * 10, "course": course_id}
+            for course_id in course_ids
+        ]}
+
+    requests_mock.get(
+        f"{TEST_MOODLE_URL}{moodle.MOODLE_WEBSERVICE_PATH}",
+        json=get_quizzes,
+        additional_matcher=lambda request: request.qs["wsfunction"] == [
+            moodle.MOODLE_FUNC_GET_QUIZZES_BY_COURSES
+        ]
+    )
+    mocker.patch("moodlecli.aws.get_json_data", return_value={})
+    put_json_data = mocker.patch(
+        "moodlecli.aws.put_json_data",
+        return_value=True
+    )
+    runner = CliRunner()
+
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        with open("courses.csv", "w") as f:
+            writer = csv.DictWriter(f, utils.bulk_export_csv_course_ids())
+            writer.writeheader()
+            writer.writerows([
+                {utils.CSV_COURSE_ID: course_id} for course_id in (1, 2, 3)
+            ])
+
+        result = runner.invoke(
+            cli,
+            ["export-bulk", "courses.csv", "bucket", "grades", "grades",
+             "--quiz-chunk-size", "2"],
+            env=TEST_ENV
+        )
+
+    assert result.exit_code == 0
+    quiz_requests = [
+        request for request in requests_mock.request_history
+        if request.qs["wsfunction"] == [
+            moodle.MOODLE_FUNC_GET_QUIZZES_BY_COURSES
+        ]
+    ]
+    assert len(quiz_requests) == 2
+    exported_quizzes = {
+        call.args[2]: call.args[0]["quizzes"]
+        for call in put_json_data.call_args_list
+    }
+    assert exported_quizzes == {
+        f"grades/{course_id}.json": [
+            {"id": course_id * 10, "course": course_id}
+        ]
+        for course_id in (1, 2, 3)
+    }
+
+
+@pytest.mark.parametrize("option", [
+    ["--stream"],
+    ["--attempt-cache", "attempts.sqlite"],
+    ["--fingerprints"],
+    ["--skip-unchanged"],
+])
+def test_export_grades_incremental_rejects_options(option):
+    runner = CliRunner()
+
+    result = runner.invoke(
+        cli,
+        ["export-grades", "21", "test-bucket", "grades.json",
+         "--incremental", *option],
+        env=TEST_ENV
+    )
+
+    assert result.exit_code == 2
+    assert f"{option[0]} cannot be used with --incremental" in result.output
@@ -1,9 +1,12 @@
 from urllib import parse
-from moodlecli import utils, moodle, aws
+from moodlecli import utils, moodle, aws, cache
 import pytest
 import os
 import json
+import hashlib
 import csv
+import subprocess
+import sys
 from click.testing import CliRunner
 from moodlecli.main import cli
 import boto3
@@ -114,6 +117,17 @@ def test_course_bulk_setup(moodle_requests_mock, tmp_path):
         with open('output.csv', 'r') as f:
             assert len(list(csv.DictReader(f))) == 2
 
+        result = runner.invoke(cli, ['course-bulk-setup',
+                                     '2', 'test.csv', 'parallel.csv',
+                                     '--parallel', '2'],
+                               env=TEST_ENV)
+
+        assert result.exit_code == 0
+        with open('parallel.csv', 'r') as f:
+            rows = list(csv.DictReader(f))
+            assert [row[utils.CSV_COURSE_SHORTNAME] for row in rows] == \
+                ['a1', 'e1']
+
 
 def test_courses(requests_mock):
     test_json = [{'fullname': 'foo',
@@ -163,6 +177,61 @@ def test_enrol_bulk(moodle_requests_mock, tmp_path):
         assert result.exit_code == 0
 
 
+def test_enrol_bulk_batched(requests_mock, tmp_path):
+    def get_matching_helper(request, context):
+        wsfunction = request.qs["wsfunction"][0]
+        if wsfunction == moodle.MOODLE_FUNC_GET_ROLE_BY_SHORTNAME:
+            return {'id': 5}
+        elif wsfunction == moodle.MOODLE_FUNC_GET_USERS_BY_FIELD:
+            if request.qs['field'] == ['username']:
+                return []
+            return [{'id': 2, 'email': 'tommichaels@gmail.com'}]
+
+    def post_matching_helper(request, context):
+        params = parse.parse_qs(request.body)
+        wsfunction = params['wsfunction'][0]
+        if wsfunction == moodle.MOODLE_FUNC_CREATE_USERS:
+            return [{'id': 3, 'username': params['users[0][username]'][0]}]
+        else:
+            return []
+
+    requests_mock.get(f'{TEST_MOODLE_URL}{moodle.MOODLE_WEBSERVICE_PATH}',
+                      json=get_matching_helper)
+    requests_mock.post(f'{TEST_MOODLE_URL}{moodle.MOODLE_WEBSERVICE_PATH}',
+                       json=post_matching_helper)
+
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+
+        with open('students.csv', 'w') as f:
+            writer = csv.DictWriter(
+                    f,
+                    utils.enrol_bulk_input_csv_fieldnames()
+                )
+            writer.writeheader()
+            writer.writerows([{utils.CSV_USER_FNAME: 'Tom',
+                               utils.CSV_USER_LNAME: 'Michaels',
+                               utils.CSV_USER_EMAIL: 'tommichaels@gmail.com',
+                               utils.CSV_USER_AUTH: 'manual'},
+                              {utils.CSV_USER_FNAME: 'Phil',
+                               utils.CSV_USER_LNAME: 'Thomas',
+                               utils.CSV_USER_EMAIL: 'philthomas@gmail.com',
+                               utils.CSV_USER_AUTH: 'manual'}])
+
+        result = runner.invoke(cli, ['enrol-bulk', '3', 'student',
+                                     'students.csv', '--batch-size', '10'],
+                               env=TEST_ENV)
+        assert result.exit_code == 0
+
+    # Role lookup, lookups by email and username, user creation and
+    # enrolment
+    assert requests_mock.call_count == 5
+    enrol_params = parse.parse_qs(requests_mock.last_request.body)
+    assert enrol_params['enrolments[0][userid]'] == ['2']
+    assert enrol_params['enrolments[1][userid]'] == ['3']
+    assert enrol_params['enrolments[1][roleid]'] == ['5']
+
+
 def test_enrol_bulk_csv(tmp_path):
     runner = CliRunner()
     with runner.isolated_filesystem(temp_dir=tmp_path):
@@ -192,6 +261,56 @@ def test_unenrol_bulk(moodle_requests_mock, tmp_path):
         assert result.exit_code == 0
 
 
+def test_unenrol_bulk_batched(requests_mock, tmp_path):
+    def get_matching_helper(request, context):
+        wsfunction = request.qs["wsfunction"][0]
+        if wsfunction == moodle.MOODLE_FUNC_GET_USERS_BY_FIELD:
+            if request.qs['field'] == ['username']:
+                # The account stored as PhilThomas@gmail.com has the lower
+                # case email as its username
+                return [{'id': 3, 'username': 'philthomas@gmail.com'}]
+            # Emails are matched exactly, which misses PhilThomas@gmail.com
+            return [{'id': 2, 'email': 'tommichaels@gmail.com'}]
+
+    requests_mock.get(
+        f'{TEST_MOODLE_URL}{moodle.MOODLE_WEBSERVICE_PATH}',
+        json=get_matching_helper
+    )
+    requests_mock.post(
+        f'{TEST_MOODLE_URL}{moodle.MOODLE_WEBSERVICE_PATH}',
+        json=[]
+    )
+
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+
+        with open('unenrolstudents.csv', 'w') as f:
+            writer = csv.DictWriter(
+                    f,
+                    utils.unenrol_bulk_input_csv_fieldnames()
+                )
+            writer.writeheader()
+            writer.writerows([{utils.CSV_USER_EMAIL: 'tommichaels@gmail.com'},
+                              {utils.CSV_USER_EMAIL: 'philthomas@gmail.com'},
+                              {utils.CSV_USER_EMAIL: 'unknown@gmail.com'}])
+
+        result = runner.invoke(cli, ['unenrol-bulk', '2',
+                                     'unenrolstudents.csv',
+                                     '--batch-size', '50'],
+                               env=TEST_ENV)
+
+        assert result.exit_code == 0
+
+    # Lookup by email, lookup by username of the two emails it didn't match
+    # and unenrolment
+    assert requests_mock.call_count == 3
+    unenrol_params = parse.parse_qs(requests_mock.last_request.body)
+    assert unenrol_params['wsfunction'] == [moodle.MOODLE_FUNC_UNENROL_USER]
+    assert unenrol_params['enrolments[0][userid]'] == ['2']
+    assert unenrol_params['enrolments[1][userid]'] == ['3']
+    assert 'enrolments[2][userid]' not in unenrol_params
+
+
 def test_unenrol_bulk_csv(tmp_path):
     runner = CliRunner()
     with runner.isolated_filesystem(temp_dir=tmp_path):
@@ -250,6 +369,26 @@ def test_role_info(requests_mock):
     assert json.loads(result.output) == test_json
 
 
+def test_stats(moodle_requests_mock, tmp_path):
+    runner = CliRunner()
+    stats_file = tmp_path / "stats.prom"
+
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        result = runner.invoke(cli, ['--stats', '--stats-file',
+                                     str(stats_file), '--stats-format',
+                                     'prometheus', 'import-bulk-csv',
+                                     'output.csv'],
+                               env=TEST_ENV)
+    assert result.exit_code == 0
+    assert os.stat(stats_file).st_size != 0
+
+    result = runner.invoke(cli, ['--stats', 'self-enrolment-methods',
+                                 '2', '3'],
+                           env=TEST_ENV)
+    assert result.exit_code == 0
+    assert moodle.MOODLE_FUNC_GET_SELF_ENROLMENT_METHODS in result.output
+
+
 def test_self_enrollment_methods(moodle_requests_mock):
     runner = CliRunner()
 
@@ -294,6 +433,123 @@ def test_export_users(moodle_requests_mock, tmp_path, mocker):
     stubber.assert_no_pending_responses()
 
 
+def test_export_users_skip_unchanged(moodle_requests_mock, mocker):
+    runner = CliRunner()
+
+    s3_client = boto3.client('s3')
+    stubber = botocore.stub.Stubber(s3_client)
+
+    key = '/path/key.txt'
+    bucket_name = 'test-bucket'
+    data = [{'id': 2, 'uuid': 'abcd'},
+            {'id': 3, 'uuid': None}]
+    sha256 = hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+    stubber.add_response(
+        'head_object',
+        {'Metadata': {'sha256': sha256}},
+        {'Bucket': bucket_name, 'Key': key}
+    )
+    stubber.activate()
+    mocker.patch("boto3.client", lambda service: s3_client)
+
+    result = runner.invoke(cli, ['export-users', '21', bucket_name, key,
+                                 '--skip-unchanged'],
+                           env=TEST_ENV)
+
+    assert result.exit_code == 0
+    assert f"skipped upload of {key}" in result.output
+    stubber.assert_no_pending_responses()
+
+
+def test_metadata_cache(moodle_requests_mock, requests_mock, tmp_path):
+    runner = CliRunner()
+    path = str(tmp_path / "metadata.json")
+
+    for _ in range(2):
+        result = runner.invoke(
+            cli,
+            ['--metadata-cache', path, 'role-info', 'student'],
+            env=TEST_ENV
+        )
+        assert result.exit_code == 0
+        assert json.loads(result.output) == {'id': 2}
+
+    assert requests_mock.call_count == 1
+
+
+def test_metadata_cache_in_memory(moodle_requests_mock, mocker, tmp_path):
+    client_class = mocker.patch("moodlecli.main.MoodleClient")
+    client_class.return_value.get_role_by_shortname.return_value = {'id': 2}
+    runner = CliRunner()
+
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        result = runner.invoke(cli, ['role-info', 'student'], env=TEST_ENV)
+        assert os.listdir() == []
+
+    assert result.exit_code == 0
+    metadata_cache = client_class.call_args[0][5]
+    assert metadata_cache.path is None
+    assert metadata_cache.ttl == cache.DEFAULT_METADATA_TTL
+
+
+def test_export_users_scoped_uuids(moodle_requests_mock, requests_mock,
+                                   mocker):
+    runner = CliRunner()
+    put_json_data = mocker.patch(
+        "moodlecli.aws.put_json_data",
+        return_value=True
+    )
+
+    result = runner.invoke(cli, ['export-users', '21', 'bucket', 'key',
+                                 '--uuid-chunk-size', '1'],
+                           env=TEST_ENV)
+
+    assert result.exit_code == 0
+    assert put_json_data.call_args.args[0] == [
+        {'id': 2, 'uuid': 'abcd'},
+        {'id': 3, 'uuid': None}
+    ]
+    uuid_requests = [
+        request.qs for request in requests_mock.request_history
+        if request.qs["wsfunction"] == [moodle.MOODLE_FUNC_GET_USER_UUIDS]
+    ]
+    assert [request["user_ids[0][id]"] for request in uuid_requests] == [
+        ["2"], ["3"]
+    ]
+
+
+def test_export_users_roster_cache(moodle_requests_mock, requests_mock,
+                                   mocker, tmp_path):
+    runner = CliRunner()
+    put_json_data = mocker.patch(
+        "moodlecli.aws.put_json_data",
+        return_value=True
+    )
+    roster_cache = str(tmp_path / "rosters.sqlite")
+
+    for _ in range(2):
+        result = runner.invoke(cli, ['export-users', '21', 'bucket', 'key',
+                                     '--user-fields', 'username, email',
+                                     '--roster-cache', roster_cache],
+                               env=TEST_ENV)
+        assert result.exit_code == 0
+        assert put_json_data.call_args.args[0] == [
+            {'id': 2, 'uuid': 'abcd'},
+            {'id': 3, 'uuid': None}
+        ]
+
+    roster_requests = [
+        request.qs for request in requests_mock.request_history
+        if request.qs["wsfunction"] == [
+            moodle.MOODLE_FUNC_CORE_ENROL_GET_ENROLLED_USERS
+        ]
+    ]
+    assert len(roster_requests) == 1
+    assert roster_requests[0]["options[0][name]"] == ["userfields"]
+    assert roster_requests[0]["options[0][value]"] == ["id,username,email"]
+
+
 def test_export_bulk_csv(tmp_path):
     runner = CliRunner()
     with runner.isolated_filesystem(temp_dir=tmp_path):
@@ -304,6 +560,33 @@ def test_export_bulk_csv(tmp_path):
         assert os.stat("output.csv").st_size != 0
 
 
+@pytest.mark.parametrize("args,pool_size", [
+    (['course-bulk-setup', '1', 'in.csv', 'out.csv', '--parallel', '16'],
+     16),
+    (['--pool-size', '20', 'course-bulk-setup', '1', 'in.csv', 'out.csv',
+      '--parallel', '16'], 20),
+    (['export-bulk', 'in.csv', 'bucket', 'path', 'users', '--parallel', '4',
+      '--max-workers', '8'], 32),
+    (['--pool-size', '40', 'export-bulk', 'in.csv', 'bucket', 'path',
+      'users', '--parallel', '4', '--max-workers', '8'], 40),
+])
+def test_pool_size_covers_concurrency(moodle_requests_mock, tmp_path,
+                                      mocker, args, pool_size):
+    create_session = mocker.patch(
+        "moodlecli.main.create_session",
+        wraps=moodle.create_session
+    )
+    runner = CliRunner()
+
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        with open('in.csv', 'w') as f:
+            f.write(f"{utils.CSV_COURSE_ID}\n")
+        result = runner.invoke(cli, args, env=TEST_ENV)
+
+    assert result.exit_code == 0
+    create_session.assert_called_once_with(pool_size)
+
+
 def test_export_bulk_users(moodle_requests_mock, tmp_path, mocker):
     runner = CliRunner()
 
@@ -339,6 +622,142 @@ def test_export_bulk_users(moodle_requests_mock, tmp_path, mocker):
         stubber.assert_no_pending_responses()
 
 
+def test_export_bulk_parallel_isolates_failures(moodle_requests_mock,
+                                                tmp_path, mocker):
+    runner = CliRunner()
+
+    def put_json_data(data, bucket_name, key, **kwargs):
+        if key == 'path/2.json':
+            raise Exception('Upload failed')
+
+    mocker.patch("moodlecli.aws.put_json_data", side_effect=put_json_data)
+
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+
+        with open('test.csv', 'w') as f:
+            writer = csv.DictWriter(
+                    f,
+                    utils.bulk_export_csv_course_ids()
+                )
+            writer.writeheader()
+            writer.writerows([{utils.CSV_COURSE_ID: 1},
+                              {utils.CSV_COURSE_ID: 2},
+                              {utils.CSV_COURSE_ID: 3}])
+
+        result = runner.invoke(cli, ['export-bulk', 'test.csv',
+                                     'test-bucket', 'path', 'users',
+                                     '--parallel', '3'],
+                               env=TEST_ENV)
+
+    assert result.exit_code == 1
+    assert aws.put_json_data.call_count == 3
+    assert "Exported 2 of 3 courses" in result.output
+    assert "Failed to export course 2" in result.output
+    assert "Failed to export course 1" not in result.output
+
+
+def test_export_bulk_resume(moodle_requests_mock, tmp_path, mocker):
+    runner = CliRunner()
+    failing_keys = {'path/2.json'}
+
+    def put_json_data(data, bucket_name, key, **kwargs):
+        if key in failing_keys:
+            raise Exception('Upload failed')
+        return True
+
+    mocker.patch("moodlecli.aws.put_json_data", side_effect=put_json_data)
+
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+
+        with open('test.csv', 'w') as f:
+            writer = csv.DictWriter(
+                    f,
+                    utils.bulk_export_csv_course_ids()
+                )
+            writer.writeheader()
+            writer.writerows([{utils.CSV_COURSE_ID: 1},
+                              {utils.CSV_COURSE_ID: 2},
+                              {utils.CSV_COURSE_ID: 3}])
+
+        args = ['export-bulk', 'test.csv', 'test-bucket', 'path', 'users',
+                '--checkpoint', 'export.checkpoint']
+        result = runner.invoke(cli, args, env=TEST_ENV)
+        assert result.exit_code == 1
+        assert aws.put_json_data.call_count == 3
+
+        failing_keys.clear()
+        result = runner.invoke(cli, args + ['--resume'], env=TEST_ENV)
+        assert result.exit_code == 0
+        assert "Skipping 2 courses exported by a previous run" in \
+            result.output
+        assert "Exported 1 of 1 courses" in result.output
+        assert aws.put_json_data.call_args.args[2] == 'path/2.json'
+
+        # Resuming a completed run does nothing
+        result = runner.invoke(cli, args + ['--resume'], env=TEST_ENV)
+        assert result.exit_code == 0
+        assert aws.put_json_data.call_count == 4
+
+        # A checkpoint can only resume the run it was written for
+        result = runner.invoke(cli, ['export-bulk', 'test.csv',
+                                     'test-bucket', 'other', 'users',
+                                     '--checkpoint', 'export.checkpoint',
+                                     '--resume'],
+                               env=TEST_ENV)
+        assert result.exit_code == 2
+        assert "cannot be used to resume" in result.output
+
+
+def test_import_bulk_resume(moodle_requests_mock, requests_mock, tmp_path):
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+
+        with open('courses.csv', 'w') as f:
+            writer = csv.DictWriter(
+                    f,
+                    utils.import_bulk_input_csv_fieldnames()
+                )
+            writer.writeheader()
+            writer.writerows([{utils.CSV_COURSE_ID: 2},
+                              {utils.CSV_COURSE_ID: 3}])
+
+        with open('import.checkpoint', 'w') as f:
+            f.write('{"scope": "import-bulk 1"}\n{"done": "2"}\n{"do')
+
+        result = runner.invoke(cli, ['import-bulk', '1', 'courses.csv',
+                                     '--checkpoint', 'import.checkpoint',
+                                     '--resume'],
+                               env=TEST_ENV)
+        assert result.exit_code == 0
+
+        with open('import.checkpoint') as f:
+            assert f.read().splitlines() == [
+                '{"scope": "import-bulk 1"}',
+                '{"done": "2"}',
+                '{"done": "3"}'
+            ]
+
+    imports = [
+        parse.parse_qs(request.body)['importto']
+        for request in requests_mock.request_history
+        if request.method == 'POST'
+    ]
+    assert imports == [['3']]
+
+
+def test_resume_requires_checkpoint(moodle_requests_mock, tmp_path):
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        with open('courses.csv', 'w') as f:
+            f.write(f'{utils.CSV_COURSE_ID}\n')
+
+        result = runner.invoke(cli, ['import-bulk', '1', 'courses.csv',
+                                     '--resume'],
+                               env=TEST_ENV)
+    assert result.exit_code == 2
+    assert "--resume requires --checkpoint" in result.output
+
+
 def test_course_bulk_setup_error(moodle_requests_mock, tmp_path):
     """This exercises an error that can be caused by invalid email inputs
     in the course-bulk-setup CLI command"""
@@ -401,4 +820,25 @@ def test_export_policy_acceptances(mocker,
     ]
 
     aws.put_json_data.assert_called_once_with(
-        policy_acceptance_data, 'bucket_name', 'key.json')
+        policy_acceptance_data, 'bucket_name', 'key.json',
+        output_format='json', compression=None)
+
+
+@pytest.mark.parametrize("args", [["--help"], ["course-bulk-csv", "out.csv"]])
+def test_startup_skips_heavy_imports(tmp_path, args):
+    code = (
+        "import sys\n"
+        "from moodlecli.main import cli\n"
+        "cli(sys.argv[1:], standalone_mode=False)\n"
+        "heavy = ['boto3', 'requests', 'prettytable']\n"
+        "print(','.join(name for name in heavy if name in sys.modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code, *args],
+        env={**os.environ, **TEST_ENV},
+        cwd=tmp_path,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    assert result.stdout.splitlines()[-1] == ""
@@ -1,7 +1,11 @@
 import pytest
+from moodlecli import cache
 from moodlecli import moodle
 from moodlecli import utils
+from moodlecli.stats import RequestStats
 import random
+import threading
+import requests
 from requests.exceptions import ConnectionError
 
 TEST_MOODLE_URL = "http://dagobah"
@@ -28,6 +32,29 @@ def test_convert_moodle_params():
         assert moodle.convert_moodle_params(case["input"]) == case["expected"]
 
 
+def test_convert_moodle_params_nested_order():
+    data = {
+        "users": [
+            {"id": 1, "customfields": [{"type": "a", "value": "b"}]},
+            {"id": 2, "customfields": []}
+        ],
+        "options": {"ids": [3, 4]},
+        "name": "x"
+    }
+
+    assert list(moodle.convert_moodle_params(data).items()) == [
+        ("users[0][id]", 1),
+        ("users[0][customfields][0][type]", "a"),
+        ("users[0][customfields][0][value]", "b"),
+        ("users[1][id]", 2),
+        ("options[ids][0]", 3),
+        ("options[ids][1]", 4),
+        ("name", "x"),
+    ]
+    assert moodle.convert_moodle_params([5, 6]) == {"0": 5, "1": 6}
+    assert moodle.convert_moodle_params([5], "ids") == {"ids[0]": 5}
+
+
 def test_copy_course(mocker):
     session_mock = mocker.Mock()
     session_mock.post.return_value.json.return_value = {}
@@ -284,6 +311,70 @@ def test_create_user_capital_email(mocker):
     )
 
 
+def test_get_users_by_field(mocker):
+    session_mock = mocker.Mock()
+    session_mock.get.return_value.json.return_value = [{"id": 111}]
+    client = moodle.MoodleClient(
+        session_mock, TEST_MOODLE_URL, TEST_MOODLE_TOKEN
+    )
+    res = client.get_users_by_field(
+        "email", ["a@acmeinc.com", "b@acmeinc.com"]
+    )
+    session_mock.get.assert_called_once_with(
+        f"{TEST_MOODLE_URL}{moodle.MOODLE_WEBSERVICE_PATH}",
+        params={
+            "field": "email",
+            "values[0]": "a@acmeinc.com",
+            "values[1]": "b@acmeinc.com",
+            "wsfunction": moodle.MOODLE_FUNC_GET_USERS_BY_FIELD,
+            "moodlewsrestformat": "json",
+            "wstoken": TEST_MOODLE_TOKEN
+        },
+        timeout=moodle.MOODLE_REQUEST_TIMEOUT
+    )
+    assert res == [{"id": 111}]
+
+
+def test_create_users(mocker):
+    session_mock = mocker.Mock()
+    session_mock.post.return_value.json.return_value = [{}, {}]
+    client = moodle.MoodleClient(
+        session_mock, TEST_MOODLE_URL, TEST_MOODLE_TOKEN
+    )
+    client.create_users([
+        {
+            "firstname": "fname1",
+            "lastname": "lname1",
+            "email": "EMAIL1",
+            "auth": "oauth2"
+        },
+        {
+            "firstname": "fname2",
+            "lastname": "lname2",
+            "email": "email2",
+            "auth": "manual"
+        }
+    ])
+    params = session_mock.post.call_args[0][1]
+    assert "users[1][password]" in params
+    del params["users[1][password]"]
+    assert params == {
+        "users[0][username]": "email1",
+        "users[0][email]": "email1",
+        "users[0][firstname]": "fname1",
+        "users[0][lastname]": "lname1",
+        "users[0][auth]": "oauth2",
+        "users[1][username]": "email2",
+        "users[1][email]": "email2",
+        "users[1][firstname]": "fname2",
+        "users[1][lastname]": "lname2",
+        "users[1][auth]": "manual",
+        "wsfunction": moodle.MOODLE_FUNC_CREATE_USERS,
+        "moodlewsrestformat": "json",
+        "wstoken": TEST_MOODLE_TOKEN
+    }
+
+
 def test_get_course_enrolment_url(mocker):
     session_mock = mocker.Mock()
     client = moodle.MoodleClient(
@@ -314,6 +405,30 @@ def test_enrol_user(mocker):
     )
 
 
+def test_enrol_users(mocker):
+    session_mock = mocker.Mock()
+    session_mock.post.return_value.json.return_value = None
+    client = moodle.MoodleClient(
+        session_mock, TEST_MOODLE_URL, TEST_MOODLE_TOKEN
+    )
+    client.enrol_users(1, [2, 4], 3)
+    session_mock.post.assert_called_once_with(
+        f"{TEST_MOODLE_URL}{moodle.MOODLE_WEBSERVICE_PATH}",
+        {
+            "enrolments[0][courseid]": 1,
+            "enrolments[0][userid]": 2,
+            "enrolments[0][roleid]": 3,
+            "enrolments[1][courseid]": 1,
+            "enrolments[1][userid]": 4,
+            "enrolments[1][roleid]": 3,
+            "wsfunction": moodle.MOODLE_FUNC_ENROL_USER,
+            "moodlewsrestformat": "json",
+            "wstoken": TEST_MOODLE_TOKEN
+        },
+        timeout=moodle.MOODLE_REQUEST_TIMEOUT
+    )
+
+
 def test_unenrol_user(mocker):
     session_mock = mocker.Mock()
     session_mock.post.return_value.json.return_value = [{}]
@@ -334,6 +449,28 @@ def test_unenrol_user(mocker):
     )
 
 
+def test_unenrol_users(mocker):
+    session_mock = mocker.Mock()
+    session_mock.post.return_value.json.return_value = None
+    client = moodle.MoodleClient(
+        session_mock, TEST_MOODLE_URL, TEST_MOODLE_TOKEN
+    )
+    client.unenrol_users(1, [2, 4])
+    session_mock.post.assert_called_once_with(
+        f"{TEST_MOODLE_URL}{moodle.MOODLE_WEBSERVICE_PATH}",
+        {
+            "enrolments[0][courseid]": 1,
+            "enrolments[0][userid]": 2,
+            "enrolments[1][courseid]": 1,
+            "enrolments[1][userid]": 4,
+            "wsfunction": moodle.MOODLE_FUNC_UNENROL_USER,
+            "moodlewsrestformat": "json",
+            "wstoken": TEST_MOODLE_TOKEN
+        },
+        timeout=moodle.MOODLE_REQUEST_TIMEOUT
+    )
+
+
 def test_setup_duplicate_course(mocker):
     random.seed(1)
     moodle_mock = mocker.Mock()
@@ -434,6 +571,56 @@ def test_setup_duplicate_course_timeout_workaround(mocker):
     assert res[utils.CSV_COURSE_ENROLMENT_KEY] == "suave-spider-1033"
 
 
+def test_setup_duplicate_courses_parallel(mocker):
+    moodle_mock = mocker.Mock()
+    courses = [
+        {
+            utils.CSV_INST_FNAME: "fname",
+            utils.CSV_INST_LNAME: "lname",
+            utils.CSV_INST_EMAIL: "fname@lname.com",
+            utils.CSV_INST_AUTH: "oauth2",
+            utils.CSV_COURSE_NAME: f"test course {idx}",
+            utils.CSV_COURSE_SHORTNAME: f"testcourse{idx}",
+            utils.CSV_COURSE_CATEGORY: 1
+        }
+        for idx in range(10)
+    ]
+    started = {idx: threading.Event() for idx in range(10)}
+    release = threading.Event()
+
+    def copy_course(base_course_id, name, shortname, category):
+        idx = int(shortname[-1])
+        started[idx].set()
+        # Course 0 fails once courses 2 and 3 are in progress, while
+        # course 1 has already finished and the rest are queued
+        if idx == 0:
+            assert started[3].wait(5)
+            raise Exception("Copy failed")
+        if idx in (2, 3):
+            assert release.wait(5)
+        return {"id": f"courseid{idx}"}
+
+    moodle_mock.get_user_by_email.return_value = {"id": "userid"}
+    moodle_mock.copy_course.side_effect = copy_course
+    moodle_mock.get_self_enrolment_methods.return_value = [{"id": "enrolid"}]
+    moodle_mock.get_course_enrolment_url.return_value = "enrolmenturl"
+
+    results = []
+    with pytest.raises(Exception, match="Copy failed"):
+        for result in utils.setup_duplicate_courses(
+            moodle_mock, 111, courses, 1, 2, max_workers=3
+        ):
+            results.append(result)
+            release.set()
+
+    # Courses in progress when course 0 failed complete in input order,
+    # but queued courses are never started
+    assert [result[utils.CSV_COURSE_ID] for result in results] == [
+        "courseid1", "courseid2", "courseid3"
+    ]
+    assert moodle_mock.copy_course.call_count == 4
+
+
 def test_check_for_moodle_error(mocker):
     result_mock = mocker.Mock()
     result_mock.json.return_value = {
@@ -448,6 +635,118 @@ def test_check_for_moodle_error(mocker):
     moodle.check_for_moodle_error(result_mock)
 
 
+def test_is_retryable_error(mocker):
+    assert moodle.is_retryable_error(ConnectionError())
+    assert moodle.is_retryable_error(requests.Timeout())
+    assert moodle.is_retryable_error(
+        requests.HTTPError(response=mocker.Mock(status_code=502))
+    )
+    assert not moodle.is_retryable_error(
+        requests.HTTPError(response=mocker.Mock(status_code=404))
+    )
+    assert moodle.is_retryable_error(
+        Exception({"exception": "dml_read_exception"})
+    )
+    assert not moodle.is_retryable_error(
+        Exception({"exception": "invalid_parameter_exception"})
+    )
+    assert not moodle.is_retryable_error(Exception("error"))
+
+
+def test_retry_delay(mocker):
+    mocker.patch("moodlecli.moodle.random.uniform", lambda a, b: b)
+    assert moodle.retry_delay(0) == moodle.MOODLE_RETRY_BACKOFF
+    assert moodle.retry_delay(2) == moodle.MOODLE_RETRY_BACKOFF * 4
+    assert moodle.retry_delay(100) == moodle.MOODLE_RETRY_BACKOFF_MAX
+
+
+def test_get_retries(mocker):
+    sleep_mock = mocker.patch("moodlecli.moodle.sleep")
+    session_mock = mocker.Mock()
+    error_response = mocker.Mock()
+    error_response.json.return_value = {"exception": "dml_read_exception"}
+    ok_response = mocker.Mock()
+    ok_response.json.return_value = {"courses": []}
+    session_mock.get.side_effect = [
+        ConnectionError("Mock disconnect"),
+        error_response,
+        ok_response
+    ]
+    client = moodle.MoodleClient(
+        session_mock, TEST_MOODLE_URL, TEST_MOODLE_TOKEN
+    )
+
+    assert client.get_courses() == {"courses": []}
+    assert session_mock.get.call_count == 3
+    assert sleep_mock.call_count == 2
+
+
+def test_get_retries_exhausted(mocker):
+    sleep_mock = mocker.patch("moodlecli.moodle.sleep")
+    session_mock = mocker.Mock()
+    session_mock.get.side_effect = ConnectionError("Mock disconnect")
+    client = moodle.MoodleClient(
+        session_mock, TEST_MOODLE_URL, TEST_MOODLE_TOKEN, retries=2
+    )
+
+    with pytest.raises(ConnectionError):
+        client.get_courses()
+    assert session_mock.get.call_count == 3
+    assert sleep_mock.call_count == 2
+
+
+def test_no_retries_for_fatal_errors_and_posts(mocker):
+    sleep_mock = mocker.patch("moodlecli.moodle.sleep")
+    session_mock = mocker.Mock()
+    session_mock.get.return_value.json.return_value = {
+        "exception": "invalid_parameter_exception"
+    }
+    session_mock.post.side_effect = ConnectionError("Mock disconnect")
+    client = moodle.MoodleClient(
+        session_mock, TEST_MOODLE_URL, TEST_MOODLE_TOKEN
+    )
+
+    with pytest.raises(Exception, match="invalid_parameter_exception"):
+        client.get_courses()
+    with pytest.raises(ConnectionError):
+        client.import_course(1, 2)
+    assert session_mock.get.call_count == 1
+    assert session_mock.post.call_count == 1
+    sleep_mock.assert_not_called()
+
+
+def test_request_stats(mocker):
+    mocker.patch("moodlecli.moodle.sleep")
+    session_mock = mocker.Mock()
+    ok_response = mocker.Mock(content=b"[]")
+    ok_response.json.return_value = []
+    session_mock.get.side_effect = [ConnectionError(), ok_response]
+    session_mock.post.return_value.content = b'{"exception": "error"}'
+    session_mock.post.return_value.json.return_value = {"exception": "error"}
+    request_stats = RequestStats()
+    client = moodle.MoodleClient(
+        session_mock, TEST_MOODLE_URL, TEST_MOODLE_TOKEN, stats=request_stats
+    )
+
+    client.get_courses()
+    with pytest.raises(Exception):
+        client.import_course(1, 2)
+
+    summary = request_stats.summary()
+    assert summary[moodle.MOODLE_FUNC_GET_COURSES]["count"] == 2
+    assert summary[moodle.MOODLE_FUNC_GET_COURSES]["errors"] == 1
+    assert summary[moodle.MOODLE_FUNC_GET_COURSES]["response_bytes"] == 2
+    assert summary[moodle.MOODLE_FUNC_IMPORT_COURSE]["count"] == 1
+    assert summary[moodle.MOODLE_FUNC_IMPORT_COURSE]["errors"] == 1
+
+
+def test_create_session():
+    session = moodle.create_session(25)
+    adapter = session.get_adapter("https://moodle")
+    assert adapter._pool_maxsize == 25
+    assert session.get_adapter("http://moodle") is adapter
+
+
 def test_get_course_grades(mocker):
     session_mock = mocker.Mock()
     session_mock.get.return_value.json.return_value = [{}]
@@ -492,6 +791,28 @@ def test_get_users_by_course(mocker):
     assert users_json == [{}]
 
 
+def test_get_users_by_course_user_fields(mocker):
+    session_mock = mocker.Mock()
+    session_mock.get.return_value.json.return_value = [{}]
+    client = moodle.MoodleClient(
+        session_mock, TEST_MOODLE_URL, TEST_MOODLE_TOKEN
+    )
+    client.get_users_by_course(2, ["id", "email"])
+
+    session_mock.get.assert_called_once_with(
+        f"{TEST_MOODLE_URL}{moodle.MOODLE_WEBSERVICE_PATH}",
+        params={
+            "courseid": 2,
+            "options[0][name]": "userfields",
+            "options[0][value]": "id,email",
+            "wsfunction": moodle.MOODLE_FUNC_CORE_ENROL_GET_ENROLLED_USERS,
+            "moodlewsrestformat": "json",
+            "wstoken": TEST_MOODLE_TOKEN
+        },
+        timeout=moodle.MOODLE_REQUEST_TIMEOUT
+    )
+
+
 def test_get_user_uuids(mocker):
     session_mock = mocker.Mock()
     session_mock.get.return_value.json.return_value = [{}]
@@ -610,3 +931,34 @@ def test_get_policy_acceptance_data(mocker):
         },
         timeout=moodle.MOODLE_REQUEST_TIMEOUT
     )
+
+
+def test_metadata_cache(mocker):
+    session_mock = mocker.Mock()
+    session_mock.get.return_value.json.side_effect = [
+        {"id": 5},
+        {"courses": []},
+        {"courses": [{"id": 1}]},
+        [{"id": 7}],
+        [{"id": 7, "status": 0}],
+    ]
+    session_mock.post.return_value.json.return_value = {}
+    client = moodle.MoodleClient(
+        session_mock, TEST_MOODLE_URL, TEST_MOODLE_TOKEN,
+        metadata_cache=cache.MetadataCache()
+    )
+
+    assert client.get_role_by_shortname("student") == {"id": 5}
+    assert client.get_role_by_shortname("student") == {"id": 5}
+    # Missing courses are looked up again
+    assert client.get_course_by_shortname("c1") == {"courses": []}
+    assert client.get_course_by_shortname("c1") == {"courses": [{"id": 1}]}
+    assert client.get_course_by_shortname("c1") == {"courses": [{"id": 1}]}
+    assert client.get_self_enrolment_methods(1, 5) == [{"id": 7}]
+    assert client.get_self_enrolment_methods(1, 5) == [{"id": 7}]
+    # Enabling a method invalidates cached methods
+    client.enable_self_enrolment_method(7)
+    assert client.get_self_enrolment_methods(1, 5) == [
+        {"id": 7, "status": 0}
+    ]
+    assert session_mock.get.call_count == 5
@@ -0,0 +1,137 @@
+import asyncio
+import httpx
+import pytest
+from urllib import parse
+from moodlecli import moodle
+from moodlecli.moodle_async import AsyncMoodleClient
+
+TEST_MOODLE_URL = "http://dagobah"
+TEST_MOODLE_TOKEN = "1234"
+
+
+def make_client(handler, **kwargs):
+    session = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return AsyncMoodleClient(
+        session, TEST_MOODLE_URL, TEST_MOODLE_TOKEN, **kwargs
+    )
+
+
+def test_get_user_quiz_attempts():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json={"attempts": []})
+
+    client = make_client(handler)
+    res = asyncio.run(client.get_user_quiz_attempts(1, 2))
+
+    assert res == {"attempts": []}
+    assert len(requests) == 1
+    assert requests[0].method == "GET"
+    assert str(requests[0].url).startswith(
+        f"{TEST_MOODLE_URL}{moodle.MOODLE_WEBSERVICE_PATH}"
+    )
+    assert dict(requests[0].url.params) == {
+        "userid": "1",
+        "quizid": "2",
+        "wsfunction": moodle.MOODLE_FUNC_GET_USER_QUIZ_ATTEMPTS,
+        "moodlewsrestformat": "json",
+        "wstoken": TEST_MOODLE_TOKEN
+    }
+
+
+def test_post_params():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json=[])
+
+    client = make_client(handler)
+    asyncio.run(client.enrol_user(1, 2, 3))
+
+    assert requests[0].method == "POST"
+    assert parse.parse_qs(requests[0].content.decode()) == {
+        "enrolments[0][courseid]": ["1"],
+        "enrolments[0][userid]": ["2"],
+        "enrolments[0][roleid]": ["3"],
+        "wsfunction": [moodle.MOODLE_FUNC_ENROL_USER],
+        "moodlewsrestformat": ["json"],
+        "wstoken": [TEST_MOODLE_TOKEN]
+    }
+
+
+def test_get_user_by_email_and_create_user():
+    def handler(request):
+        if request.method == "GET":
+            return httpx.Response(200, json={"users": [{"id": 111}]})
+        return httpx.Response(200, json=[{"id": 222, "username": "email"}])
+
+    client = make_client(handler)
+
+    async def run():
+        return await asyncio.gather(
+            client.get_user_by_email("admin@acmeinc.com"),
+            client.create_user("fname", "lname", "email", "oauth2")
+        )
+
+    assert asyncio.run(run()) == [
+        {"id": 111},
+        {"id": 222, "username": "email"}
+    ]
+
+
+def test_moodle_error():
+    def handler(request):
+        return httpx.Response(200, json={"exception": "moodle_exception"})
+
+    client = make_client(handler)
+
+    with pytest.raises(Exception, match="moodle_exception"):
+        asyncio.run(client.get_courses())
+
+
+def test_get_retries(mocker):
+    mocker.patch("moodlecli.moodle_async.retry_delay", lambda attempt: 0)
+    responses = [
+        httpx.ConnectError("Mock disconnect"),
+        httpx.Response(503),
+        httpx.Response(200, json={"exception": "dml_read_exception"}),
+        httpx.Response(200, json=[{"id": 1}]),
+    ]
+
+    def handler(request):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    client = make_client(handler)
+
+    assert asyncio.run(client.get_courses()) == [{"id": 1}]
+    assert responses == []
+
+
+def test_concurrency_limit():
+    in_flight = 0
+    max_in_flight = 0
+
+    async def handler(request):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, json={"attempts": []})
+
+    client = make_client(handler, max_concurrency=3)
+
+    async def run():
+        return await asyncio.gather(*[
+            client.get_user_quiz_attempts(user_id, 1)
+            for user_id in range(10)
+        ])
+
+    assert len(asyncio.run(run())) == 10
+    assert max_in_flight == 3
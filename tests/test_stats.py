@@ -0,0 +1,69 @@
+import json
+from moodlecli import stats
+
+
+def test_record_and_summary():
+    request_stats = stats.RequestStats()
+    request_stats.record("func_a", 0.02, 100, False)
+    request_stats.record("func_a", 3, 50, True)
+    request_stats.record("func_b", 1000, 0, True)
+
+    summary = request_stats.summary()
+
+    assert summary["func_a"]["count"] == 2
+    assert summary["func_a"]["errors"] == 1
+    assert summary["func_a"]["response_bytes"] == 150
+    assert summary["func_a"]["total_seconds"] == 3.02
+    assert summary["func_a"]["max_seconds"] == 3
+    assert summary["func_a"]["buckets"] == [1, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0]
+    # Latencies above the largest bucket are only included in the count
+    assert summary["func_b"]["buckets"] == [0] * len(stats.LATENCY_BUCKETS)
+    assert summary["func_b"]["count"] == 1
+
+
+def test_to_table():
+    request_stats = stats.RequestStats()
+    request_stats.record("func_a", 1, 100, False)
+    request_stats.record("func_b", 10, 100, False)
+
+    table = request_stats.to_table()
+
+    assert table.index("func_b") < table.index("func_a")
+    assert "10.000" in table
+
+
+def test_to_prometheus():
+    request_stats = stats.RequestStats()
+    request_stats.record("func_a", 0.2, 100, False)
+    request_stats.record("func_a", 2, 50, True)
+
+    lines = request_stats.to_prometheus().splitlines()
+
+    assert 'moodlecli_requests_total{wsfunction="func_a"} 2' in lines
+    assert 'moodlecli_request_errors_total{wsfunction="func_a"} 1' in lines
+    assert 'moodlecli_response_bytes_total{wsfunction="func_a"} 150' in lines
+    assert 'moodlecli_request_duration_seconds_bucket' \
+        '{wsfunction="func_a",le="0.1"} 0' in lines
+    assert 'moodlecli_request_duration_seconds_bucket' \
+        '{wsfunction="func_a",le="0.25"} 1' in lines
+    assert 'moodlecli_request_duration_seconds_bucket' \
+        '{wsfunction="func_a",le="+Inf"} 2' in lines
+    assert 'moodlecli_request_duration_seconds_sum' \
+        '{wsfunction="func_a"} 2.2' in lines
+    assert 'moodlecli_request_duration_seconds_count' \
+        '{wsfunction="func_a"} 2' in lines
+
+
+def test_write(tmp_path):
+    request_stats = stats.RequestStats()
+    request_stats.record("func_a", 1, 100, False)
+
+    request_stats.write(tmp_path / "stats.json", "json")
+    request_stats.write(tmp_path / "stats.prom", "prometheus")
+
+    with open(tmp_path / "stats.json") as f:
+        data = json.load(f)
+    assert data["functions"]["func_a"]["count"] == 1
+    assert data["latency_buckets"] == list(stats.LATENCY_BUCKETS)
+    with open(tmp_path / "stats.prom") as f:
+        assert f.read() == request_stats.to_prometheus()
@@ -1,7 +1,8 @@
 from moodlecli.moodle import MoodleClient, MOODLE_WEBSERVICE_PATH
-from moodlecli import utils
+from moodlecli import cache, utils
 import pytest
 import requests
+import threading
 
 TEST_MOODLE_URL = "http://test-things"
 TEST_MOODLE_TOKEN = "e4586db9345084f15abc7326b84dde21"
@@ -26,3 +27,250 @@ def test_maybe_user_uuids(requests_mock):
                       json={'exception': 'dml_missing_record_exception'})
 
     assert (utils.maybe_user_uuids(moodle) == [])
+
+
+def test_get_scoped_user_uuids(mocker, tmp_path):
+    moodle = mocker.Mock()
+    moodle.get_user_uuids.side_effect = [
+        [{"user_id": 1, "user_uuid": "a"}, {"user_id": 2, "user_uuid": "b"}],
+        [{"user_id": 3, "user_uuid": "c"}],
+    ]
+    uuid_cache = cache.UserUUIDCache(tmp_path / "uuids.sqlite")
+    uuid_cache.put_many({4: "d"})
+
+    res = utils.get_scoped_user_uuids(
+        moodle, [1, 2, "4", 5, 1, 3], 2, uuid_cache
+    )
+
+    assert utils.inject_uuids(res, [{"id": id} for id in range(1, 6)]) == [
+        {"id": 1, "uuid": "a"},
+        {"id": 2, "uuid": "b"},
+        {"id": 3, "uuid": "c"},
+        {"id": 4, "uuid": "d"},
+        {"id": 5, "uuid": None},
+    ]
+    assert moodle.get_user_uuids.call_args_list == [
+        mocker.call([1, 2]),
+        mocker.call([5, 3]),
+    ]
+    assert uuid_cache.get_many([1, 2, 3, 5]) == {1: "a", 2: "b", 3: "c"}
+    uuid_cache.close()
+
+
+def test_get_user_ids_by_emails(mocker):
+    moodle = mocker.Mock()
+    moodle.get_users_by_field.side_effect = [
+        [{"id": 1, "email": "a@x.com"}],
+        [],
+        [],
+    ]
+
+    res = utils.get_user_ids_by_emails(moodle, ["a@x.com", "B@x.com"], 2)
+
+    assert res == {"a@x.com": 1}
+    assert moodle.get_users_by_field.call_args_list == [
+        mocker.call("email", ["B@x.com", "a@x.com"]),
+        mocker.call("email", ["b@x.com"]),
+        mocker.call("username", ["b@x.com"]),
+    ]
+    moodle.get_user_by_email.assert_not_called()
+
+
+def test_get_user_ids_by_emails_mixed_case(mocker):
+    moodle = mocker.Mock()
+    # The account is stored as John@X.com, which doesn't match exactly, but
+    # its username is the lower case email
+    moodle.get_users_by_field.side_effect = lambda field, values: (
+        [{"id": 7, "username": "john@x.com", "email": "John@X.com"}]
+        if field == "username" else []
+    )
+
+    res = utils.get_user_ids_by_emails(moodle, ["john@x.com"], 10)
+
+    assert res == {"john@x.com": 7}
+    moodle.get_users_by_field.assert_called_with("username", ["john@x.com"])
+    moodle.get_user_by_email.assert_not_called()
+
+
+def test_create_or_get_users(mocker):
+    moodle = mocker.Mock()
+    moodle.get_users_by_field.side_effect = [
+        [{"id": 1, "email": "a@x.com"}],
+        [{"id": 3, "email": "c@x.com"}],
+        [],
+    ]
+    moodle.create_users.return_value = [{"id": 2, "username": "b@x.com"}]
+    users = [
+        {"firstname": "A", "lastname": "A", "email": "A@x.com", "auth": "m"},
+        {"firstname": "B", "lastname": "B", "email": "b@x.com", "auth": "m"},
+        {"firstname": "C", "lastname": "C", "email": "c@x.com", "auth": "m"},
+        {"firstname": "A", "lastname": "A", "email": "a@x.com", "auth": "m"},
+    ]
+
+    assert utils.create_or_get_users(moodle, users, 2) == [1, 2, 3, 1]
+    assert moodle.get_users_by_field.call_args_list == [
+        mocker.call("email", ["A@x.com", "a@x.com"]),
+        mocker.call("email", ["b@x.com", "c@x.com"]),
+        mocker.call("username", ["b@x.com"]),
+    ]
+    moodle.get_user_by_email.assert_not_called()
+    moodle.create_users.assert_called_once_with([users[1]])
+
+
+def test_create_or_get_users_existing_account_fallback(mocker):
+    moodle = mocker.Mock()
+    # Neither lookup finds D@x.com, whose account has another username
+    moodle.get_users_by_field.return_value = []
+    moodle.create_users.side_effect = [
+        Exception({
+            "exception": "invalid_parameter_exception",
+            "debuginfo": "Email address already exists: d@x.com"
+        }),
+        [{"id": 5, "username": "e@x.com"}],
+    ]
+    moodle.get_user_by_email.side_effect = \
+        lambda email: {"id": 4} if email == "d@x.com" else None
+    users = [
+        {"firstname": "D", "lastname": "D", "email": "d@x.com", "auth": "m"},
+        {"firstname": "E", "lastname": "E", "email": "e@x.com", "auth": "m"},
+    ]
+
+    assert utils.create_or_get_users(moodle, users, 10) == [4, 5]
+    assert moodle.get_user_by_email.call_count == 2
+    assert moodle.create_users.call_args_list == [
+        mocker.call(users),
+        mocker.call([users[1]]),
+    ]
+
+
+def test_create_or_get_users_error(mocker):
+    moodle = mocker.Mock()
+    moodle.get_users_by_field.return_value = []
+    moodle.create_users.side_effect = Exception({"exception": "other"})
+    users = [
+        {"firstname": "D", "lastname": "D", "email": "d@x.com", "auth": "m"}
+    ]
+
+    with pytest.raises(Exception):
+        utils.create_or_get_users(moodle, users, 10)
+    moodle.get_user_by_email.assert_not_called()
+
+
+def test_create_or_get_users_duplicate_email(mocker):
+    moodle = mocker.Mock()
+    moodle.get_users_by_field.return_value = [
+        {"id": 1, "email": "a@x.com"},
+        {"id": 2, "email": "A@x.com"},
+    ]
+    users = [
+        {"firstname": "A", "lastname": "A", "email": "a@x.com", "auth": "m"}
+    ]
+
+    with pytest.raises(Exception, match="Multiple users returned with email"):
+        utils.create_or_get_users(moodle, users, 10)
+
+
+def test_course_copy_poller_backoff(mocker):
+    sleep_mock = mocker.patch("moodlecli.utils.sleep")
+    moodle = mocker.Mock()
+    moodle.get_course_by_shortname.side_effect = [
+        {"courses": []},
+        {"courses": []},
+        {"courses": []},
+        {"courses": [{"shortname": "c1", "id": 11}]},
+    ]
+    poller = utils.CourseCopyPoller(
+        moodle, initial_interval=5, max_interval=15, backoff=2
+    )
+
+    assert poller.wait_for("c1") == 11
+    assert [call.args[0] for call in sleep_mock.call_args_list] == \
+        [5, 10, 15, 15]
+    moodle.get_course_by_shortname.assert_called_with("c1")
+    moodle.get_courses.assert_not_called()
+
+
+def test_course_copy_poller_deadline(mocker):
+    mocker.patch("moodlecli.utils.sleep")
+    mocker.patch("moodlecli.utils.monotonic", side_effect=[0, 50, 101])
+    moodle = mocker.Mock()
+    moodle.get_course_by_shortname.return_value = {"courses": []}
+    poller = utils.CourseCopyPoller(moodle, deadline=100)
+
+    with pytest.raises(Exception, match="Timed out waiting for course c1"):
+        poller.wait_for("c1")
+    assert moodle.get_course_by_shortname.call_count == 2
+
+
+def test_course_copy_poller_shared(mocker):
+    moodle = mocker.Mock()
+    polls = []
+
+    def get_courses():
+        polls.append(None)
+        if len(polls) < 2:
+            return []
+        return [
+            {"shortname": "c1", "id": 11},
+            {"shortname": "other", "id": 12},
+            {"shortname": "c2", "id": 13},
+        ]
+
+    moodle.get_courses.side_effect = get_courses
+    moodle.get_course_by_shortname.return_value = {"courses": []}
+    poller = utils.CourseCopyPoller(
+        moodle, initial_interval=0.01, max_interval=0.02
+    )
+    results = {}
+
+    def wait_for(shortname):
+        results[shortname] = poller.wait_for(shortname)
+
+    threads = [
+        threading.Thread(target=wait_for, args=(shortname,))
+        for shortname in ["c1", "c2"]
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {"c1": 11, "c2": 13}
+    assert len(polls) == 2
+
+
+def test_get_course_users(mocker, tmp_path):
+    moodle = mocker.Mock()
+    moodle.get_users_by_course.return_value = [{"id": 1, "email": "a@x.com"}]
+    roster_cache = cache.RosterCache(tmp_path / "rosters.sqlite")
+
+    for _ in range(2):
+        res = utils.get_course_users(moodle, 2, ["email"], roster_cache)
+        assert res == [{"id": 1, "email": "a@x.com"}]
+
+    moodle.get_users_by_course.assert_called_once_with(2, ["id", "email"])
+    roster_cache.close()
+
+
+def test_get_quizzes_by_course_ids(mocker):
+    moodle = mocker.Mock()
+    moodle.get_quizzes_by_courses.side_effect = [
+        {"quizzes": [
+            {"id": 1, "course": 3},
+            {"id": 2, "course": 1},
+            {"id": 3, "course": 3}
+        ]},
+        {"quizzes": [], "warnings": []},
+    ]
+
+    res = utils.get_quizzes_by_course_ids(moodle, ["1", 3, 1, "5"], 2)
+
+    assert res == {
+        "1": [{"id": 2, "course": 1}],
+        "3": [{"id": 1, "course": 3}, {"id": 3, "course": 3}],
+        "5": []
+    }
+    assert moodle.get_quizzes_by_courses.call_args_list == [
+        mocker.call([1, 3]),
+        mocker.call([5]),
+    ]